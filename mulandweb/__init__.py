@@ -7,3 +7,7 @@ bottle.BaseRequest.MEMFILE_MAX = config.mulandweb_memfile_max
 app = bottle.Bottle()
 
 from . import handlers
+
+from .transport import TransportMiddleware
+from .metrics import MetricsMiddleware
+application = MetricsMiddleware(TransportMiddleware(app))
@@ -3,15 +3,22 @@
 import argparse
 from . import config
 
-def run(host=config.mulandweb_host, port=config.mulandweb_port):
-    '''Run server on Gunicorn'''
-    from . import app
+def run(host=config.mulandweb_host, port=config.mulandweb_port, asgi=False):
+    '''Run server on Gunicorn, on asyncio workers if asgi'''
+    if asgi:
+        from .asgi import application as app
+    else:
+        from . import application as app
     from gunicorn.app.base import Application
-    gunicorn_config = {'bind': "%s:%d" % (host, port)}
+    from . import metrics
+    metrics.clear()
     class GunicornApplication(Application):
         def __init__(self):
             self.application = app
-            self.options = {'bind': "%s:%d" % (host, port)}
+            self.options = {'bind': "%s:%d" % (host, port),
+                            'child_exit': child_exit}
+            if asgi:
+                self.options['worker_class'] = 'asgi'
             super().__init__()
         def load_config(self):
             for key, value in self.options.items():
@@ -20,10 +27,22 @@ def run(host=config.mulandweb_host, port=config.mulandweb_port):
             return self.application
     GunicornApplication().run()
 
-def import_model(name, srid=4326):
-    '''Import model into database'''
-    from .mulanddb import ModelImporter
-    ModelImporter(name=name, srid=srid, verbose=True).import_model()
+def child_exit(server, worker):
+    '''Gunicorn hook merging metrics of a worker which exited'''
+    # pylint: disable=unused-argument
+    from . import metrics
+    metrics.retire(worker.pid)
+
+def import_model(name, srid=4326, update=False):
+    '''Import model into model store'''
+    from .filestore import importers
+    importers[config.mulandweb_store](name=name, srid=srid, verbose=True,
+                                      update=update).import_model()
+
+def work(workers=config.mulandweb_job_workers):
+    '''Run job queue workers'''
+    from . import jobs
+    jobs.work(workers)
 
 def create_tables():
     '''Create MulandWeb tables'''
@@ -39,19 +58,33 @@ def main():
     action.add_argument('-i', '--import', dest='import_name',
                         metavar='model_name', type=str, nargs='?', default=None,
                         help="import model 'model_name' with name 'model_name'")
+    action.add_argument('-w', '--work', action='store_true',
+                        help='run workers evaluating queued jobs')
     action.add_argument('-c', '--create-tables', action='store_true',
                         help='create mulandweb tables at the database.')
+    parser.add_argument('-a', '--async', dest='asgi', action='store_true',
+                        help='when running, serve on asyncio workers')
+    parser.add_argument('--workers', dest='workers',
+                        metavar='n', type=int, default=config.mulandweb_job_workers,
+                        help='number of job workers')
     parser.add_argument('--import-srid', dest='srid',
                         metavar='srid', type=int, nargs='?', default=4326,
                         help='specify SRID used in shape files when importing')
+    parser.add_argument('-u', '--update', action='store_true',
+                        help='when importing, replace existing model '
+                             'reloading only changed files')
     args = parser.parse_args()
 
     if args.run:
-        run()
+        run(asgi=args.asgi)
         return
 
     if args.import_name:
-        import_model(args.import_name, srid=args.srid)
+        import_model(args.import_name, srid=args.srid, update=args.update)
+        return
+
+    if args.work:
+        work(args.workers)
         return
 
     if args.create_tables:
@@ -0,0 +1,182 @@
+# coding: utf-8
+'''Serves MulandWeb on an asyncio event loop through ASGI'''
+
+import re
+import sys
+import asyncio
+from tempfile import SpooledTemporaryFile
+from concurrent.futures import ThreadPoolExecutor
+
+from . import config
+from . import application as app
+
+__all__ = ['ASGIApplication', 'application']
+
+_run_re = re.compile('^/[^/]+(/batch)?$')
+
+class ASGIApplication:
+    '''ASGI application running a WSGI application off the event loop
+
+    Each request is handed to a thread of a bounded executor, where database
+    queries and mu-land runs block that thread only, while the event loop
+    keeps serving other connections. Requests running Mu-Land wait on the
+    loop for one of max_runs slots before taking a thread, and free it once
+    the application returns, while their response is sent. Once max_queue
+    requests are waiting, new ones are answered 503 before reading them.
+    '''
+    def __init__(self, wsgi_app, max_runs: int, max_queue: int, threads: int):
+        self.wsgi_app = wsgi_app
+        self.max_runs = max_runs
+        self.max_queue = max_queue
+        self.threads = threads
+        self.waiting = 0
+        self._runs = None
+        self._executor = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            raise ValueError('Unsupported ASGI scope %r' % scope['type'])
+
+        if self._runs is None:
+            self._runs = asyncio.Semaphore(self.max_runs)
+            self._executor = ThreadPoolExecutor(max_workers=self.max_runs + self.threads)
+
+        run = scope['method'] == 'POST' and _run_re.match(scope['path']) is not None
+        if run:
+            if self._runs.locked() and self.waiting >= self.max_queue:
+                await _send_error(send, 503, b'Too many pending requests.')
+                return
+            self.waiting += 1
+        try:
+            body = await _read_body(receive)
+            if run and body is not None:
+                await self._runs.acquire()
+        finally:
+            if run:
+                self.waiting -= 1
+        if body is None:
+            await _send_error(send, 413, b'Request body is too large.')
+            return
+        await self._serve(scope, body, send, self._runs.release if run else None)
+
+    async def _serve(self, scope, body, send, release=None):
+        '''Run WSGI application at executor and send its response
+
+        release is called as soon as the application returns.
+        '''
+        loop = asyncio.get_running_loop()
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            '''Record status and headers of response'''
+            # pylint: disable=unused-argument
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = [(key.lower().encode('latin-1'),
+                                    value.encode('latin-1'))
+                                   for key, value in headers]
+            return response.setdefault('written', []).append
+
+        environ = _environ(scope, body)
+        try:
+            result = await loop.run_in_executor(self._executor, self.wsgi_app,
+                                                environ, start_response)
+        finally:
+            if release is not None:
+                release()
+        iterator = iter(result)
+        try:
+            # Chunks are produced at executor, so streamed bodies don't block
+            chunk = await loop.run_in_executor(self._executor, next, iterator, None)
+            await send({'type': 'http.response.start',
+                        'status': response['status'],
+                        'headers': response['headers']})
+            for written in response.get('written', []):
+                await send({'type': 'http.response.body', 'body': written,
+                            'more_body': True})
+            while chunk is not None:
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': chunk,
+                                'more_body': True})
+                chunk = await loop.run_in_executor(self._executor, next,
+                                                   iterator, None)
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            if hasattr(result, 'close'):
+                await loop.run_in_executor(self._executor, result.close)
+
+    async def _lifespan(self, receive, send):
+        '''Handle lifespan protocol'''
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self._executor is not None:
+                    self._executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+async def _read_body(receive):
+    '''Read whole request body into a spooled file, None if it's too large'''
+    body = SpooledTemporaryFile(max_size=config.mulandweb_memfile_max)
+    size = 0
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            break
+        chunk = message.get('body', b'')
+        size += len(chunk)
+        if size > config.mulandweb_body_max:
+            body.close()
+            return None
+        body.write(chunk)
+        if not message.get('more_body', False):
+            break
+    body.seek(0)
+    return body
+
+async def _send_error(send, status, body):
+    '''Send plain text error response'''
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', b'text/plain'),
+                            (b'content-length', str(len(body)).encode()),
+                            (b'retry-after', b'1')]})
+    await send({'type': 'http.response.body', 'body': body})
+
+def _environ(scope, body):
+    '''Build WSGI environ from ASGI scope'''
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'REMOTE_ADDR': client[0],
+        'SERVER_PROTOCOL': 'HTTP/%s' % scope.get('http_version', '1.1'),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for key, value in scope.get('headers', []):
+        key = key.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            key = 'HTTP_' + key
+        if key in environ:
+            value = environ[key] + ',' + value
+        environ[key] = value
+    return environ
+
+application = ASGIApplication(app, config.mulandweb_async_runs,
+                              config.mulandweb_async_queue,
+                              config.mulandweb_async_threads)
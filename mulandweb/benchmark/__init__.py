@@ -0,0 +1,11 @@
+# coding: utf-8
+'''Benchmarks MulandWeb on synthetic models
+
+Run python -m mulandweb.benchmark -h for usage.
+'''
+
+from .synthetic import SyntheticModel
+from .timing import stages, measure, sweep, report, compare, save, load
+
+__all__ = ['SyntheticModel', 'stages', 'measure', 'sweep', 'report',
+           'compare', 'save', 'load']
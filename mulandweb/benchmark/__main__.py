@@ -0,0 +1,82 @@
+# coding: utf-8
+
+import argparse
+from .synthetic import SyntheticModel
+from . import timing
+
+def generate(name, path, params):
+    '''Write synthetic model files, to be imported as model name'''
+    model = SyntheticModel(**{key: params[key] for key in
+                              ['zones', 'agents', 'types', 'markets', 'seed']})
+    folder = model.write(path, name)
+    print('Model written to %s, import it with python -m mulandweb -i %s'
+          % (folder, name))
+
+def run(params, sweep=None, repeat=3, model=None, output=None, baseline=None):
+    '''Time stages, printing and optionally storing results'''
+    # pylint: disable=too-many-arguments
+    if sweep:
+        name, _, values = sweep.partition('=')
+        if name not in params:
+            raise SystemExit("Can't sweep unknown parameter '%s'" % name)
+        results = timing.sweep(params, name,
+                               [type(params[name])(value) for value in values.split(',')],
+                               repeat, model)
+    else:
+        results = [timing.measure(params, repeat, model)]
+
+    timing.report(results)
+    if baseline:
+        timing.compare(results, timing.load(baseline))
+    if output:
+        timing.save(results, output)
+
+def main():
+    '''Main function'''
+    parser = argparse.ArgumentParser(prog='mulandweb.benchmark',
+                                     description='MulandWeb benchmarks')
+    action = parser.add_mutually_exclusive_group(required=True)
+    action.add_argument('-g', '--generate', dest='generate_name',
+                        metavar='model_name', type=str, default=None,
+                        help="write synthetic model files of 'model_name'")
+    action.add_argument('-r', '--run', action='store_true',
+                        help='time request stages on a synthetic model')
+    parser.add_argument('--path', default='.',
+                        help='folder where models are generated')
+    parser.add_argument('--zones', type=int, default=24)
+    parser.add_argument('--agents', type=int, default=6)
+    parser.add_argument('--types', type=int, default=12)
+    parser.add_argument('--markets', type=int, default=2)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--locations', type=int, default=1000,
+                        help='locations of each request')
+    parser.add_argument('--units', type=int, default=4,
+                        help='units of each location')
+    parser.add_argument('--overrides', type=float, default=0.1,
+                        help='share of locations and units with overrides')
+    parser.add_argument('--sweep', metavar='name=v1,v2,...',
+                        help='repeat run for each value of a parameter')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--model', metavar='model_name',
+                        help='query input data from imported model generated '
+                             'with the same parameters')
+    parser.add_argument('-o', '--output', metavar='file',
+                        help='store results as a JSON baseline')
+    parser.add_argument('-b', '--baseline', metavar='file',
+                        help='compare results to a JSON baseline')
+    args = parser.parse_args()
+
+    params = {key: getattr(args, key) for key in
+              ['zones', 'agents', 'types', 'markets', 'seed', 'locations',
+               'units', 'overrides']}
+
+    if args.generate_name:
+        generate(args.generate_name, args.path, params)
+        return
+
+    if args.run:
+        run(params, args.sweep, args.repeat, args.model, args.output,
+            args.baseline)
+        return
+
+main()
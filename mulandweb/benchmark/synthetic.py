@@ -0,0 +1,260 @@
+# coding: utf-8
+'''Generates synthetic Mu-Land models of configurable size
+
+Zones are squares of a grid in EPSG:4326. Agents and real estate types are
+spread evenly over markets, and every agent bids on every real estate type
+of its market at every zone, as at the demo-city model.
+'''
+
+import os
+import math
+from pathlib import Path
+
+import numpy as np
+import shapefile
+
+from ..muland import MulandData
+
+__all__ = ['SyntheticModel']
+
+class SyntheticModel:
+    '''Model of zones x agents x types, generated from seed
+
+    tables maps each model file to (header, values), values being an array
+    of its records in the order they are written.
+    '''
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, zones: int = 24, agents: int = 6, types: int = 12,
+                 markets: int = 2, seed: int = 0, cell: float = 0.01,
+                 origin=(-119.8, 36.7)):
+        # pylint: disable=too-many-arguments
+        if min(zones, agents, types, markets) < 1:
+            raise ValueError('Model sizes must be positive')
+        if markets > min(agents, types):
+            raise ValueError('Every market needs an agent and a type')
+
+        self.zones = zones
+        self.agents = agents
+        self.types = types
+        self.markets = markets
+        self.seed = seed
+        self.cell = cell
+        self.origin = origin
+        self.grid = int(math.ceil(math.sqrt(zones)))
+
+        rng = np.random.default_rng(seed)
+        self.agents_market = np.arange(agents) * markets // agents + 1
+        self.types_market = np.arange(types) * markets // types + 1
+        self.tables = {}
+        self._generate(rng)
+
+    def _generate(self, rng):
+        '''Generate tables of model files'''
+        # pylint: disable=too-many-locals
+        n_i, n_h, n_v = self.zones, self.agents, self.types
+        zone_ids = np.arange(1, n_i + 1)
+        agent_ids = np.arange(1, n_h + 1)
+        type_ids = np.arange(1, n_v + 1)
+
+        self.tables['zones'] = (
+            ['I_IDX', 'INDAREA', 'COMAREA', 'SERVAREA', 'TOTAREA', 'TOTBUILT',
+             'INCOMEHH', 'DIST_ACC'],
+            np.column_stack((zone_ids, rng.uniform(0, 5, (n_i, 3)),
+                             rng.uniform(100, 10000, n_i), rng.uniform(1, 20, n_i),
+                             rng.uniform(0, 5000, n_i), rng.uniform(1, 10, n_i))))
+
+        self.tables['agents'] = (
+            ['IDAGENT', 'IDMARKET', 'IDAGGRA', 'UPPERBB', 'HHINC', 'RHO',
+             'FNIP', 'ONES'],
+            np.column_stack((agent_ids, self.agents_market, agent_ids,
+                             np.full(n_h, 50000.0), rng.uniform(500, 5000, n_h),
+                             rng.uniform(10, 25, n_h), np.zeros(n_h), np.ones(n_h))))
+
+        h, i = _product(agent_ids, zone_ids)
+        self.tables['agents_zones'] = (
+            ['H_IDX', 'I_IDX', 'ACC', 'P_LN_ATT'],
+            np.column_stack((h, i, rng.uniform(0, 1, h.shape[0]), np.zeros(h.shape[0]))))
+
+        i, v = _product(zone_ids, type_ids)
+        is_house = (v % 2).astype(float)
+        self.tables['real_estates_zones'] = (
+            ['V_IDX', 'I_IDX', 'M_IDX', 'LOTSIZE', 'BUILT', 'IS_HOUSE', 'IS_APT'],
+            np.column_stack((v, i, self.types_market[v - 1],
+                             rng.uniform(1, 6, v.shape[0]),
+                             rng.uniform(0.01, 0.4, v.shape[0]),
+                             is_house, 1 - is_house)))
+
+        v, i = _product(type_ids, zone_ids)
+        self.tables['rent_adjustments'] = (['V_IDX', 'I_IDX', 'RENTADJ'],
+                                           np.column_stack((v, i, np.zeros(v.shape[0]))))
+        self.tables['supply'] = (['V_IDX', 'I_IDX', 'NREST'],
+                                 np.column_stack((v, i, rng.uniform(0, 200, v.shape[0]))))
+
+        self.tables['demand'] = (['H_IDX', 'DEMAND'],
+                                 np.column_stack((agent_ids, rng.uniform(1000, 20000, n_h))))
+
+        h, v, i = _product(agent_ids, type_ids, zone_ids)
+        for name, column, value in [('subsidies', 'SUBSIDIES', 0.0),
+                                    ('demand_exogenous_cutoff', 'DCUTOFF', 1.0),
+                                    ('bids_adjustments', 'BIDADJ', 0.0)]:
+            self.tables[name] = (['H_IDX', 'V_IDX', 'I_IDX', column],
+                                 np.column_stack((h, v, i, np.full(h.shape[0], value))))
+
+        # Bids on real estates BUILT and zones DIST_ACC and INCOMEHH
+        rows = []
+        for idattrib, crest, czones in [(1, 5, 0), (2, 0, 8), (3, 0, 7)]:
+            for agent in range(n_h):
+                rows.append([self.agents_market[agent], agent + 1, idattrib,
+                             rng.uniform(0.001, 5), 0, crest, 0, czones, 1,
+                             0, 0, 0, 0, 0])
+        self.tables['bids_functions'] = (
+            ['IDMARKET', 'IDAGGRA', 'IDATTRIB', 'LINEAPAR', 'CAGENT_X',
+             'CREST_X', 'CACC_X', 'CZONES_X', 'EXPPAR_X', 'CAGENT_Y',
+             'CREST_Y', 'CACC_Y', 'CZONES_Y', 'EXPPAR_Y'],
+            np.array(rows, dtype=float))
+
+        # Rents on real estates BUILT and LOTSIZE
+        rows = []
+        for market in range(1, self.markets + 1):
+            for idattrib, crest in [(1, 5), (2, 4)]:
+                rows.append([market, idattrib, 0.4, rng.uniform(0.3, 0.6),
+                             crest, 0, 1, 0, 0, 0])
+        self.tables['rent_functions'] = (
+            ['IDMARKET', 'IDATTRIB', 'SCALEPAR', 'LINEAPAR', 'CREST_X',
+             'CZONES_X', 'EXPPAR_X', 'CREST_Y', 'CZONES_Y', 'EXPPAR_Y'],
+            np.array(rows, dtype=float))
+
+    def zone_bounds(self, zones_id: int):
+        '''Return (lng0, lat0, lng1, lat1) of zone'''
+        row, col = divmod(zones_id - 1, self.grid)
+        lng = self.origin[0] + col * self.cell
+        lat = self.origin[1] + row * self.cell
+        return lng, lat, lng + self.cell, lat + self.cell
+
+    def write(self, path: str, name: str):
+        '''Write model files to path/name, as read by ModelImporter'''
+        folder = Path(path, name)
+        os.makedirs(str(folder), exist_ok=True)
+        for table, (header, values) in self.tables.items():
+            row_format = ';'.join(['%r'] * len(header)) + '\n'
+            with open(str(Path(folder, table + '.csv')), 'w') as file:
+                file.write(';'.join('"%s"' % key for key in header))
+                file.write('\n')
+                for record in values.tolist():
+                    file.write(row_format % tuple(record))
+
+        writer = shapefile.Writer(str(Path(folder, name)), shapeType=shapefile.POLYGON)
+        writer.field('ID', 'N', 10, 0)
+        for zones_id in range(1, self.zones + 1):
+            lng0, lat0, lng1, lat1 = self.zone_bounds(zones_id)
+            # Exterior rings are clockwise
+            writer.poly([[(lng0, lat0), (lng0, lat1), (lng1, lat1),
+                          (lng1, lat0), (lng0, lat0)]])
+            writer.record(zones_id)
+        writer.close()
+        return str(folder)
+
+    def locations(self, count: int, units: int = 4, overrides: float = 0.0,
+                  seed: int = 0):
+        '''Generate location list of a request
+
+        Each location is at a random zone with units of random types.
+        overrides is the share of locations and units given an override.
+        '''
+        rng = np.random.default_rng(seed)
+        zones_ids = rng.integers(1, self.zones + 1, count)
+        offsets = rng.uniform(0.05, 0.95, (count, 2)) * self.cell
+        unit_types = rng.integers(1, self.types + 1, (count, units))
+        location_overridden = rng.uniform(0, 1, count) < overrides
+        unit_overridden = rng.uniform(0, 1, (count, units)) < overrides
+
+        ret = []
+        for index, zones_id in enumerate(zones_ids.tolist()):
+            lng, lat, _, _ = self.zone_bounds(zones_id)
+            location = {'lnglat': [lng + float(offsets[index, 0]),
+                                   lat + float(offsets[index, 1])],
+                        'units': []}
+            if location_overridden[index]:
+                location['dist_acc'] = 1.0
+            for unit in range(units):
+                item = {'type': int(unit_types[index, unit])}
+                if unit_overridden[index, unit]:
+                    item['lotsize'] = 2.0
+                location['units'].append(item)
+            ret.append(location)
+        return ret
+
+    def zones_of(self, lng, lat):
+        '''Return zone id of each point, 0 if not in any zone'''
+        col = np.floor((np.asarray(lng) - self.origin[0]) / self.cell).astype(np.int64)
+        row = np.floor((np.asarray(lat) - self.origin[1]) / self.cell).astype(np.int64)
+        zones_ids = row * self.grid + col + 1
+        inside = ((col >= 0) & (col < self.grid) & (row >= 0) &
+                  (zones_ids <= self.zones))
+        return np.where(inside, zones_ids, 0)
+
+    def muland_data(self, scenario):
+        '''Get Muland input of scenario, as MulandDB.get returns it
+
+        Tables are built from the model in memory, in place of database
+        queries, and overrides aren't applied.
+        '''
+        # pylint: disable=too-many-locals
+        tables = self.tables
+        zones_of = self.zones_of(scenario.lng, scenario.lat)
+        located = np.nonzero(zones_of)[0]
+        lids = located + 1
+        zones = zones_of[located]
+
+        units = np.nonzero(zones_of[scenario.unit_loc])[0]
+        unit_lids = scenario.unit_loc[units] + 1
+        unit_zones = zones_of[scenario.unit_loc[units]]
+        unit_types = scenario.unit_type[units]
+        n_i, n_h, n_v = self.zones, self.agents, self.types
+
+        def by_unit(table, column):
+            '''Rows [type, lid, value] of table laid out type x zone'''
+            value = tables[table][1][:, column].reshape(n_v, n_i)
+            return np.column_stack((unit_types, unit_lids,
+                                    value[unit_types - 1, unit_zones - 1]))
+
+        def by_agent_unit(table):
+            '''Rows [agent, type, lid, value] of table laid out agent x type x zone'''
+            value = tables[table][1][:, 3].reshape(n_h, n_v, n_i)
+            h = np.repeat(np.arange(n_h), units.shape[0])
+            u = np.tile(np.arange(units.shape[0]), n_h)
+            return np.column_stack((h + 1, unit_types[u], unit_lids[u],
+                                    value[h, unit_types[u] - 1, unit_zones[u] - 1]))
+
+        agents_zones = tables['agents_zones'][1].reshape(n_h, n_i, -1)
+        h = np.repeat(np.arange(n_h), located.shape[0])
+        loc = np.tile(np.arange(located.shape[0]), n_h)
+        real_estates = tables['real_estates_zones'][1].reshape(n_i, n_v, -1)
+
+        values = {
+            'zones': np.column_stack((lids, tables['zones'][1][zones - 1, 1:])),
+            'agents': tables['agents'][1],
+            'agents_zones': np.column_stack((h + 1, lids[loc],
+                                             agents_zones[h, zones[loc] - 1, 2:])),
+            'bids_adjustments': by_agent_unit('bids_adjustments'),
+            'bids_functions': tables['bids_functions'][1],
+            'demand': tables['demand'][1],
+            'demand_exogenous_cutoff': by_agent_unit('demand_exogenous_cutoff'),
+            'real_estates_zones': np.column_stack(
+                (unit_types, unit_lids,
+                 real_estates[unit_zones - 1, unit_types - 1, 2:])),
+            'rent_adjustments': by_unit('rent_adjustments', 2),
+            'rent_functions': tables['rent_functions'][1],
+            'subsidies': by_agent_unit('subsidies'),
+            'supply': by_unit('supply', 2),
+        }
+        data = {name: MulandData(header=tables[name][0], values=value)
+                for name, value in values.items()}
+        data['static_key'] = 'synthetic-%d-%d-%d-%d-%d' % (
+            self.zones, self.agents, self.types, self.markets, self.seed)
+        return data
+
+def _product(*columns):
+    '''Return columns of cartesian product of arrays, last varying fastest'''
+    grids = np.meshgrid(*columns, indexing='ij')
+    return tuple(grid.reshape(-1) for grid in grids)
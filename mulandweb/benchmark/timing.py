@@ -0,0 +1,193 @@
+# coding: utf-8
+'''Times each stage of a request on synthetic models
+
+Stages run as they do for a request:
+
+    ingest      decoding and validation of the JSON body into a Scenario
+    get         MulandDB.get, only when a model imported in the model store
+                is given
+    overrides   resolution and application of the scenario's overrides
+    populate    Muland._populate_working_dir
+    run         mu-land subprocess, or MulandEngine when MULAND_ENGINE is
+                numpy
+    collect     Muland._collect_data
+    encode_*    encoding of output data by each response codec
+
+Results are dicts of parameters and seconds of each stage by repetition,
+and are stored as JSON baselines.
+'''
+
+import io
+import os
+import sys
+import json
+import time
+import tempfile
+import platform
+import statistics
+from pathlib import Path
+
+import numpy as np
+
+from ..muland import Muland
+from ..engine import MulandEngine
+from ..mulanddb import Overrides
+from ..filestore import stores
+from .synthetic import SyntheticModel
+from .. import formats
+from .. import config
+
+__all__ = ['stages', 'measure', 'sweep', 'report', 'compare', 'save', 'load']
+
+stages = ['ingest', 'get', 'overrides', 'populate', 'run', 'collect',
+          'encode_json', 'encode_xml', 'encode_npz']
+
+_encoders = {'encode_json': formats.json_codec,
+             'encode_xml': formats.XMLCodec(),
+             'encode_npz': formats.NPZCodec()}
+
+def measure(params: dict, repeat: int = 3, model: str = None):
+    '''Time stages of requests with params, repeat times
+
+    params are the arguments of SyntheticModel and of its locations method.
+    If model is given, input data is queried from that model, which must
+    have been generated with the same params and imported.
+    '''
+    synthetic = SyntheticModel(**{key: params[key] for key in
+                                  ['zones', 'agents', 'types', 'markets', 'seed']})
+    body = json.dumps({'loc': synthetic.locations(
+        params['locations'], params['units'], params['overrides'],
+        params['seed'])}).encode('utf-8')
+
+    times = {stage: [] for stage in stages}
+    for _ in range(repeat):
+        timer = _Timer(times)
+        with timer('ingest'):
+            scenario = formats.json_codec.load_scenario(io.BytesIO(body),
+                                                        'application/json')
+        if model is not None:
+            with timer('get'), stores[config.mulandweb_store](model, scenario) as mudb:
+                data = mudb.get()
+        else:
+            data = synthetic.muland_data(scenario)
+        with timer('overrides'):
+            overrides = Overrides(scenario)
+            for key, value in data.items():
+                if key in Muland.input_files:
+                    overrides.apply(value)
+        output_data = _run_muland(data, timer)
+        for stage, codec in _encoders.items():
+            with timer(stage):
+                for _ in codec.iterdump(output_data):
+                    pass
+
+    return {'params': dict(params, model=model, engine=config.muland_engine),
+            'rows': {key: len(value) for key, value in data.items()
+                     if key in Muland.input_files},
+            'times': {stage: seconds for stage, seconds in times.items() if seconds}}
+
+def sweep(params: dict, name: str, values: list, repeat: int = 3, model=None):
+    '''Measure stages as parameter name takes each of values'''
+    # pylint: disable=too-many-arguments
+    return [measure(dict(params, **{name: value}), repeat, model)
+            for value in values]
+
+def report(results: list, file=sys.stdout):
+    '''Print median milliseconds of each stage by result'''
+    columns = [stage for stage in stages
+               if any(stage in result['times'] for result in results)]
+    keys = ['zones', 'agents', 'types', 'locations', 'units']
+    widths = [max(9, len(column)) for column in keys + columns]
+    print(' '.join('%*s' % item for item in zip(widths, keys + columns)), file=file)
+    for result in results:
+        cells = ['%d' % result['params'][key] for key in keys]
+        cells.extend('%.2f' % (statistics.median(result['times'][stage]) * 1000)
+                     if stage in result['times'] else '-'
+                     for stage in columns)
+        print(' '.join('%*s' % item for item in zip(widths, cells)), file=file)
+
+def compare(results: list, baseline: dict, file=sys.stdout):
+    '''Print ratio of median times of results to those of baseline
+
+    Results are matched to baseline results of the same params.
+    '''
+    previous = {_params_key(result['params']): result
+                for result in baseline['results']}
+    for result in results:
+        base = previous.get(_params_key(result['params']))
+        if base is None:
+            print('%s: not in baseline' % _params_key(result['params']), file=file)
+            continue
+        ratios = ['%s x%.2f' % (stage, statistics.median(seconds) /
+                                statistics.median(base['times'][stage]))
+                  for stage, seconds in result['times'].items()
+                  if stage in base['times']]
+        print('%s: %s' % (_params_key(result['params']), ', '.join(ratios)),
+              file=file)
+
+def save(results: list, filename: str):
+    '''Store results as a JSON baseline'''
+    baseline = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'environment': {'python': platform.python_version(),
+                        'numpy': np.__version__,
+                        'machine': platform.machine(),
+                        'cpus': os.cpu_count()},
+        'results': results,
+    }
+    with open(filename, 'w') as file:
+        json.dump(baseline, file, indent=1, sort_keys=True)
+
+def load(filename: str):
+    '''Load JSON baseline'''
+    with open(filename) as file:
+        return json.load(file)
+
+def _params_key(params):
+    '''Key matching results of the same params'''
+    return ','.join('%s=%s' % item for item in sorted(params.items()))
+
+def _run_muland(data, timer):
+    '''Time populate, run and collect stages, returning output data'''
+    mu = Muland(**data)
+    with tempfile.TemporaryDirectory(dir=Muland.work_folder) as working_dir:
+        with timer('populate'):
+            mu._populate_working_dir(working_dir) # pylint: disable=protected-access
+        if config.muland_engine == 'binary':
+            with timer('run'):
+                mu._run_muland(working_dir, config.muland_timeout) # pylint: disable=protected-access
+        else:
+            engine = MulandEngine(**data)
+            with timer('run'):
+                engine.run()
+            _write_output(working_dir, engine.output_data)
+        with timer('collect'):
+            mu._collect_data(working_dir) # pylint: disable=protected-access
+    return mu.output_data
+
+def _write_output(working_dir, output_data):
+    '''Write output files as mu-land does, for collect stage'''
+    for name, values in output_data.items():
+        with open(str(Path(working_dir, 'output', name + '.csv')), 'w') as file:
+            file.write(';'.join('"C%d"' % column for column in range(values.shape[1])))
+            file.write('\n')
+            np.savetxt(file, values, delimiter=';', fmt='%.10g')
+
+class _Timer:
+    '''Context managers appending seconds taken to times of a stage'''
+    def __init__(self, times):
+        self.times = times
+        self.stage = None
+        self.start = None
+
+    def __call__(self, stage):
+        self.stage = stage
+        return self
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.times[self.stage].append(time.perf_counter() - self.start)
@@ -2,19 +2,107 @@
 # pylint: disable=bad-continuation,invalid-name
 '''Specifies database tables and provides function to create them'''
 
-from sqlalchemy import create_engine, Table, Column, MetaData
-from sqlalchemy import Integer, String, Float, ForeignKey, Sequence
+import os
+import re
+from collections import namedtuple
+from time import perf_counter
+
+from sqlalchemy import create_engine, event, exc, Table, Column, MetaData
+from sqlalchemy import Integer, String, Float, Text, DateTime, ForeignKey, Sequence
+from sqlalchemy import Index, func
 from sqlalchemy import ForeignKeyConstraint
 from sqlalchemy.dialects.postgresql import ARRAY
 from geoalchemy2 import Geometry
 from . import config
 
-engine = create_engine(config.db_url)
+QueryStat = namedtuple('QueryStat', ['name', 'seconds', 'rows'])
+
+_engine = None
+_engine_pid = None
+_inherited_engines = []
+_label_re = re.compile(r'^\s*(?:(?:EXECUTE|PREPARE)\s+(\w+)|.*?\bFROM\s+(\w+))',
+                       re.IGNORECASE | re.DOTALL)
+
+def get_engine():
+    '''Return engine of this process, creating it on first use
+
+    The engine is created after fork, so processes never share pooled
+    connections.
+    '''
+    global _engine, _engine_pid # pylint: disable=global-statement
+    pid = os.getpid()
+    if _engine is not None and _engine_pid == pid:
+        return _engine
+
+    # Keep engine inherited from parent process referenced, so its
+    # connections, whose sockets belong to the parent, are never closed here
+    if _engine is not None:
+        _inherited_engines.append(_engine)
+
+    _engine = create_engine(config.db_url,
+                            pool_size=config.db_pool_size,
+                            max_overflow=config.db_max_overflow,
+                            pool_timeout=config.db_pool_timeout,
+                            pool_recycle=config.db_pool_recycle,
+                            pool_pre_ping=True)
+    _engine_pid = pid
+    event.listen(_engine, 'connect', _on_connect)
+    event.listen(_engine, 'checkout', _on_checkout)
+    event.listen(_engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(_engine, 'after_cursor_execute', _after_cursor_execute)
+    return _engine
+
+def __getattr__(name):
+    '''Provide engine attribute, created lazily by get_engine'''
+    if name == 'engine':
+        return get_engine()
+    raise AttributeError("module '%s' has no attribute '%s'" % (__name__, name))
+
+def connect():
+    '''Lease a connection from the pool of this process
+
+    The connection returns to the pool when closed, so use it as a context
+    manager. Statistics of every query run with it are appended to the
+    QueryStat list at its info['query_stats'].
+    '''
+    conn = get_engine().connect()
+    conn.info['query_stats'] = []
+    return conn
+
+def _on_connect(dbapi_connection, connection_record):
+    '''Record process owning new DBAPI connection'''
+    # pylint: disable=unused-argument
+    connection_record.info['pid'] = os.getpid()
+
+def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+    '''Refuse connections created by another process'''
+    # pylint: disable=unused-argument
+    if connection_record.info['pid'] != os.getpid():
+        connection_record.connection = connection_proxy.connection = None
+        raise exc.DisconnectionError('Connection belongs to another process')
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    '''Start timing query'''
+    # pylint: disable=unused-argument,too-many-arguments
+    conn.info['query_start'] = perf_counter()
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    '''Record query statistics at leased connection'''
+    # pylint: disable=unused-argument,too-many-arguments
+    stats = conn.info.get('query_stats')
+    if stats is None:
+        return
+    match = _label_re.match(statement)
+    name = (match.group(1) or match.group(2)) if match else 'query'
+    stats.append(QueryStat(name, perf_counter() - conn.info['query_start'],
+                           cursor.rowcount))
+
 meta = MetaData()
 
 models = Table(config.db_prefix + 'models', meta,
     Column('id', Integer, Sequence(config.db_prefix + 'models_id_seq'), primary_key=True),
     Column('name', String, index=True, nullable=False, unique=True),
+    Column('version', Integer, nullable=False, server_default='1'),
     Column('zones_header', ARRAY(String, zero_indexes=True), nullable=False),
     Column('agents_header', ARRAY(String, zero_indexes=True), nullable=False),
     Column('agents_zones_header', ARRAY(String, zero_indexes=True), nullable=False),
@@ -156,6 +244,27 @@ rent_functions = Table(config.db_prefix + 'rent_functions', meta,
     Column('exppar_y', Float, nullable=False),
 )
 
+model_files = Table(config.db_prefix + 'model_files', meta,
+    Column('models_id', Integer, ForeignKey(models.c.id), primary_key=True),
+    Column('table_name', String, primary_key=True),
+    Column('checksum', String, nullable=False),
+)
+
+jobs = Table(config.db_prefix + 'jobs', meta,
+    Column('id', String(32), primary_key=True),
+    Column('model', String, nullable=False),
+    Column('engine', String, nullable=False),
+    Column('status', String, nullable=False), # queued, running, done or failed
+    Column('attempts', Integer, nullable=False, server_default='0'),
+    Column('input', Text, nullable=False),
+    Column('output', Text),
+    Column('error', Text),
+    Column('created', DateTime(timezone=True), nullable=False, server_default=func.now()),
+    Column('started', DateTime(timezone=True)),
+    Column('finished', DateTime(timezone=True)),
+    Index(config.db_prefix + 'jobs_status_created_idx', 'status', 'created'),
+)
+
 def create_tables():
     '''Create tables at the database'''
-    meta.create_all(engine)
+    meta.create_all(get_engine())
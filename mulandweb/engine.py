@@ -0,0 +1,209 @@
+# coding: utf-8
+# pylint: disable=invalid-name
+'''Evaluates Mu-Land equations in-process using NumPy'''
+
+import numpy as np
+
+from .muland import Muland, MulandRunError
+from . import metrics
+
+__all__ = ['MulandEngine']
+
+class MulandEngine(Muland):
+    '''Evaluates Mu-Land model in-process
+
+    Takes the same arguments as Muland and fills output_data with the same
+    keys and record layout Muland collects from mu-land's output folder,
+    without creating a working dir or spawning a process.
+    '''
+
+    @classmethod
+    def available(cls):
+        '''Engine runs anywhere numpy does'''
+        return True
+
+    def run(self, timeout=None, rusage=False):
+        '''Runs Muland equations, timeout and rusage are ignored'''
+        try:
+            with np.errstate(all='ignore'), metrics.muland_seconds.time(engine='numpy'):
+                self._evaluate()
+        except (ValueError, IndexError) as e:
+            raise MulandRunError('Mu-Land engine failed: %s' % e)
+
+    def _evaluate(self):
+        '''Evaluate bids, location probability, location and rents'''
+        # pylint: disable=too-many-locals
+        data = {key: value.values for key, value in self.input_data.items()}
+        agents = data['agents']
+        zones = data['zones']
+        real_estates = data['real_estates_zones']
+
+        n_h = agents.shape[0]
+        n_vi = real_estates.shape[0]
+        if n_h == 0:
+            raise MulandRunError('Mu-Land engine requires at least one agent')
+        n_m = int(agents[:, 1].max())
+
+        # Index maps, as built by mu-land's idx::*IdxGen
+        agents_keys = agents[:, 0].astype(np.int64)
+        zones_keys = zones[:, 0].astype(np.int64)
+        vi_keys = _pair_keys(real_estates[:, 0], real_estates[:, 1])
+
+        # Markets: m_idx is the union of masks where agent and real estate
+        # markets agree
+        agents_market = agents[:, 1].astype(np.int64)
+        vi_market = real_estates[:, 2].astype(np.int64)
+        in_market = agents_market[:, None] == vi_market[None, :]
+
+        # Sparse matrices and positional vectors
+        phi = self._hvi_matrix(data['demand_exogenous_cutoff'],
+                               agents_keys, vi_keys, n_vi)
+        bid_adjustment = self._hvi_matrix(data['bids_adjustments'],
+                                          agents_keys, vi_keys, n_vi)
+        subsidies = self._hvi_matrix(data['subsidies'],
+                                     agents_keys, vi_keys, n_vi)
+        acc, att = self._acc_att_matrices(data['agents_zones'],
+                                          agents_keys, zones_keys)
+        demand = _column(data['demand'], 1, n_h, 'demand')
+        supply = _column(data['supply'], 2, n_vi, 'supply')
+        rent_adjustment = _column(data['rent_adjustments'], 2, n_vi,
+                                  'rent_adjustments')
+
+        # BidFn
+        b_hvi = np.zeros((n_h, n_vi))
+        for fn in data['bids_functions']:
+            market, aggra = fn[0], fn[1]
+            vi_mask = (vi_market == market).astype(float)
+            bidders = (agents_market == market) & (agents[:, 2] == aggra)
+            if not bidders.any():
+                continue
+            sources = {'agents': agents[bidders], 'real_estates': real_estates,
+                       'acc': acc[bidders], 'att': att[bidders],
+                       'zones': zones}
+            x = _term(sources, fn[4:9], vi_mask, default=0.0)
+            y = _term(sources, fn[9:14], vi_mask, default=1.0)
+            b_hvi[bidders] += fn[3] * x * y
+        b_hvi += bid_adjustment + subsidies
+        b_h = np.zeros(n_h)
+
+        # LocationProbFn
+        hphi_exp_b = demand[:, None] * phi * np.exp(b_hvi + b_h[:, None])
+        hphi_exp_b = np.where(in_market, hphi_exp_b, 0.0)
+        sum_by_h = hphi_exp_b.sum(axis=0)
+        nonzero = sum_by_h != 0
+        p_hvi = hphi_exp_b.copy()
+        p_hvi[:, nonzero] /= sum_by_h[nonzero]
+
+        # LocationFn
+        h_hvi = supply[None, :] * p_hvi
+
+        # RentsFn
+        r_vi = np.zeros(n_vi)
+        r_mu_m = np.zeros(n_m)
+        ones_vi = np.ones(n_vi)
+        for fn in data['rent_functions']:
+            market = fn[0]
+            vi_mask = (vi_market == market).astype(float)
+            r_mu_m[int(market) - 1] = fn[2]
+            sources = {'real_estates': real_estates, 'zones': zones}
+            x = _term(sources, (0, fn[4], 0, fn[5], fn[6]), vi_mask,
+                      default=ones_vi)
+            y = _term(sources, (0, fn[7], 0, fn[8], fn[9]), vi_mask,
+                      default=ones_vi)
+            r_vi += fn[3] * x * y
+
+        valid_market = (vi_market >= 1) & (vi_market <= n_m)
+        mu_vi = np.zeros(n_vi)
+        mu_vi[valid_market] = r_mu_m[vi_market[valid_market] - 1]
+        has_mu = mu_vi != 0
+        rent_logsum = np.zeros(n_vi)
+        rent_logsum[has_mu] = np.log(sum_by_h[has_mu]) / mu_vi[has_mu]
+        r_vi = rent_logsum + r_vi + rent_adjustment
+
+        # Output, laid out as configurator::save
+        vi_pairs = real_estates[:, 0:2]
+        self.output_data['bids'] = _records(vi_pairs, b_hvi.T)
+        self.output_data['bh'] = _records(agents[:, 0:1], b_h[:, None])
+        self.output_data['location'] = _records(vi_pairs, h_hvi.T)
+        self.output_data['location_probability'] = _records(vi_pairs, p_hvi.T)
+        self.output_data['rents'] = _records(vi_pairs, r_vi[:, None])
+
+    @staticmethod
+    def _hvi_matrix(matrix, agents_keys, vi_keys, n_vi):
+        '''Build h x vi matrix from H_IDX;V_IDX;I_IDX;VALUE records'''
+        ret = np.zeros((agents_keys.shape[0], n_vi))
+        h = _lookup(agents_keys, matrix[:, 0].astype(np.int64))
+        vi = _lookup(vi_keys, _pair_keys(matrix[:, 1], matrix[:, 2]))
+        value = matrix[:, 3]
+        valid = (h >= 0) & (vi >= 0) & (value != 0)
+        ret[h[valid], vi[valid]] = value[valid]
+        return ret
+
+    @staticmethod
+    def _acc_att_matrices(matrix, agents_keys, zones_keys):
+        '''Build h x i accessibility and attraction matrices'''
+        shape = (agents_keys.shape[0], zones_keys.shape[0])
+        acc = np.zeros(shape)
+        att = np.zeros(shape)
+        h = _lookup(agents_keys, matrix[:, 0].astype(np.int64))
+        i = _lookup(zones_keys, matrix[:, 1].astype(np.int64))
+        valid = (h >= 0) & (i >= 0)
+        acc[h[valid], i[valid]] = matrix[valid, 2]
+        att[h[valid], i[valid]] = matrix[valid, 3]
+        return acc, att
+
+def _column(matrix, column, size, name):
+    '''Get column of matrix checking it has one value per row of model'''
+    if matrix.shape[0] != size:
+        raise MulandRunError("'%s' has %d records, expected %d" %
+                             (name, matrix.shape[0], size))
+    return matrix[:, column]
+
+def _pair_keys(first, second):
+    '''Combine two integer columns into a single sortable key'''
+    return (first.astype(np.int64) << 32) | second.astype(np.int64)
+
+def _lookup(keys, values):
+    '''Find row of each value in keys, first match wins, -1 if absent'''
+    if keys.shape[0] == 0:
+        return np.full(values.shape[0], -1, dtype=np.int64)
+    uniq, first = np.unique(keys, return_index=True)
+    pos = np.clip(np.searchsorted(uniq, values), 0, uniq.shape[0] - 1)
+    return np.where(uniq[pos] == values, first[pos], -1)
+
+def _fix_dimensions(source, n_vi):
+    '''Repeat per zone values over real estates as FixDimensions does'''
+    n_i = source.shape[-1]
+    step = n_vi // n_i if n_i else 0
+    ret = np.zeros(source.shape[:-1] + (n_vi,))
+    ret[..., :n_i * step] = np.repeat(source, step, axis=-1)
+    return ret
+
+def _term(sources, definition, vi_mask, default):
+    '''Evaluate x or y term of a bid or rent function definition
+
+    definition is (agents column, real estates column, accessibility or
+    attraction column, zones column, exponent), column indexes starting at 1
+    as in mu-land's function files.
+    '''
+    cagent, crest, cacc, czones, exppar = definition
+    n_vi = vi_mask.shape[0]
+    if cagent != 0:
+        term = sources['agents'][:, int(cagent) - 1, None] * vi_mask
+    elif crest != 0:
+        term = sources['real_estates'][:, int(crest) - 1] * vi_mask
+    elif cacc != 0:
+        term = sources['acc'] if cacc == 3 else sources['att']
+        term = _fix_dimensions(term, n_vi) * vi_mask
+    elif czones != 0:
+        term = _fix_dimensions(sources['zones'][:, int(czones) - 1], n_vi)
+        term = term * vi_mask
+    else:
+        term = default
+    if exppar < 0:
+        return np.where(vi_mask != 0, np.power(term, exppar), 0.0)
+    return np.power(term, exppar)
+
+def _records(keys, values):
+    '''Build output records from key columns and value columns'''
+    return np.hstack((keys, values))
@@ -0,0 +1,335 @@
+# coding: utf-8
+'''Provides an embedded model store of packed files, needing no database
+
+Each model is a single file <MULANDWEB_STORE_PATH>/<name>.model holding its
+tables as raw arrays, mapped into memory and shared by every request and
+worker process. Location dependent tables are sorted by zone and type, so
+rows of locations and units are found by binary search, and zones are
+looked up by a ZoneIndex of their polygons, stored as WKB in EPSG:900913.
+
+Models are imported by ModelFileImporter from the same files read by
+ModelImporter. The store used is chosen by MULANDWEB_STORE, from stores and
+importers.
+'''
+
+import os
+import json
+import mmap
+import uuid
+import struct
+import tempfile
+import warnings
+from pathlib import Path
+from threading import Lock
+from time import perf_counter
+
+import numpy as np
+import shapely
+
+from .mulanddb import MulandDB, MulandDBException, ModelNotFound, ModelImporter
+from .snapshot import ModelSnapshot
+from .zoneindex import ZoneIndex, _to_mercator
+from . import config
+from . import db
+
+__all__ = ['ModelFile', 'ModelFileDB', 'ModelFileImporter', 'open_model',
+           'get_model_version', 'write_model_file', 'stores', 'importers']
+
+_magic = b'MULANDWEB-MODEL1'
+_align = 64
+_static_tables = ['agents', 'bids_functions', 'demand', 'rent_functions']
+_models = {}
+_lock = Lock()
+
+class ModelFile:
+    '''Tables of a model version mapped from its packed file
+
+    Arrays are read-only views of the file, which stay valid after it's
+    replaced by a new version, until the ModelFile is dropped.
+    '''
+    def __init__(self, filename: str):
+        with open(filename, 'rb') as file:
+            stat = os.fstat(file.fileno())
+            meta, data_start = _read_header(file)
+            buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        self.stat_key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        self.models_id = meta['models_id']
+        self.version = meta['version']
+        self.headers = meta['headers']
+        self.keys = meta['keys']
+        self.arrays = {}
+        for name, (dtype, shape, offset) in meta['arrays'].items():
+            self.arrays[name] = np.frombuffer(
+                buffer, dtype=dtype, count=int(np.prod(shape)),
+                offset=data_start + offset).reshape(shape)
+
+        self.snapshot = ModelSnapshot(self.models_id, self.version, self.headers,
+                                      {name: self.arrays[name] for name in _static_tables})
+        zones = self.arrays['zones']
+        wkb = self.arrays['zones.wkb']
+        offsets = self.arrays['zones.wkb_offsets'].tolist()
+        areas = shapely.from_wkb([wkb[offsets[i]:offsets[i + 1]].tobytes()
+                                  for i in range(zones.shape[0])])
+        self.zone_index = ZoneIndex(self.models_id, self.version, zones[:, 0],
+                                    areas, zones[:, 1:])
+
+    def join(self, table: str, lids, zones_ids, types_ids=None):
+        '''Get rows of location dependent table matching each location
+
+        Locations are given by lid and zone, and by type too if they are
+        units. Rows are copies whose zone is replaced by lid of location.
+        '''
+        zone_column, type_column = self.keys[table]
+        keys = np.asarray(zones_ids, dtype=np.int64)
+        if type_column >= 0:
+            keys = (keys << 32) | np.asarray(types_ids, dtype=np.int64)
+        table_keys = self.arrays[table + '.keys']
+        starts = np.searchsorted(table_keys, keys, 'left')
+        counts = np.searchsorted(table_keys, keys, 'right') - starts
+
+        # Expand each location into its range of rows
+        items = np.repeat(np.arange(keys.shape[0]), counts)
+        offsets = np.arange(items.shape[0]) - np.repeat(np.cumsum(counts) - counts,
+                                                        counts)
+        values = self.arrays[table][np.repeat(starts, counts) + offsets]
+        values[:, zone_column] = np.asarray(lids, dtype=float)[items]
+        return values
+
+def open_model(model: str, path: str = None):
+    '''Get ModelFile of model, loading it again if its file was replaced
+
+    Raises ModelNotFound if model has no file.
+    '''
+    filename = _filename(model, path)
+    try:
+        stat = os.stat(filename)
+        with _lock:
+            model_file = _models.get(filename)
+        if model_file is None or model_file.stat_key != (stat.st_ino, stat.st_mtime_ns,
+                                                         stat.st_size):
+            model_file = ModelFile(filename)
+            with _lock:
+                _models[filename] = model_file
+    except FileNotFoundError:
+        raise ModelNotFound
+    return model_file
+
+def get_model_version(model: str):
+    '''Return tuple (models_id, version) of current version of model'''
+    model_file = open_model(model)
+    return model_file.models_id, model_file.version
+
+class ModelFileDB(MulandDB):
+    '''Provides data retrieval from model files, as MulandDB does from the database
+
+    Nothing is held open while it's used, and times of table lookups are
+    kept at query_stats.
+    '''
+    # pylint: disable=too-few-public-methods
+    get_version = staticmethod(get_model_version)
+
+    def _open(self, model):
+        '''Get file of model and return (models_id, version) of it'''
+        self.model_file = open_model(model)
+        self.query_stats = []
+        return self.model_file.models_id, self.model_file.version
+
+    def close(self):
+        '''Nothing is released, as model files are kept by process'''
+        pass
+
+    def _get_snapshot(self):
+        '''Get location independent tables of model file'''
+        return self.model_file.snapshot
+
+    def _get_zones(self):
+        '''Get zones values, as MulandDB._get_zones'''
+        scenario = self.scenario
+        if not len(scenario):
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), []
+
+        start = perf_counter()
+        ret = self.model_file.zone_index.lookup(np.arange(len(scenario)),
+                                                scenario.lng, scenario.lat)
+        self.query_stats.append(db.QueryStat('zones', perf_counter() - start,
+                                             ret[0].shape[0]))
+        return ret
+
+    def _join(self, table, units=True):
+        '''Get rows of table matching units, or locations if not units'''
+        start = perf_counter()
+        if units:
+            params = self.units_params
+            values = self.model_file.join(table, params['lids'], params['zones_ids'],
+                                          params['types_ids'])
+        else:
+            params = self.locations_params
+            values = self.model_file.join(table, params['ids'], params['zones_ids'])
+        self.query_stats.append(db.QueryStat(table, perf_counter() - start,
+                                             values.shape[0]))
+        return values
+
+    def _get_agents_zones_records(self):
+        return self._join('agents_zones', units=False)
+
+    def _get_bids_adjustments_records(self):
+        return self._join('bids_adjustments')
+
+    def _get_demand_exogenous_cutoff_records(self):
+        return self._join('demand_exogenous_cutoff')
+
+    def _get_real_estates_zones(self):
+        return self._join('real_estates_zones')
+
+    def _get_rent_adjustments(self):
+        return self._join('rent_adjustments')
+
+    def _get_subsidies(self):
+        return self._join('subsidies')
+
+    def _get_supply(self):
+        return self._join('supply')
+
+class ModelFileImporter(ModelImporter):
+    '''Import models into packed files of the file store
+
+    Every table is loaded from its CSV file, also when updating, and the
+    new file replaces the current one atomically. Zone shapes are projected
+    from SRID 4326, or taken as they are from 3857 or 900913.
+    '''
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, name, srid=4326, verbose=False, update=False, path=None):
+        # pylint: disable=too-many-arguments
+        super().__init__(name, srid=srid, verbose=verbose, update=update)
+        self.path = path
+
+    def import_model(self):
+        '''Run all the steps to import a model'''
+        try:
+            filename = _filename(self.name, self.path)
+        except ModelNotFound:
+            raise MulandDBException("Invalid model name '%s'" % self.name)
+        try:
+            with open(filename, 'rb') as file:
+                current, _ = _read_header(file)
+        except FileNotFoundError:
+            current = None
+        if current is not None and not self.update:
+            raise MulandDBException("Model '%s' already exists" % self.name)
+        if self.srid not in (4326, 3857, 900913):
+            raise MulandDBException('Model files take shapes in SRID 4326, '
+                                    '3857 or 900913 only')
+
+        arrays = {}
+        keys = {}
+        for table, columns, _, _ in self._tables:
+            values = self._load_csv(table)
+            if 'zones_id' in columns:
+                # Location dependent, sorted by zone and type
+                zone_column = columns.index('zones_id')
+                type_column = columns.index('types_id') if 'types_id' in columns else -1
+                table_keys = values[:, zone_column].astype(np.int64)
+                if type_column >= 0:
+                    table_keys = (table_keys << 32) | values[:, type_column].astype(np.int64)
+                order = np.argsort(table_keys, kind='stable')
+                values = values[order]
+                arrays[table + '.keys'] = table_keys[order]
+                keys[table] = [zone_column, type_column]
+            arrays[table] = values
+            if self.verbose:
+                print('Loaded %d rows of %s' % (values.shape[0], table))
+
+        polygons = self.get_zone_polygons()
+        try:
+            areas = [polygons[zones_id]
+                     for zones_id in arrays['zones'][:, 0].astype(np.int64).tolist()]
+        except KeyError as e:
+            raise MulandDBException('Zone %s has no shape' % e)
+        if self.srid == 4326:
+            areas = shapely.transform(areas, _to_mercator)
+        wkb = shapely.to_wkb(areas)
+        arrays['zones.wkb'] = np.frombuffer(b''.join(wkb), dtype=np.uint8)
+        arrays['zones.wkb_offsets'] = np.concatenate(
+            ([0], np.cumsum([len(item) for item in wkb], dtype=np.int64)))
+
+        version = current['version'] + 1 if current is not None else 1
+        write_model_file(filename, {
+            'name': self.name,
+            'models_id': uuid.uuid4().int >> 66,
+            'version': version,
+            'headers': {key: list(value) for key, value in self.get_headers().items()},
+            'keys': keys,
+        }, arrays)
+        if self.verbose:
+            print('Wrote version %d of %s into %s' % (version, self.name, filename))
+
+    def _load_csv(self, table):
+        '''Load CSV file of table into a records x columns array'''
+        filename = getattr(self, table + '_csv')
+        with open(filename) as f:
+            ncolumns = len(f.readline().split(';'))
+        with warnings.catch_warnings():
+            # Files without records are just empty arrays
+            warnings.simplefilter('ignore', UserWarning)
+            values = np.loadtxt(filename, dtype=float, delimiter=';', skiprows=1,
+                                ndmin=2)
+        return values.reshape(-1, ncolumns)
+
+def write_model_file(filename: str, meta: dict, arrays: dict):
+    '''Write meta and arrays into packed model file, replacing it atomically
+
+    The file holds a magic string, the length of a JSON header and the
+    header, followed by each array, aligned. Offsets of arrays are stored
+    into the header, under 'arrays', from the end of the header.
+    '''
+    entries = {}
+    offset = 0
+    for name, array in arrays.items():
+        array = arrays[name] = np.ascontiguousarray(array)
+        entries[name] = [array.dtype.str, list(array.shape), offset]
+        offset = _aligned(offset + array.nbytes)
+    header = json.dumps(dict(meta, arrays=entries)).encode('utf-8')
+
+    folder = os.path.dirname(filename) or '.'
+    os.makedirs(folder, exist_ok=True)
+    fd, tmpname = tempfile.mkstemp(dir=folder, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            file.write(_magic)
+            file.write(struct.pack('<Q', len(header)))
+            file.write(header)
+            file.write(b'\0' * (_aligned(file.tell()) - file.tell()))
+            for array in arrays.values():
+                file.write(array.tobytes())
+                file.write(b'\0' * (_aligned(array.nbytes) - array.nbytes))
+        os.replace(tmpname, filename)
+    except BaseException:
+        os.unlink(tmpname)
+        raise
+
+def _read_header(file):
+    '''Read header of model file, returning (meta, offset of arrays)'''
+    start = len(_magic) + 8
+    prefix = file.read(start)
+    if prefix[:len(_magic)] != _magic:
+        raise MulandDBException("'%s' isn't a model file" % file.name)
+    length, = struct.unpack_from('<Q', prefix, len(_magic))
+    meta = json.loads(file.read(length).decode('utf-8'))
+    return meta, _aligned(start + length)
+
+def _filename(model, path=None):
+    '''Get file of model at path, MULANDWEB_STORE_PATH by default'''
+    if not model or model.startswith('.') or Path(model).name != model:
+        raise ModelNotFound
+    path = config.mulandweb_store_path if path is None else path
+    return str(Path(path, model + '.model'))
+
+def _aligned(offset):
+    '''Round offset up to alignment of arrays'''
+    return -(-offset // _align) * _align
+
+# Model data access and import of each store, by MULANDWEB_STORE name
+stores = {'postgis': MulandDB, 'file': ModelFileDB}
+importers = {'postgis': ModelImporter, 'file': ModelFileImporter}
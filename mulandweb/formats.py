@@ -0,0 +1,242 @@
+# coding: utf-8
+'''Provides codecs of request and response bodies
+
+Codecs are chosen by MIME type: requests by their Content-Type and
+responses by Accept, falling back to the codec of the request. Besides
+JSON and XML, input data may be sent as typed columns in a binary codec:
+
+    lng, lat        float, one item per location
+    unit_loc        integer, index of location of each unit
+    unit_type       integer, type of each unit
+    loc.<NAME>      float, override of locations, NaN where not set
+    unit.<NAME>     float, override of units, NaN where not set
+
+and output data is returned by binary codecs as one float64 block per file.
+'''
+
+import json
+import codecs
+import zipfile
+from io import BytesIO
+
+import numpy as np
+from numpy.lib.npyio import NpzFile
+
+from . import ingest
+from . import xmlparser
+from . import config
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+__all__ = ['CodecError', 'Codec', 'for_content_type', 'for_accept', 'json_codec']
+
+_chunk_rows = 1024
+_utf8reader = codecs.getreader('utf-8')
+
+class CodecError(Exception):
+    '''Body couldn't be decoded'''
+    pass
+
+class Codec:
+    '''Format of request and response bodies
+
+    mimes are the MIME types handled, the first one being the Content-Type
+    of responses.
+    '''
+    mimes = []
+    charset = None
+
+    @property
+    def content_type(self):
+        '''Content-Type of responses'''
+        if self.charset is None:
+            return self.mimes[0]
+        return '%s; charset=%s' % (self.mimes[0], self.charset)
+
+    def load(self, body, ctype: str):
+        '''Decode request body into input data, None if body is empty'''
+        raise NotImplementedError
+
+    def load_scenario(self, body, ctype: str):
+        '''Decode request body into a Scenario, None if body is empty
+
+        Raises ingest.IngestError if input data isn't a valid scenario.
+        '''
+        data_in = self.load(body, ctype)
+        if data_in is None:
+            return None
+        return ingest.load(data_in)
+
+    def iterdump(self, output_data: dict):
+        '''Encode output data into chunks of bytes'''
+        raise NotImplementedError
+
+class JSONCodec(Codec):
+    '''JSON, encoded a block of rows at a time
+
+    With the orjson backend, JSON is read and written by orjson. Its output
+    has no spaces and writes NaN and infinities as null.
+    '''
+    mimes = ['application/json']
+
+    def __init__(self, backend: str):
+        if backend == 'orjson' and orjson is None:
+            raise ImportError('orjson JSON backend requires orjson')
+        self.backend = backend
+
+    def load(self, body, ctype):
+        data = body.read()
+        if not data:
+            return None
+        try:
+            if self.backend == 'orjson':
+                return orjson.loads(data)
+            return json.loads(data.decode('utf-8'))
+        except ValueError as e:
+            raise CodecError('Invalid JSON: %s' % e)
+
+    def iterdump(self, output_data):
+        if self.backend == 'orjson':
+            dumps, separator = _orjson_dumps, b','
+        else:
+            dumps, separator = _json_dumps, b', '
+
+        # Keys and punctuation are sent along with the next block of rows
+        prefix = b'{'
+        for key, values in output_data.items():
+            prefix += dumps(key) + b':' + separator[1:] + b'['
+            for start in range(0, len(values), _chunk_rows):
+                yield prefix + dumps(values[start:start + _chunk_rows])[1:-1]
+                prefix = separator
+            prefix = b']' + separator if prefix == separator else prefix + b']' + separator
+        yield prefix[:-len(separator)] + b'}' if output_data else b'{}'
+
+class XMLCodec(Codec):
+    '''XML, as read and written by xmlparser'''
+    mimes = ['application/xml', 'text/xml']
+    charset = 'utf-8'
+
+    def load(self, body, ctype):
+        if 'charset=utf-8' not in ctype:
+            raise CodecError('Specify charset=utf-8 for this MIME type.')
+        try:
+            return {'loc': xmlparser.load(_utf8reader(body))}
+        except xmlparser.XMLParseError as e:
+            raise CodecError('Invalid XML: %s' % e)
+
+    def load_scenario(self, body, ctype):
+        # Locations are ingested while they are parsed
+        if 'charset=utf-8' not in ctype:
+            raise CodecError('Specify charset=utf-8 for this MIME type.')
+        try:
+            return ingest.from_locations(xmlparser.iterload(_utf8reader(body)))
+        except xmlparser.XMLParseError as e:
+            raise CodecError('Invalid XML: %s' % e)
+
+    def iterdump(self, output_data):
+        return xmlparser.iterdump(output_data)
+
+class NPZCodec(Codec):
+    '''NumPy's npz archives of typed columns and output blocks'''
+    mimes = ['application/x-npz']
+
+    def load(self, body, ctype):
+        try:
+            npz = np.load(body, allow_pickle=False)
+        except EOFError:
+            return None
+        except (OSError, ValueError, zipfile.BadZipFile) as e:
+            raise CodecError('Invalid npz: %s' % e)
+        if not isinstance(npz, NpzFile):
+            # Body was a single .npy array
+            raise CodecError('Invalid npz: not an archive')
+        try:
+            with npz:
+                return {name: npz[name] for name in npz.files}
+        except (OSError, ValueError, zipfile.BadZipFile) as e:
+            raise CodecError('Invalid npz: %s' % e)
+
+    def load_scenario(self, body, ctype):
+        data_in = self.load(body, ctype)
+        if data_in is None:
+            return None
+        return ingest.from_columns(data_in)
+
+    def iterdump(self, output_data):
+        buffer = BytesIO()
+        np.savez(buffer, **output_data)
+        yield buffer.getvalue()
+
+class MsgPackCodec(Codec):
+    '''MessagePack maps of typed columns and output blocks
+
+    Columns are maps of 'dtype', 'shape' and raw 'data', or plain arrays.
+    '''
+    mimes = ['application/msgpack', 'application/x-msgpack']
+
+    def load(self, body, ctype):
+        try:
+            data = msgpack.unpackb(body.read(), raw=False)
+            return {name: _unpack_block(value) for name, value in data.items()}
+        except (ValueError, TypeError, KeyError, AttributeError,
+                msgpack.UnpackException) as e:
+            raise CodecError('Invalid MessagePack: %s' % e)
+
+    def load_scenario(self, body, ctype):
+        return ingest.from_columns(self.load(body, ctype))
+
+    def iterdump(self, output_data):
+        packer = msgpack.Packer()
+        yield packer.pack_map_header(len(output_data))
+        for key, values in output_data.items():
+            values = np.ascontiguousarray(values, dtype='<f8')
+            yield packer.pack(key) + packer.pack({'dtype': '<f8',
+                                                  'shape': list(values.shape),
+                                                  'data': values.tobytes()})
+
+def for_content_type(ctype: str):
+    '''Get codec reading Content-Type, None if there is none'''
+    return _codecs.get(ctype.split(';')[0].strip().lower())
+
+def for_accept(accept: str, default: Codec):
+    '''Get codec of first MIME type accepted, else default'''
+    for mime in (accept or '').split(','):
+        codec = _codecs.get(mime.split(';')[0].strip().lower())
+        if codec is not None:
+            return codec
+    return default
+
+def _json_dumps(value):
+    '''Encode value with json'''
+    if isinstance(value, np.ndarray):
+        value = value.tolist()
+    return json.dumps(value).encode('utf-8')
+
+def _orjson_dumps(value):
+    '''Encode value with orjson'''
+    if isinstance(value, np.ndarray):
+        value = np.ascontiguousarray(value)
+    return orjson.dumps(value, option=orjson.OPT_SERIALIZE_NUMPY)
+
+def _unpack_block(value):
+    '''Convert MessagePack column into an array'''
+    if isinstance(value, dict):
+        return np.frombuffer(value['data'], dtype=np.dtype(value['dtype'])).reshape(
+            value['shape'])
+    return np.asarray(value)
+
+json_codec = JSONCodec(config.mulandweb_json_backend)
+
+_codecs = {}
+for _codec in ([json_codec, XMLCodec(), NPZCodec()] +
+               ([MsgPackCodec()] if msgpack is not None else [])):
+    for _mime in _codec.mimes:
+        _codecs[_mime] = _codec
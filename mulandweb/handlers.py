@@ -3,98 +3,374 @@
 # pylint: disable=invalid-name,
 '''Provides request handlers for MulandWeb'''
 
+import os
 import re
 import json
-import codecs
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
 import bottle
 
-from .muland import Muland, MulandRunError
-from .mulanddb import MulandDB, ModelNotFound
-from . import xmlparser
+from .muland import Muland, MulandData, MulandRunError, MulandTimeoutError
+from .engine import MulandEngine
+from .mulanddb import ModelNotFound
+from .filestore import stores
+from .resultcache import request_key, results
+from .reducers import ReducerError, reduce as reduce_output, reducers
+from .ingest import IngestError
+from . import ingest
+from . import formats
+from . import jobs
+from . import metrics
+from . import profiling
+from . import config
 from . import app
 
-__all__ = ['post_handler']
+__all__ = ['post_handler', 'batch_handler', 'job_post_handler',
+           'job_get_handler', 'metrics_handler', 'profile_get_handler',
+           'evaluate']
 
 _model_re = re.compile('[a-z]')
-_utf8reader = codecs.getreader('utf-8')
+_engines = {'binary': Muland, 'numpy': MulandEngine}
+_pool = None
 
 @app.post('/<model>')
-def post_handler(model): # pylint: disable=too-many-branches,too-many-statements
+def post_handler(model):
     '''Handles POST requests to server'''
+    profile = _get_profile(model)
+    if profile is None:
+        return _post(model)
+
+    # Response is encoded while profiling, and profiled even if it failed
+    try:
+        with profile:
+            try:
+                output = _post(model, profile)
+                if not isinstance(output, bottle.HTTPResponse):
+                    output = [b''.join(output)]
+            except bottle.HTTPResponse as e:
+                output = e
+    finally:
+        profile.save()
+    target = output if isinstance(output, bottle.HTTPResponse) else bottle.response
+    target.set_header(profiling.id_header, profile.id)
+    return output
+
+def _post(model, profile=None):
+    '''Evaluate request to model, profiling it into profile if given'''
     # Validate model name
     if _model_re.match(model) is None:
         raise bottle.HTTPError(404)
 
+    engine = _get_engine()
+    reduce = _get_reduce()
+
     # Extract data acoording to Content-Type
-    ctype = bottle.request.headers['Content-Type'].lower() # pylint: disable=unsubscriptable-object
-    mime = ctype.split(';')[0]
-    if mime == 'application/json':
-        data_in = bottle.request.json
-        output_mime = 'json'
-    elif mime == 'application/xml' or mime == 'text/xml':
-        if 'charset=utf-8' not in ctype:
-            raise bottle.HTTPError(400, 'Specify charset=utf-8 for '
-                                        'for this MIME type.')
-        loc = xmlparser.load(_utf8reader(bottle.request.body))
-        data_in = {'loc': loc} # pylint: disable=redefined-variable-type
-        output_mime = 'xml'
-    else:
+    ctype = bottle.request.headers.get('Content-Type', '').lower() # pylint: disable=no-member
+    codec = formats.for_content_type(ctype)
+    if codec is None:
         raise bottle.HTTPError(400, 'Invalid Content-Type')
+    try:
+        scenario = codec.load_scenario(bottle.request.body, ctype)
+    except (formats.CodecError, IngestError) as e:
+        raise bottle.HTTPError(400, str(e))
+    output_codec = formats.for_accept(bottle.request.headers.get('Accept'), codec) # pylint: disable=no-member
+    bottle.response.headers['Vary'] = 'Accept'
+
+    if scenario is None:
+        raise bottle.HTTPError(400, 'No input data.')
+
+    # Get data from MulandDB and run Mu-Land, unless result is cached
+    query_stats = []
+    try:
+        key = None if profile is not None else _get_result_key(model, [scenario], engine, reduce)[0]
+        if key is not None:
+            etag = '"%s-%s"' % (key, output_codec.mimes[0].rsplit('/', 1)[-1])
+            bottle.response.headers['ETag'] = etag
+            if etag in bottle.request.headers.get('If-None-Match', ''): # pylint: disable=no-member
+                return bottle.HTTPResponse(status=304, ETag=etag)
+        output_data = evaluate(model, scenario, engine, query_stats, key,
+                               reduce=reduce, profile=profile)
+    except ModelNotFound:
+        raise bottle.HTTPError(404)
+    except ReducerError as e:
+        raise bottle.HTTPError(400, str(e))
+    except MulandRunError as e:
+        raise bottle.HTTPError(500, exception=e)
+    bottle.response.headers['Server-Timing'] = ', '.join(
+        '%s;dur=%.3f;desc="%d rows"' % (stat.name, stat.seconds * 1000, stat.rows)
+        for stat in query_stats)
+
+    # Send response
+    bottle.response.headers['Content-Type'] = output_codec.content_type
+    return metrics.encode_seconds.time_iter(output_codec.iterdump(output_data),
+                                            codec=output_codec.mimes[0])
+
+@app.post('/<model>/batch')
+def batch_handler(model):
+    '''Handles POST requests of many scenarios, streaming results
+
+    Input is a JSON array of objects in the same format accepted by
+    post_handler. Scenarios are evaluated in parallel and each result is
+    sent as a JSON line, in completion order, as soon as it is available.
+    '''
+    # Validate model name
+    if _model_re.match(model) is None:
+        raise bottle.HTTPError(404)
+
+    engine = _get_engine()
+    reduce = _get_reduce()
 
-    # Prepare data
+    ctype = bottle.request.headers.get('Content-Type', '').lower() # pylint: disable=no-member
+    if ctype.split(';')[0] != 'application/json':
+        raise bottle.HTTPError(415, 'Invalid Content-Type')
+
+    data_in = _load_json(ctype)
     if data_in is None:
         raise bottle.HTTPError(400, 'No input data.')
 
-    if not isinstance(data_in, dict):
-        raise bottle.HTTPError(400, 'Input data isn\'t an object.')
+    if not isinstance(data_in, list):
+        raise bottle.HTTPError(400, 'Input data isn\'t an array.')
+
+    if len(data_in) > config.mulandweb_batch_max:
+        raise bottle.HTTPError(400, 'Too many scenarios.')
+
+    scenarios = [_get_scenario(scenario) for scenario in data_in]
+    try:
+        keys = _get_result_key(model, scenarios, engine, reduce)
+    except ModelNotFound:
+        raise bottle.HTTPError(404)
+
+    errors = bottle.request.environ['wsgi.errors']
+    pool = _get_pool()
+    futures = {pool.submit(evaluate, model, scenario, engine, key=key,
+                           reduce=reduce): index
+               for index, (scenario, key) in enumerate(zip(scenarios, keys))}
 
-    if 'loc' not in data_in:
-        raise bottle.HTTPError(400, "'loc' is not present at input data.")
+    def stream():
+        '''Yield JSON line of each scenario as it finishes'''
+        for future in as_completed(futures):
+            scenario = futures[future]
+            try:
+                output_data = future.result()
+            except ModelNotFound:
+                error = 'Model not found'
+            except (MulandRunError, ReducerError) as e:
+                error = str(e)
+            except Exception: # pylint: disable=broad-except
+                # As Bottle does, the traceback is kept out of the response
+                errors.write('Error in scenario %d of batch\n%s' % (
+                    scenario, traceback.format_exc()))
+                error = 'Internal Server Error'
+            else:
+                yield ('{"scenario": %d, "output": ' % scenario).encode('utf-8')
+                yield from metrics.encode_seconds.time_iter(
+                    formats.json_codec.iterdump(output_data),
+                    codec=formats.json_codec.mimes[0])
+                yield b'}\n'
+                continue
+            yield (json.dumps({'scenario': scenario, 'error': error}) +
+                   '\n').encode('utf-8')
 
-    locations = data_in['loc']
-    if not isinstance(locations, list):
-        raise bottle.HTTPError(400, "'loc' isn't an array")
+    bottle.response.headers['Content-Type'] = 'application/x-ndjson'
+    return stream()
 
-    for loc in locations:
-        if 'lnglat' not in loc:
-            raise bottle.HTTPError(400, "'lnglat' not in 'loc' items")
+@app.post('/<model>/jobs')
+def job_post_handler(model):
+    '''Handles POST requests queueing evaluation of a scenario
 
-        lnglat = loc['lnglat']
-        if not isinstance(lnglat, list) or len(lnglat) != 2:
-            raise bottle.HTTPError(400, "'lnglat' isn't array with 2 elements")
+    Input is a JSON object in the same format accepted by post_handler.
+    Responds with the id of the job, whose state and output are available
+    at job_get_handler.
+    '''
+    # Validate model name
+    if _model_re.match(model) is None:
+        raise bottle.HTTPError(404)
 
-        if not all((isinstance(x, (int, float)) for x in lnglat)):
-            raise bottle.HTTPError(400, "lng or lat not a number")
+    engine = _get_engine()
 
-        if 'units' not in loc:
-            raise bottle.HTTPError(400, "'units' not in 'loc' items")
-        units = loc['units']
-        if not isinstance(units, list):
-            raise bottle.HTTPError(400, "'units' isn't an array")
+    ctype = bottle.request.headers.get('Content-Type', '').lower() # pylint: disable=no-member
+    if ctype.split(';')[0] != 'application/json':
+        raise bottle.HTTPError(415, 'Invalid Content-Type')
 
-        for unit in units:
-            if 'type' not in unit:
-                raise bottle.HTTPError(400, "'type' not in unit")
-            if not isinstance(unit['type'], (int, float)):
-                raise bottle.HTTPError(400, "'type' isn't a number")
+    data_in = _load_json(ctype)
+    if data_in is None:
+        raise bottle.HTTPError(400, 'No input data.')
 
-    # Get data from MulandDB
+    _get_scenario(data_in)
     try:
-        mudata = MulandDB(model, locations).get()
+        _get_store().get_version(model)
     except ModelNotFound:
         raise bottle.HTTPError(404)
 
-    # Run Mu-Land
-    mu = Muland(**mudata)
+    job_id = jobs.submit(model, data_in['loc'], engine)
+    bottle.response.status = 202
+    bottle.response.headers['Location'] = '/jobs/' + job_id
+    bottle.response.headers['Content-Type'] = 'application/json'
+    return json.dumps({'id': job_id, 'status': 'queued'})
+
+@app.get('/jobs/<job_id>')
+def job_get_handler(job_id):
+    '''Handles GET requests of state and output of a job'''
+    job = jobs.get(job_id)
+    if job is None:
+        raise bottle.HTTPError(404)
+    bottle.response.headers['Content-Type'] = 'application/json'
+    return json.dumps(job)
+
+@app.get('/metrics')
+def metrics_handler():
+    '''Handles GET requests of metrics of all workers'''
+    bottle.response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    return metrics.render()
+
+@app.get('/profiles/<profile_id>')
+def profile_get_handler(profile_id):
+    '''Handles GET requests of summaries of profiled requests'''
+    if not profiling.authorized(bottle.request.headers.get(profiling.header)): # pylint: disable=no-member
+        raise bottle.HTTPError(403, 'Invalid profile token')
+    summary = profiling.load_summary(profile_id)
+    if summary is None:
+        raise bottle.HTTPError(404)
+    bottle.response.headers['Content-Type'] = 'application/json'
+    return json.dumps(summary)
+
+def evaluate(model, scenario, engine, query_stats=None, key=None,
+             timeout=config.muland_timeout, reduce=None, profile=None):
+    '''Get model data for scenario, run Mu-Land and return its output
+
+    Statistics of database queries are appended to query_stats if given.
+    If key is given, output is looked up at and stored into result cache.
+    Mu-Land is killed after timeout seconds. If reduce, a tuple (reducer
+    names, parameters), is given, tables of reducers are returned instead.
+    If profile is given, queries and Mu-Land resource usage are kept there.
+    Metrics are written before returning, as this may run in a pool process.
+    '''
+    # pylint: disable=too-many-arguments
+    metrics.locations.inc(len(scenario), model=model)
+    metrics.units.inc(scenario.unit_loc.shape[0], model=model)
     try:
-        mu.run()
-    except MulandRunError as e:
-        raise bottle.HTTPError(500, exception=e)
+        if key is None:
+            return _evaluate(model, scenario, engine, query_stats, timeout,
+                             reduce, profile)
+        output_data, hit = results.get_or_compute(
+            key, lambda: _evaluate(model, scenario, engine, query_stats,
+                                   timeout, reduce, profile))
+        metrics.cache_requests.inc(model=model, result='hit' if hit else 'miss')
+        return output_data
+    finally:
+        metrics.flush()
 
-    # Send response
-    if output_mime == 'json':
-        bottle.response.headers['Content-Type'] = 'application/json'
-        return json.dumps(mu.output_data)
-    elif output_mime == 'xml':
-        bottle.response.headers['Content-Type'] = 'application/xml; charset=utf-8'
-        return xmlparser.dumps(mu.output_data)
+def _evaluate(model, scenario, engine, query_stats, timeout, reduce, profile):
+    '''Evaluate scenario, regardless of result cache'''
+    # pylint: disable=too-many-arguments
+    with _get_store()(model, scenario) as mudb:
+        mudata = mudb.get()
+    for stat in mudb.query_stats:
+        metrics.query_seconds.observe(stat.seconds, model=model, query=stat.name)
+    metrics.outside_locations.inc(mudb.outside_locations, model=model)
+    if query_stats is not None:
+        query_stats.extend(mudb.query_stats)
+    if profile is not None:
+        profile.query_stats.extend(mudb.query_stats)
+    mu = _engines[engine](**mudata)
+    try:
+        mu.run(timeout, rusage=profile is not None)
+    except MulandTimeoutError:
+        metrics.muland_failures.inc(model=model, reason='timeout')
+        raise
+    except MulandRunError:
+        metrics.muland_failures.inc(model=model, reason='error')
+        raise
+    finally:
+        if profile is not None:
+            profile.rusage = mu.rusage
+    if reduce is not None:
+        params = mudb.locations_params
+        location_zones = MulandData(['I_IDX', 'ZONE'],
+                                    values=np.column_stack((params['ids'],
+                                                            params['zones_ids'])))
+        return reduce_output(reduce[0], reduce[1],
+                             dict(mu.input_data, location_zones=location_zones),
+                             mu.output_data)
+    return mu.output_data
+
+def _load_json(ctype):
+    '''Decode JSON request body, which may be larger than MEMFILE_MAX'''
+    try:
+        return formats.json_codec.load(bottle.request.body, ctype)
+    except formats.CodecError as e:
+        raise bottle.HTTPError(400, str(e))
+
+def _get_engine():
+    '''Get engine selected for request'''
+    engine = bottle.request.query.get('engine', config.muland_engine) # pylint: disable=no-member
+    if engine not in _engines:
+        raise bottle.HTTPError(400, 'Invalid engine')
+    if not _engines[engine].available():
+        raise bottle.HTTPError(400, 'Engine not available')
+    return engine
+
+def _get_store():
+    '''Get class reading model data of configured store'''
+    return stores[config.mulandweb_store]
+
+def _get_reduce():
+    '''Get reducers selected for request and their parameters'''
+    names = bottle.request.query.get('reduce') # pylint: disable=no-member
+    if not names:
+        return None
+    names = names.split(',')
+    params = {}
+    for name in names:
+        if name not in reducers:
+            raise bottle.HTTPError(400, 'Invalid reducer')
+        for param in reducers[name][1]:
+            value = bottle.request.query.get(param) # pylint: disable=no-member
+            if value is not None:
+                params[param] = value
+    return names, params
+
+def _get_result_key(model, scenarios, engine, reduce=None):
+    '''Get result cache key of each scenario, None if cache is disabled
+
+    Keys include the current version of model, so results of a model are
+    no longer used once it is imported again.
+    '''
+    if not results.enabled:
+        return [None] * len(scenarios)
+    models_id, version = _get_store().get_version(model)
+    return [request_key(model, models_id, version, engine, scenario, reduce)
+            for scenario in scenarios]
+
+def _get_profile(model):
+    '''Get profile of request if it's asked for, None otherwise'''
+    token = bottle.request.headers.get(profiling.header) # pylint: disable=no-member
+    if token is None:
+        return None
+    if not profiling.authorized(token):
+        raise bottle.HTTPError(403, 'Invalid profile token')
+    return profiling.RequestProfile(model)
+
+def _get_scenario(data_in):
+    '''Validate input data and return its scenario'''
+    try:
+        return ingest.load(data_in)
+    except IngestError as e:
+        raise bottle.HTTPError(400, str(e))
+
+def _get_pool():
+    '''Get process pool of this worker, creating it on first use
+
+    Pool processes are started by a fork server rather than forked from the
+    worker, so they don't inherit its threads, locks or database
+    connections. Neither do they share its memory tier of results, so
+    scenarios of batches are cached across processes by the disk tier only.
+    '''
+    global _pool # pylint: disable=global-statement
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=config.mulandweb_batch_workers,
+                                    mp_context=multiprocessing.get_context('forkserver'),
+                                    initializer=metrics.adopt, initargs=(os.getpid(),))
+    return _pool
@@ -0,0 +1,223 @@
+# coding: utf-8
+'''Provides ingestion of request locations into typed columns
+
+Input data is validated and converted into a Scenario in a single pass over
+its locations, and every later stage reads the Scenario's columns.
+'''
+
+import math
+import hashlib
+import json
+
+import numpy as np
+
+__all__ = ['IngestError', 'Scenario', 'load', 'from_locations', 'from_columns']
+
+# Unit types are bound as int4 and packed with locations into int64 keys
+_type_limit = 2 ** 31
+
+class IngestError(Exception):
+    '''Input data isn't a valid scenario'''
+    pass
+
+class Scenario:
+    '''Locations and units of a request as typed columns
+
+    lng and lat are float arrays of locations, unit_loc and unit_type are
+    integer arrays of the location index and type of each unit. Overrides
+    are sparse: names lists upper cased override names, and
+    location_overrides and unit_overrides are tuples (rows, name numbers,
+    values) of arrays, in the order overrides were given.
+    '''
+    __slots__ = ['lng', 'lat', 'unit_loc', 'unit_type', 'names',
+                 'location_overrides', 'unit_overrides']
+
+    def __init__(self, lng, lat, unit_loc, unit_type, names=(),
+                 location_overrides=None, unit_overrides=None):
+        # pylint: disable=too-many-arguments
+        self.lng = np.ascontiguousarray(lng, dtype=float)
+        self.lat = np.ascontiguousarray(lat, dtype=float)
+        self.unit_loc = np.ascontiguousarray(unit_loc, dtype=np.int64)
+        self.unit_type = np.ascontiguousarray(unit_type, dtype=np.int64)
+        self.names = list(names)
+        self.location_overrides = _overrides(location_overrides)
+        self.unit_overrides = _overrides(unit_overrides)
+
+    def __len__(self):
+        return self.lng.shape[0]
+
+    def __repr__(self):
+        return 'Scenario(locations=%d, units=%d, names=%r)' % (
+            len(self), self.unit_loc.shape[0], self.names)
+
+    def digest(self):
+        '''Return SHA-256 of columns, the same for equal scenarios'''
+        sha = hashlib.sha256(json.dumps(self.names).encode('utf-8'))
+        for column in ((self.lng, self.lat, self.unit_loc, self.unit_type) +
+                       self.location_overrides + self.unit_overrides):
+            sha.update(np.int64(column.shape[0]).tobytes())
+            sha.update(column.tobytes())
+        return sha.hexdigest()
+
+def load(data_in):
+    '''Validate input data object and ingest its location list'''
+    if not isinstance(data_in, dict):
+        raise IngestError('Input data isn\'t an object.')
+
+    if 'loc' not in data_in:
+        raise IngestError("'loc' is not present at input data.")
+
+    locations = data_in['loc']
+    if not isinstance(locations, list):
+        raise IngestError("'loc' isn't an array")
+
+    return from_locations(locations)
+
+def from_locations(locations):
+    '''Validate iterable of location dicts while ingesting them'''
+    # pylint: disable=too-many-branches,too-many-locals
+    lngs, lats, unit_loc, unit_type = [], [], [], []
+    numbers = {}
+    names = {}
+    location_overrides = ([], [], [])
+    unit_overrides = ([], [], [])
+
+    def add_overrides(overrides, row, entity, skip):
+        '''Append numeric items of entity, but skip, as overrides of row'''
+        for key, value in entity.items():
+            if key == skip or not isinstance(value, (int, float)):
+                continue
+            number = numbers.get(key)
+            if number is None:
+                number = numbers[key] = names.setdefault(key.upper(), len(names))
+            overrides[0].append(row)
+            overrides[1].append(number)
+            overrides[2].append(value)
+
+    for location_id, loc in enumerate(locations):
+        if not isinstance(loc, dict) or 'lnglat' not in loc:
+            raise IngestError("'lnglat' not in 'loc' items")
+
+        lnglat = loc['lnglat']
+        if not isinstance(lnglat, list) or len(lnglat) != 2:
+            raise IngestError("'lnglat' isn't array with 2 elements")
+
+        lng, lat = lnglat
+        if not _is_number(lng) or not _is_number(lat):
+            raise IngestError("lng or lat not a number")
+        if not _is_finite(lng) or not _is_finite(lat):
+            raise IngestError("'lng' or 'lat' not a finite number")
+        lngs.append(lng)
+        lats.append(lat)
+
+        if 'units' not in loc:
+            raise IngestError("'units' not in 'loc' items")
+        units = loc['units']
+        if not isinstance(units, list):
+            raise IngestError("'units' isn't an array")
+
+        for unit in units:
+            if not isinstance(unit, dict) or 'type' not in unit:
+                raise IngestError("'type' not in unit")
+            type_id = unit['type']
+            if not _is_number(type_id):
+                raise IngestError("'type' isn't a number")
+            if isinstance(type_id, float) and not type_id.is_integer():
+                raise IngestError("'type' isn't an integer")
+            type_id = int(type_id)
+            if not 0 <= type_id < _type_limit:
+                raise IngestError("'type' out of range")
+            if len(unit) > 1:
+                add_overrides(unit_overrides, len(unit_loc), unit, 'type')
+            unit_loc.append(location_id)
+            unit_type.append(type_id)
+
+        if len(loc) > 2:
+            # Keys other than lnglat and units, which is skipped as an array
+            add_overrides(location_overrides, location_id, loc, 'lnglat')
+
+    return Scenario(lngs, lats, unit_loc, unit_type, names,
+                    location_overrides, unit_overrides)
+
+def from_columns(columns: dict):
+    '''Validate and ingest dict of typed columns
+
+    Columns are lng, lat, unit_loc, unit_type and overrides named
+    loc.<NAME> or unit.<NAME>, whose NaN items aren't set. unit_loc and
+    unit_type must hold integers, or floats without fractional part, and
+    unit_type ones from 0 to 2**31 - 1.
+    '''
+    try:
+        lng = np.asarray(columns['lng'], dtype=float).reshape(-1)
+        lat = np.asarray(columns['lat'], dtype=float).reshape(-1)
+        unit_loc = _integer_column(columns.get('unit_loc', []), 'unit_loc')
+        unit_type = _integer_column(columns.get('unit_type', []), 'unit_type',
+                                    _type_limit)
+    except KeyError as e:
+        raise IngestError('Missing column %s' % e)
+    except (TypeError, ValueError) as e:
+        raise IngestError('Invalid column: %s' % e)
+    if lng.shape != lat.shape or unit_loc.shape != unit_type.shape:
+        raise IngestError('Columns have different lengths')
+    if not (np.isfinite(lng).all() and np.isfinite(lat).all()):
+        raise IngestError("'lng' or 'lat' not a finite number")
+    if unit_loc.shape[0] and (unit_loc.min() < 0 or unit_loc.max() >= lng.shape[0]):
+        raise IngestError("'unit_loc' out of range")
+
+    names = {}
+    overrides = {'loc': ([], [], []), 'unit': ([], [], [])}
+    lengths = {'loc': lng.shape[0], 'unit': unit_loc.shape[0]}
+    for name, column in columns.items():
+        target, _, attr = name.partition('.')
+        if not attr or target not in overrides:
+            continue
+        try:
+            column = np.asarray(column, dtype=float).reshape(-1)
+        except (TypeError, ValueError) as e:
+            raise IngestError('Invalid column: %s' % e)
+        if column.shape[0] != lengths[target]:
+            raise IngestError("'%s' has a wrong length" % name)
+        rows = np.nonzero(~np.isnan(column))[0]
+        number = names.setdefault(attr.upper(), len(names))
+        overrides[target][0].append(rows)
+        overrides[target][1].append(np.full(rows.shape[0], number, dtype=np.int64))
+        overrides[target][2].append(column[rows])
+
+    return Scenario(lng, lat, unit_loc, unit_type, names,
+                    [np.concatenate(part) if part else [] for part in overrides['loc']],
+                    [np.concatenate(part) if part else [] for part in overrides['unit']])
+
+def _integer_column(column, name, limit=None):
+    '''Convert column into an int64 array, if it holds integers only
+
+    If limit is given, integers must be from 0 up to limit, excluded.
+    '''
+    column = np.asarray(column).reshape(-1)
+    if not column.shape[0]:
+        return column.astype(np.int64)
+    if column.dtype.kind not in 'iu' and not (
+            column.dtype.kind == 'f' and np.isfinite(column).all() and
+            (np.trunc(column) == column).all()):
+        raise IngestError("'%s' isn't a column of integers" % name)
+    if limit is not None and (column.min() < 0 or column.max() >= limit):
+        raise IngestError("'%s' out of range" % name)
+    return column.astype(np.int64)
+
+def _is_number(value):
+    '''Whether value is a number, booleans aren't'''
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def _is_finite(value):
+    '''Whether number is finite, as floats of it are'''
+    try:
+        return math.isfinite(value)
+    except OverflowError:
+        return False
+
+def _overrides(overrides):
+    '''Convert sparse overrides into tuple of (rows, numbers, values) arrays'''
+    if overrides is None:
+        overrides = ([], [], [])
+    rows, numbers, values = overrides
+    return (np.asarray(rows, dtype=np.int64), np.asarray(numbers, dtype=np.int64),
+            np.asarray(values, dtype=float))
@@ -0,0 +1,146 @@
+# coding: utf-8
+'''Provides persistent queue of Mu-Land evaluations'''
+
+import json
+import time
+import uuid
+import multiprocessing
+
+from sqlalchemy import select, func, and_, or_
+
+from .muland import MulandRunError, output_records
+from .mulanddb import ModelNotFound
+from . import ingest
+from . import metrics
+from . import config
+from . import db
+
+__all__ = ['submit', 'get', 'work']
+
+# Running jobs not finished by then are assumed lost with their worker
+_lease = config.mulandweb_job_timeout + 60
+
+def submit(model: str, locations: list, engine: str):
+    '''Queue evaluation of locations and return its job id'''
+    job_id = uuid.uuid4().hex
+    with db.connect() as conn:
+        conn.execute(db.jobs.insert().values(
+            id=job_id, model=model, engine=engine, status='queued',
+            input=json.dumps(locations)))
+    return job_id
+
+def get(job_id: str):
+    '''Return job as a dict, None if not found
+
+    Output is present once the job is done and error once it failed.
+    '''
+    jobs = db.jobs
+    s = (select([jobs.c.id, jobs.c.model, jobs.c.engine, jobs.c.status,
+                 jobs.c.attempts, jobs.c.created, jobs.c.started,
+                 jobs.c.finished, jobs.c.output, jobs.c.error])
+        .where(jobs.c.id == job_id))
+    with db.connect() as conn:
+        row = conn.execute(s).fetchone()
+    if row is None:
+        return None
+
+    job = {key: row[key] for key in ['id', 'model', 'engine', 'status',
+                                     'attempts']}
+    for key in ['created', 'started', 'finished']:
+        job[key] = row[key].isoformat() if row[key] is not None else None
+    if row['output'] is not None:
+        job['output'] = json.loads(row['output'])
+    if row['error'] is not None:
+        job['error'] = row['error']
+    return job
+
+def work(workers: int = config.mulandweb_job_workers):
+    '''Run worker processes draining the queue until interrupted'''
+    processes = [multiprocessing.Process(target=_work_loop, daemon=True)
+                 for _ in range(workers)]
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.terminate()
+            process.join()
+    finally:
+        for process in processes:
+            if not process.is_alive():
+                metrics.retire(process.pid)
+
+def _work_loop():
+    '''Run queued jobs, one at a time'''
+    try:
+        while True:
+            job = _claim()
+            if job is None:
+                time.sleep(config.mulandweb_job_poll)
+                continue
+            _run(*job)
+    except KeyboardInterrupt:
+        pass
+
+def _claim():
+    '''Mark next queued job as running and return (id, model, engine,
+    locations, attempts), None if there is none
+
+    Jobs left running past their lease by a dead worker are claimed again.
+    '''
+    jobs = db.jobs
+    s = (select([jobs.c.id, jobs.c.model, jobs.c.engine, jobs.c.input,
+                 jobs.c.attempts])
+        .where(or_(jobs.c.status == 'queued',
+                   and_(jobs.c.status == 'running',
+                        jobs.c.started < func.now() -
+                                         func.make_interval(0, 0, 0, 0, 0, 0, _lease))))
+        .order_by(jobs.c.created)
+        .limit(1)
+        .with_for_update(skip_locked=True))
+
+    with db.connect() as conn:
+        with conn.begin():
+            row = conn.execute(s).fetchone()
+            if row is None:
+                return None
+            attempts = row['attempts'] + 1
+            if attempts > config.mulandweb_job_attempts:
+                _finish(conn, row['id'], 'failed', error='Too many attempts')
+                return None
+            conn.execute(jobs.update()
+                .where(jobs.c.id == row['id'])
+                .values(status='running', attempts=attempts,
+                        started=func.now()))
+    return (row['id'], row['model'], row['engine'], json.loads(row['input']),
+            attempts)
+
+def _run(job_id, model, engine, locations, attempts):
+    '''Evaluate job, storing its output or error'''
+    from .handlers import evaluate
+    try:
+        output_data = evaluate(model, ingest.from_locations(locations), engine,
+                               timeout=config.mulandweb_job_timeout)
+    except ModelNotFound:
+        status, output, error = 'failed', None, 'Model not found'
+    except MulandRunError as e:
+        status, output, error = 'failed', None, str(e)
+    except Exception as e: # pylint: disable=broad-except
+        # Unexpected errors, as lost database connections, are retried
+        retry = attempts < config.mulandweb_job_attempts
+        status, output, error = ('queued' if retry else 'failed'), None, repr(e)
+    else:
+        status, output, error = 'done', json.dumps(output_records(output_data)), None
+
+    with db.connect() as conn:
+        _finish(conn, job_id, status, output, error)
+
+def _finish(conn, job_id, status, output=None, error=None):
+    '''Store final state of job'''
+    jobs = db.jobs
+    conn.execute(jobs.update()
+        .where(jobs.c.id == job_id)
+        .values(status=status, output=output, error=error,
+                finished=func.now() if status != 'queued' else None))
@@ -0,0 +1,336 @@
+# coding: utf-8
+'''Provides Prometheus metrics of MulandWeb
+
+Every process keeps its own series and writes them to a file of its own
+under MULANDWEB_METRICS_PATH at the end of each request or evaluation.
+Series of every file there are summed when metrics are rendered, so they
+cover all gunicorn workers, batch pool processes and job workers sharing
+the path. Without a path, only the rendering process is covered.
+
+Files of processes which exited are merged by retire into retired.json, so
+totals are kept without files piling up. Servers started by python -m
+mulandweb -r do it from gunicorn's child_exit hook, and so should other
+gunicorn configurations, with mulandweb.__main__.child_exit.
+'''
+
+import os
+import json
+import time
+import uuid
+import fcntl
+import tempfile
+from pathlib import Path
+from threading import Lock
+
+from . import config
+
+__all__ = ['Counter', 'Histogram', 'MetricsMiddleware', 'flush', 'render',
+           'clear', 'retire', 'adopt']
+
+_retired = 'retired.json'
+
+_default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                    10.0, 30.0, 60.0)
+
+_lock = Lock()
+_metrics = []
+_values = {}
+_state = {'pid': None, 'file': None, 'dirty': False}
+
+class Counter:
+    '''Monotonic counter, by label values'''
+    kind = 'counter'
+
+    def __init__(self, name: str, documentation: str, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        _metrics.append(self)
+
+    def inc(self, amount: float = 1, **labels):
+        '''Increase counter of labels by amount'''
+        key = (self.name, tuple(str(labels[label]) for label in self.labels))
+        with _lock:
+            values = _process_values()
+            values[key] = values.get(key, 0) + amount
+            _state['dirty'] = True
+
+class Histogram:
+    '''Histogram of observed values, by label values'''
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labels=(),
+                 buckets=_default_buckets):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        _metrics.append(self)
+
+    def observe(self, value: float, **labels):
+        '''Add value to histogram of labels'''
+        key = (self.name, tuple(str(labels[label]) for label in self.labels))
+        with _lock:
+            values = _process_values()
+            counts = values.get(key)
+            if counts is None:
+                # Per bucket counts, then sum and count
+                counts = values[key] = [0] * (len(self.buckets) + 2)
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            counts[-2] += value
+            counts[-1] += 1
+            _state['dirty'] = True
+
+    def time(self, **labels):
+        '''Context manager observing seconds taken by its block'''
+        return _Timer(self, labels)
+
+    def time_iter(self, iterable, **labels):
+        '''Yield items of iterable, observing seconds taken producing them'''
+        iterator = iter(iterable)
+        seconds = 0.0
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                finally:
+                    seconds += time.perf_counter() - start
+                yield item
+        finally:
+            self.observe(seconds, **labels)
+
+class MetricsMiddleware:
+    '''WSGI middleware observing latency and size of responses
+
+    Responses are labelled by the rule of the route serving them and by the
+    model in their URL, if any.
+    '''
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        start = time.perf_counter()
+        response = {}
+        def metrics_start_response(status, headers, exc_info=None):
+            '''Record status of response'''
+            response['status'] = status.split(' ', 1)[0]
+            return start_response(status, headers, exc_info)
+
+        result = self.wsgi_app(environ, metrics_start_response)
+        return self._iter_result(environ, result, response, start)
+
+    @staticmethod
+    def _iter_result(environ, result, response, start):
+        '''Yield chunks of result, observing them once it's finished'''
+        size = 0
+        try:
+            for chunk in result:
+                size += len(chunk)
+                yield chunk
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+            route = environ.get('bottle.route')
+            labels = {'handler': route.rule if route is not None else '',
+                      'model': environ.get('route.url_args', {}).get('model', ''),
+                      'status': response.get('status', '')}
+            request_seconds.observe(time.perf_counter() - start, **labels)
+            response_bytes.inc(size, **labels)
+            flush()
+
+class _Timer:
+    '''Context manager observing seconds taken into a histogram'''
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+def flush(path: str = None):
+    '''Write series of this process to its file, if they changed'''
+    path = config.mulandweb_metrics_path if path is None else path
+    if not path:
+        return
+    with _lock:
+        values = _process_values()
+        if not _state['dirty']:
+            return
+        os.makedirs(path, exist_ok=True)
+        _write_series(path, _state['file'], values)
+        _state['dirty'] = False
+
+def clear(path: str = None):
+    '''Remove series files of every process, as when a server starts'''
+    path = config.mulandweb_metrics_path if path is None else path
+    if not path or not os.path.isdir(path):
+        return
+    for filename in os.listdir(path):
+        if filename.endswith('.json'):
+            os.unlink(str(Path(path, filename)))
+
+def retire(pid: int, path: str = None):
+    '''Merge series files of a process which exited into retired.json
+
+    Files of processes adopted by it, as its batch pool, are merged too.
+    '''
+    path = config.mulandweb_metrics_path if path is None else path
+    if not path or not os.path.isdir(path):
+        return
+    prefix = '%d-' % pid
+    with _files_lock(path, fcntl.LOCK_EX):
+        filenames = [filename for filename in os.listdir(path)
+                     if filename.startswith(prefix) and filename.endswith('.json')]
+        if not filenames:
+            return
+        totals = {}
+        for filename in [_retired] + filenames:
+            for key, value in _read_series(path, filename):
+                _add(totals, key, value)
+        _write_series(path, _retired, totals)
+        for filename in filenames:
+            os.unlink(str(Path(path, filename)))
+
+def adopt(owner: int):
+    '''Name series file of this process after owner, to be retired with it'''
+    with _lock:
+        _process_values()
+        _state['file'] = '%d-%d-%s.json' % (owner, os.getpid(), uuid.uuid4().hex[:8])
+
+def render(path: str = None):
+    '''Return series of all processes in Prometheus text format'''
+    path = config.mulandweb_metrics_path if path is None else path
+    flush(path)
+    totals = {}
+    if path and os.path.isdir(path):
+        # Files aren't read while they're being retired
+        with _files_lock(path, fcntl.LOCK_SH):
+            for filename in os.listdir(path):
+                if filename.endswith('.json'):
+                    for key, value in _read_series(path, filename):
+                        _add(totals, key, value)
+    else:
+        with _lock:
+            for key, value in _process_values().items():
+                _add(totals, key, value)
+
+    lines = []
+    for metric in _metrics:
+        lines.append('# HELP %s %s' % (metric.name, metric.documentation))
+        lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+        for (name, labels), value in sorted(totals.items()):
+            if name != metric.name:
+                continue
+            pairs = list(zip(metric.labels, labels))
+            if metric.kind == 'counter':
+                lines.append('%s%s %s' % (name, _labels(pairs), _number(value)))
+                continue
+            cumulative = 0
+            for bound, count in zip(metric.buckets, value):
+                cumulative += count
+                lines.append('%s_bucket%s %d' % (
+                    name, _labels(pairs + [('le', _number(bound))]), cumulative))
+            lines.append('%s_bucket%s %d' % (
+                name, _labels(pairs + [('le', '+Inf')]), value[-1]))
+            lines.append('%s_sum%s %s' % (name, _labels(pairs), _number(value[-2])))
+            lines.append('%s_count%s %d' % (name, _labels(pairs), value[-1]))
+    return '\n'.join(lines) + '\n'
+
+def _process_values():
+    '''Get series of this process, dropping those inherited by fork'''
+    pid = os.getpid()
+    if _state['pid'] != pid:
+        _values.clear()
+        _state['pid'] = pid
+        _state['file'] = '%d-%s.json' % (pid, uuid.uuid4().hex[:8])
+        _state['dirty'] = False
+    return _values
+
+def _files_lock(path, operation):
+    '''Get lock file of series files under path, locked by operation'''
+    lock = open(str(Path(path, 'retire.lock')), 'w')
+    try:
+        fcntl.flock(lock, operation)
+    except BaseException:
+        lock.close()
+        raise
+    return lock
+
+def _read_series(path, filename):
+    '''Read series of file as (key, value) pairs, none if it was removed'''
+    try:
+        with open(str(Path(path, filename))) as file:
+            series = json.load(file)
+    except (OSError, ValueError):
+        return []
+    return [((name, tuple(labels)), value) for name, labels, value in series]
+
+def _write_series(path, filename, values):
+    '''Write series into file atomically'''
+    fd, tmpname = tempfile.mkstemp(dir=path, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as file:
+            json.dump([[name, list(labels), value]
+                       for (name, labels), value in values.items()], file)
+        os.replace(tmpname, str(Path(path, filename)))
+    except BaseException:
+        os.unlink(tmpname)
+        raise
+
+def _add(totals, key, value):
+    '''Add value of series into totals'''
+    if isinstance(value, list):
+        total = totals.setdefault(key, [0] * len(value))
+        for index, item in enumerate(value):
+            total[index] += item
+    else:
+        totals[key] = totals.get(key, 0) + value
+
+def _labels(pairs):
+    '''Format label pairs'''
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (key, _escape(value))
+                             for key, value in pairs)
+
+def _escape(value):
+    '''Escape label value'''
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+def _number(value):
+    '''Format number as Prometheus does'''
+    return repr(float(value))
+
+request_seconds = Histogram('mulandweb_request_seconds',
+                            'Time taken serving requests', ['handler', 'model', 'status'])
+response_bytes = Counter('mulandweb_response_bytes_total',
+                         'Bytes of response bodies', ['handler', 'model', 'status'])
+query_seconds = Histogram('mulandweb_db_query_seconds',
+                          'Time taken by MulandDB queries', ['model', 'query'])
+populate_seconds = Histogram('mulandweb_populate_seconds',
+                             'Time taken populating Mu-Land working dirs')
+muland_seconds = Histogram('mulandweb_muland_seconds',
+                           'Time taken running Mu-Land', ['engine'])
+encode_seconds = Histogram('mulandweb_encode_seconds',
+                           'Time taken encoding responses', ['codec'])
+locations = Counter('mulandweb_locations_total',
+                    'Locations of evaluated requests', ['model'])
+units = Counter('mulandweb_units_total',
+                'Units of evaluated requests', ['model'])
+outside_locations = Counter('mulandweb_outside_locations_total',
+                            'Locations dropped as outside any zone', ['model'])
+muland_failures = Counter('mulandweb_muland_failures_total',
+                          'Failed Mu-Land runs', ['model', 'reason'])
+cache_requests = Counter('mulandweb_result_cache_requests_total',
+                         'Result cache lookups', ['model', 'result'])
@@ -1,12 +1,14 @@
 #!/usr/bin/env python3
 # coding: utf-8
 
-from collections import namedtuple
 from pathlib import Path
-import os, tempfile, subprocess
-import csv
+import os, tempfile, subprocess, shutil, resource
+import warnings
+
+import numpy as np
 
 from . import config
+from . import metrics
 
 class MulandException(Exception):
     pass
@@ -17,7 +19,45 @@ class DependencyError(MulandException):
 class MulandRunError(MulandException):
     pass
 
-MulandData = namedtuple('MulandData', ['header', 'records'])
+class MulandTimeoutError(MulandRunError):
+    pass
+
+class MulandData:
+    '''Table of Muland input backed by a float64 array
+
+    values is a contiguous records x columns array and columns maps upper
+    cased header names to column indexes. As the former namedtuple, it is
+    built from header and records, any sequence of rows, and unpacks into
+    (header, records).
+    '''
+    __slots__ = ['header', 'values', 'columns']
+
+    def __init__(self, header, records=(), values=None):
+        self.header = list(header)
+        if values is None:
+            values = records
+        self.values = np.ascontiguousarray(values, dtype=float).reshape(
+            -1, len(self.header))
+        self.columns = {key.upper(): index
+                        for index, key in enumerate(self.header)}
+
+    @property
+    def records(self):
+        '''Records as lists of floats'''
+        return self.values.tolist()
+
+    def __iter__(self):
+        return iter((self.header, self.records))
+
+    def __len__(self):
+        return self.values.shape[0]
+
+    def __repr__(self):
+        return 'MulandData(header=%r, values=%r)' % (self.header, self.values)
+
+def output_records(output_data):
+    '''Convert output data arrays into lists of records'''
+    return {key: value.tolist() for key, value in output_data.items()}
 
 class Muland:
     '''Access Muland Application'''
@@ -33,19 +73,38 @@ class Muland:
     output_files = ['bids', 'bh', 'location', 'location_probability',
     'rents']
 
+    # Inputs which don't depend on locations, staged once per static_key
+    static_files = ['agents', 'bids_functions', 'demand', 'rent_functions']
+
     csv_delimiter = ';'
 
+    # Rows of input formatted at once, bounding memory used to write them
+    write_chunk_rows = 10000
+
     # Check if muland binary and work folder are in place
     if not os.access(work_folder, os.R_OK & os.W_OK):
         if os.access(work_folder, os.F_OK):
             raise DependencyError('Could not access work folder.')
         os.mkdir(work_folder)
 
-    if not os.access(muland_binary, os.X_OK):
+    if config.muland_engine == 'binary' and not os.access(muland_binary, os.X_OK):
         raise DependencyError('Could not find muland binary.')
 
-    def __init__(self, **kwargs):
-        '''Initialize Muland'''
+    @classmethod
+    def available(cls):
+        '''Whether mu-land binary can be run'''
+        return os.access(cls.muland_binary, os.X_OK)
+
+    def __init__(self, static_key=None, **kwargs):
+        '''Initialize Muland
+
+        If static_key is given, static input files are written once for
+        that key and linked into the working dir of every later run with
+        the same key. Data of these files must then be the same for runs
+        sharing the key, as it is for runs of the same model version. Keys
+        are <model>-<version>, and staging a version removes the files
+        staged for other versions of its model.
+        '''
         input_files = self.input_files
 
         for file in input_files:
@@ -55,7 +114,9 @@ class Muland:
                 raise TypeError("argument '%s' must be of type MulandData" % file)
 
         # Set instance attributes
+        self.static_key = static_key
         self.output_data = {}
+        self.rusage = None
         self.input_data = {key: value for key, value in kwargs.items()
                                       if key in input_files}
 
@@ -73,20 +134,83 @@ class Muland:
         os.mkdir(str(Path(working_dir, 'input')))
         os.mkdir(str(Path(working_dir, 'output')))
 
-        # Create files sent by user
+        # Link staged files and create files sent by user
+        static_dir = self._get_static_dir()
         for key, value in self.input_data.items():
-            header = value.header
-            records = value.records
             filename = str(Path(working_dir, 'input', key + '.csv'))
-            with open(filename, 'w') as file:
-                writer = csv.writer(file, delimiter=self.csv_delimiter,
-                                    quoting=csv.QUOTE_NONNUMERIC)
-                writer.writerow(header)
-                for row in records:
-                    writer.writerow(row)
-
-    def _run_muland(self, working_dir, timeout=2):
-        '''Run Muland on working dir'''
+            if static_dir is not None and key in self.static_files:
+                try:
+                    os.link(str(Path(static_dir, key + '.csv')), filename)
+                    continue
+                except FileNotFoundError:
+                    # Removed meanwhile, as a newer version was staged
+                    pass
+            self._write_input(filename, value)
+
+    def _get_static_dir(self):
+        '''Get folder of staged static input files, staging them if needed'''
+        if self.static_key is None:
+            return None
+
+        static_dir = Path(self.work_folder, 'static', str(self.static_key))
+        if static_dir.exists():
+            return static_dir
+
+        # Stage into a temporary folder renamed into place, so concurrent
+        # runs never see it partially written
+        static_dir.parent.mkdir(exist_ok=True)
+        staging_dir = tempfile.mkdtemp(dir=str(static_dir.parent))
+        for key in self.static_files:
+            self._write_input(str(Path(staging_dir, key + '.csv')),
+                              self.input_data[key])
+        try:
+            os.rename(staging_dir, str(static_dir))
+        except OSError:
+            # Staged by another run meanwhile
+            shutil.rmtree(staging_dir)
+        else:
+            self._prune_static_dirs(static_dir)
+        return static_dir
+
+    @staticmethod
+    def _prune_static_dirs(static_dir):
+        '''Remove folders staged for other versions of the model of static_dir
+
+        Working dirs of runs keep the files they already linked.
+        '''
+        model, separator, _ = static_dir.name.rpartition('-')
+        if not separator:
+            return
+        for folder in static_dir.parent.iterdir():
+            if folder != static_dir and folder.name.rpartition('-')[0] == model:
+                shutil.rmtree(str(folder), ignore_errors=True)
+
+    def _write_input(self, filename, data):
+        '''Write input file read by Muland
+
+        Header is quoted and values are written in shortest round-trip form,
+        as csv.writer does with QUOTE_NONNUMERIC, but each block of
+        write_chunk_rows rows is formatted by a single operation.
+        '''
+        header = data.header
+        values = data.values
+        row_format = self.csv_delimiter.join(['%r'] * len(header)) + '\n'
+        with open(filename, 'w') as file:
+            file.write(self.csv_delimiter.join('"%s"' % key for key in header))
+            file.write('\n')
+            for start in range(0, values.shape[0], self.write_chunk_rows):
+                chunk = values[start:start + self.write_chunk_rows]
+                file.write((row_format * chunk.shape[0]) %
+                           tuple(chunk.ravel().tolist()))
+
+    def _run_muland(self, working_dir, timeout, rusage=False):
+        '''Run Muland on working dir
+
+        If rusage, resource usage of the process is kept at rusage. It's
+        measured over children of this process, so it includes others
+        finishing meanwhile, as in threaded servers.
+        '''
+        before = resource.getrusage(resource.RUSAGE_CHILDREN) if rusage else None
         with subprocess.Popen([self.muland_binary, working_dir],
                               stdout=subprocess.PIPE,
                               stderr=subprocess.PIPE) as process:
@@ -99,34 +223,52 @@ class Muland:
             except subprocess.TimeoutExpired:
                 process.kill()
                 stdout, stderr = process.communicate()
-                raise MulandRunError('Mu-Land proccess timeout.')
+                raise MulandTimeoutError('Mu-Land proccess timeout.')
+            except MulandRunError:
+                raise
             except:
                 process.kill()
                 process.wait()
                 raise MulandRunError('Unknown error running Mu-Land')
+        if before is not None:
+            self.rusage = _rusage_delta(before, resource.getrusage(resource.RUSAGE_CHILDREN))
 
     def _collect_data(self, working_dir):
-        '''Collects data generated by Muland'''
+        '''Collects data generated by Muland into float arrays of records'''
         for name in self.output_files:
-            output_data = []
             fullname = str(Path(working_dir, 'output', name + '.csv'))
-            with open(fullname) as file:
-                next(file)
-                reader = csv.reader(file, delimiter=self.csv_delimiter,
-                                    quoting=csv.QUOTE_NONNUMERIC)
-                for row in reader:
-                    output_data.append(tuple(row))
-            self.output_data[name] = output_data
-
-    def run(self):
-        '''Runs Muland'''
+            with warnings.catch_warnings():
+                # Outputs without records are just empty arrays
+                warnings.simplefilter('ignore', UserWarning)
+                self.output_data[name] = np.loadtxt(
+                    fullname, dtype=float, delimiter=self.csv_delimiter,
+                    skiprows=1, ndmin=2)
+
+    def run(self, timeout=config.muland_timeout, rusage=False):
+        '''Runs Muland, killing it after timeout seconds
+
+        If rusage, resource usage of Mu-Land's process is kept at rusage.
+        '''
         # Create/destroy data directory
         with tempfile.TemporaryDirectory(dir = self.work_folder) as working_dir:
             # Prepare directory
-            self._populate_working_dir(working_dir)
+            with metrics.populate_seconds.time():
+                self._populate_working_dir(working_dir)
 
             # Run Muland
-            self._run_muland(working_dir)
+            with metrics.muland_seconds.time(engine='binary'):
+                self._run_muland(working_dir, timeout, rusage)
 
             # Collect data
             self._collect_data(working_dir)
+
+def _rusage_delta(before, after):
+    '''Get resource usage between two getrusage results as a dict
+
+    ru_maxrss is the largest of any child, in kilobytes, not a difference.
+    '''
+    ret = {'maxrss': after.ru_maxrss}
+    for field in ['utime', 'stime', 'minflt', 'majflt', 'inblock', 'oublock',
+                  'nvcsw', 'nivcsw']:
+        ret[field] = getattr(after, 'ru_' + field) - getattr(before, 'ru_' + field)
+    return ret
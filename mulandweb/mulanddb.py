@@ -2,18 +2,33 @@
 # pylint: disable=invalid-name,bad-continuation,line-too-long
 '''Implements MulandWeb\'s database access interfaces'''
 
+import os
 import csv
-from itertools import zip_longest
+import hashlib
+import warnings
+from io import StringIO
+from itertools import zip_longest, chain
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
+import numpy as np
 import shapefile
-from sqlalchemy import select, func, and_, text
+from sqlalchemy import select, func, and_, text, bindparam, literal, literal_column
+from sqlalchemy.dialects import postgresql
 from shapely.geometry import Polygon
 
 from .muland import MulandData
+from .ingest import Scenario
+from .snapshot import ModelSnapshot, snapshots
+from .zoneindex import ZoneIndex, zone_indexes
+from . import config
 from . import db
 
 
-__all__ = ['MulandDB', 'MulandDBException', 'ModelNotFound', 'ModelImporter']
+__all__ = ['MulandDB', 'MulandDBException', 'ModelNotFound', 'ModelImporter',
+           'Overrides', 'get_model_version']
+
+# (models_id, version) of zone indexes found over budget, by model name
+_oversized_indexes = {}
 
 class MulandDBException(Exception):
     '''Base Exception class for MulandDB'''
@@ -22,133 +37,248 @@ class ModelNotFound(MulandDBException):
     '''Model was not found at the database'''
     pass
 
+def get_model_version(model: str):
+    '''Return tuple (models_id, version) of current version of model'''
+    s = (select([db.models.c.id, db.models.c.version])
+        .where(db.models.c.name == model))
+    with db.connect() as conn:
+        row = conn.execute(s).fetchone()
+    if row is None:
+        raise ModelNotFound
+    return row[0], row[1]
+
+def _fetch_values(result, expand=False):
+    '''Read rows of result into a flat float64 array, closing result
+
+    If expand, the last column of each row is an array whose items follow
+    the other columns of the row.
+    '''
+    if expand:
+        rows = (chain(row[:-1], row[-1]) for row in result)
+    else:
+        rows = result
+    values = np.fromiter(chain.from_iterable(rows), dtype=float)
+    result.close()
+    return values
+
+class PreparedQuery:
+    '''Select statement executed as a server-side prepared statement
+
+    The statement is prepared once per database connection and then run with
+    EXECUTE, so its text is the same for every request and PostgreSQL can
+    reuse its plan. Sets of keys are bound as arrays and unnested by the
+    statement itself.
+    '''
+    def __init__(self, name: str, statement, params: list):
+        '''Initialize prepared query
+
+        params is a list of tuples (bind name, PostgreSQL type) of every
+        bind parameter used at statement.
+        '''
+        sql = str(statement.compile(dialect=postgresql.dialect()))
+        for index, (param, _) in enumerate(params, 1):
+            sql = sql.replace('%%(%s)s' % param, '$%d' % index)
+        self.name = 'muland_' + name
+        self.prepare_sql = 'PREPARE %s (%s) AS %s' % (
+            self.name, ', '.join(pgtype for _, pgtype in params), sql)
+        self.execute_sql = 'EXECUTE %s (%s)' % (
+            self.name, ', '.join('%%(%s)s' % param for param, _ in params))
+
+    def execute(self, conn, **values):
+        '''Execute query at connection, preparing it if needed'''
+        prepared = conn.info.setdefault('muland_prepared', set())
+        if self.name not in prepared:
+            conn.execute(self.prepare_sql).close()
+            prepared.add(self.name)
+        return conn.execute(self.execute_sql, values)
+
+class Overrides:
+    '''Overrides of a scenario, applied to tables of Muland data'''
+    # pylint: disable=too-few-public-methods
+    def __init__(self, scenario: Scenario):
+        '''Resolve overrides of locations and units into arrays
+
+        Values of every location and unit are laid out as rows of a matrix,
+        by override name number, with a mask of the overrides they set. Unit
+        rows start from the overrides of their location, which the unit's
+        own ones replace. Names of ids and indexes are never overridden.
+        '''
+        names = scenario.names
+        allowed = np.array([not (name.endswith('_IDX') or name.startswith('ID'))
+                            for name in names], dtype=bool)
+
+        shape = (len(scenario), len(names))
+        self._location_values = np.zeros(shape)
+        self._location_mask = np.zeros(shape, dtype=bool)
+        rows, numbers, values = scenario.location_overrides
+        keep = allowed[numbers]
+        self._location_values[rows[keep], numbers[keep]] = values[keep]
+        self._location_mask[rows[keep], numbers[keep]] = True
+
+        self._unit_values = self._location_values[scenario.unit_loc]
+        self._unit_mask = self._location_mask[scenario.unit_loc]
+        rows, numbers, values = scenario.unit_overrides
+        keep = allowed[numbers]
+        self._unit_values[rows[keep], numbers[keep]] = values[keep]
+        self._unit_mask[rows[keep], numbers[keep]] = True
+
+        # Units are found by (I_IDX, V_IDX), first unit of a key wins
+        unit_keys = ((scenario.unit_loc + 1) << 32) | scenario.unit_type
+        self._unit_keys, self._unit_rows = np.unique(unit_keys,
+                                                     return_index=True)
+        self._override_names = names
+
+    def apply(self, data: MulandData):
+        '''Override data in place with values provided by user
+
+        Rows of tables with V_IDX take overrides of the unit with their
+        I_IDX and V_IDX, rows of other tables with I_IDX take overrides of
+        their location. Tables without either are left as they are.
+        '''
+        columns = data.columns
+        values = data.values
+        if 'V_IDX' in columns:
+            if not self._unit_keys.shape[0]:
+                return
+            keys = ((values[:, columns['I_IDX']].astype(np.int64) << 32) |
+                    values[:, columns['V_IDX']].astype(np.int64))
+            pos = np.searchsorted(self._unit_keys, keys).clip(
+                max=self._unit_keys.shape[0] - 1)
+            rows = np.nonzero(self._unit_keys[pos] == keys)[0]
+            entities = self._unit_rows[pos[rows]]
+            override_values, override_mask = self._unit_values, self._unit_mask
+        elif 'I_IDX' in columns:
+            entities = values[:, columns['I_IDX']].astype(np.int64) - 1
+            rows = np.nonzero((entities >= 0) &
+                              (entities < len(self._location_values)))[0]
+            entities = entities[rows]
+            override_values, override_mask = (self._location_values,
+                                              self._location_mask)
+        else:
+            return
+
+        names = [number for number, name in enumerate(self._override_names)
+                 if name in columns]
+        if not names or not rows.shape[0]:
+            return
+        targets = np.array([columns[self._override_names[number]]
+                            for number in names], dtype=np.int64)
+        names = np.array(names, dtype=np.int64)
+
+        # Single scatter of every override set on the table
+        row, col = np.nonzero(override_mask[entities][:, names])
+        values[rows[row], targets[col]] = override_values[entities[row], names[col]]
+
 class MulandDB:
-    '''Provides data retrival from Muland Database'''
+    '''Provides data retrival from Muland Database
+
+    Holds a leased database connection until closed, so use it as a context
+    manager. Statistics of the queries run are kept at query_stats, and
+    the number of locations left out of every zone at outside_locations.
+
+    Other model stores subclass it, overriding _open, close, get_version
+    and the _get_* methods reading tables.
+    '''
     # pylint: disable=too-few-public-methods
-    def __init__(self, model: str, locations: list):
+    get_version = staticmethod(get_model_version)
+
+    def __init__(self, model: str, scenario: Scenario):
         '''Initialize class'''
         assert isinstance(model, str)
 
-        self.conn = db.engine.connect()
-
-        s = select([db.models.c.id]).where(db.models.c.name == model)
-        result = self.conn.execute(s)
-        row = result.fetchone()
-        result.close()
-        if result is None:
+        self.model = model
+        self.models_id, self.version = self._open(model)
+        self.scenario = scenario
+        self.locations_params = None
+        self.units_params = None
+        self.outside_locations = 0
+        self.overrides = Overrides(scenario)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _open(self, model):
+        '''Lease a connection and return (models_id, version) of model'''
+        self.conn = db.connect()
+        self.query_stats = self.conn.info['query_stats']
+
+        s = (select([db.models.c.id, db.models.c.version])
+            .where(db.models.c.name == model))
+        try:
+            result = self.conn.execute(s)
+            row = result.fetchone()
+            result.close()
+        except:
+            self.conn.close()
+            raise
+        if row is None:
+            self.conn.close()
             raise ModelNotFound
+        return row[0], row[1]
 
-        _units = []
-        _locations = []
-        for loc in locations:
-            assert isinstance(loc['lnglat'][0], (int, float))
-            assert isinstance(loc['lnglat'][1], (int, float))
-
-            loc_overrides = {key: value for key, value in loc.items()
-                             if key not in ['lnglat', 'units']}
-            _location = {'location_id': len(_locations),
-                         'lng': loc['lnglat'][0],
-                         'lat': loc['lnglat'][1],
-                         'overrides': loc_overrides}
-            _locations.append(_location)
-
-            for unit in loc['units']:
-                unit_overrides = {key: value for key, value in unit.items()
-                                  if key not in ['type']}
-                _unit = {'unit_id': len(_units),
-                         'location': _location,
-                         'types_id': unit['type'],
-                         'overrides': unit_overrides}
-                _units.append(_unit)
-
-        self.models_id = row[0]
-        self.units = _units
-        self.locations = _locations
+    def close(self):
+        '''Return database connection to the pool'''
+        self.conn.close()
 
     def _apply_overrides(self, data):
         '''Override data from db with values provided by user'''
-        header = data.header
-        if 'I_IDX' not in header and 'V_IDX' not in header:
-            return
-
-        records = data.records
-        header_idx = {key.upper(): index
-                      for key, index in zip(header, range(len(header)))}
-
-        # if there is no type, iterate over zones
-        if 'V_IDX' not in header:
-            for record, loc in zip(records, self.locations):
-                for key, value in loc['overrides'].items():
-                    if not isinstance(value, (int, float)):
-                        continue
-                    key = key.upper()
-                    if key[:-3] == '_IDX' or key[:2] == 'ID':
-                        continue
-                    try:
-                        record[header_idx[key]] = value
-                    except KeyError:
-                        continue
-            return
-
-        # otherwise, operate over units
-        for record, unit in zip(records, self.units):
-            overrides = unit['location']['overrides']
-            overrides.update(unit['overrides'])
-            for key, value in overrides.items():
-                if not isinstance(value, (int, float)):
-                    continue
-                key = key.upper()
-                if key[:-3] == '_IDX' or key[:2] == 'ID':
-                    continue
-                try:
-                    idx = header_idx[key]
-                except KeyError:
-                    continue
-                record[idx] = value
+        self.overrides.apply(data)
 
     def get(self):
         '''Get data for Muland'''
         data = {}
-        headers = self._get_headers()
+        snapshot = self._get_snapshot()
+        headers = snapshot.headers
 
         # zones
-        zone_map, zones_records = self._get_zones()
+        location_ids, zones_ids, zones_values = self._get_zones()
         data['zones'] = MulandData(header=['I_IDX'] + headers['zones_header'],
-                                   records=zones_records)
+                                   values=zones_values)
         self._apply_overrides(data['zones'])
 
-        locations = self.locations
-        for location_id, zones_id in zone_map:
-            locations[location_id]['zones_id'] = zones_id
-        del locations
-
-        # Remove locations not contained by any zones
-        outsider_locids = {location['location_id']
-                           for location in self.locations
-                           if 'zones_id' not in location}
-        self.locations = [loc for loc in self.locations
-                          if loc['location_id'] not in outsider_locids]
-        self.units = [unit for unit in self.units
-                      if unit['location']['location_id'] not in outsider_locids]
+        # Leave out locations not contained by any zones
+        scenario = self.scenario
+        location_zones = np.zeros(len(scenario), dtype=np.int64)
+        located = np.zeros(len(scenario), dtype=bool)
+        location_zones[location_ids] = zones_ids
+        located[location_ids] = True
+        location_ids = np.nonzero(located)[0]
+        self.outside_locations = len(scenario) - location_ids.shape[0]
+        self.locations_params = {
+            'models_id': self.models_id,
+            'ids': (location_ids + 1).tolist(),
+            'zones_ids': location_zones[location_ids].tolist(),
+        }
+        units = np.nonzero(located[scenario.unit_loc])[0]
+        unit_loc = scenario.unit_loc[units]
+        self.units_params = {
+            'models_id': self.models_id,
+            'lids': (unit_loc + 1).tolist(),
+            'zones_ids': location_zones[unit_loc].tolist(),
+            'types_ids': scenario.unit_type[units].tolist(),
+        }
 
         # agents
         data['agents'] = MulandData(
             header=['IDAGENT', 'IDMARKET', 'IDAGGRA', 'UPPERBB'] + headers['agents_header'],
-            records=self._get_agents_records()
+            values=snapshot.values('agents')
         )
         self._apply_overrides(data['agents'])
 
         # agents_zones
         data['agents_zones'] = MulandData(
             header=['H_IDX', 'I_IDX', 'ACC', 'P_LN_ATT'] + headers['agents_zones_header'],
-            records=self._get_agents_zones_records()
+            values=self._get_agents_zones_records()
         )
         self._apply_overrides(data['agents_zones'])
 
         # bids_adjustments
         data['bids_adjustments'] = MulandData(
             header=['H_IDX', 'V_IDX', 'I_IDX', 'BIDADJ'],
-            records=self._get_bids_adjustments_records()
+            values=self._get_bids_adjustments_records()
         )
         self._apply_overrides(data['bids_adjustments'])
 
@@ -157,35 +287,35 @@ class MulandDB:
             header=['IDMARKET', 'IDAGGRA', 'IDATTRIB', 'LINEAPAR', 'CAGENT_X',
                     'CREST_X', 'CACC_X', 'CZONES_X', 'EXPPAR_X', 'CAGENT_Y',
                     'CREST_Y', 'CACC_Y', 'CZONES_Y', 'EXPPAR_Y'],
-            records=self._get_bids_functions_records()
+            values=snapshot.values('bids_functions')
         )
         self._apply_overrides(data['bids_functions'])
 
         # demand
         data['demand'] = MulandData(
             header=['H_IDX', 'DEMAND'],
-            records=self._get_demand_records()
+            values=snapshot.values('demand')
         )
         self._apply_overrides(data['demand'])
 
         # demand_exogenous_cutoff
         data['demand_exogenous_cutoff'] = MulandData(
             header=['H_IDX', 'V_IDX', 'I_IDX', 'DCUTOFF'],
-            records=self._get_demand_exogenous_cutoff_records()
+            values=self._get_demand_exogenous_cutoff_records()
         )
         self._apply_overrides(data['demand_exogenous_cutoff'])
 
         # real_estates_zones
         data['real_estates_zones'] = MulandData(
             header=['V_IDX', 'I_IDX', 'M_IDX'] + headers['real_estates_zones_header'],
-            records=self._get_real_estates_zones()
+            values=self._get_real_estates_zones()
         )
         self._apply_overrides(data['real_estates_zones'])
 
         # rent_adjustments
         data['rent_adjustments'] = MulandData(
             header=['V_IDX', 'I_IDX', 'RENTADJ'],
-            records=self._get_rent_adjustments()
+            values=self._get_rent_adjustments()
         )
         self._apply_overrides(data['rent_adjustments'])
 
@@ -193,26 +323,46 @@ class MulandDB:
         data['rent_functions'] = MulandData(
             header=['IDMARKET', 'IDATTRIB', 'SCALEPAR', 'LINEAPAR', 'CREST_X',
                     'CZONES_X', 'EXPPAR_X', 'CREST_Y', 'CZONES_Y', 'EXPPAR_Y'],
-            records=self._get_rent_functions()
+            values=snapshot.values('rent_functions')
         )
         self._apply_overrides(data['rent_functions'])
 
         # subsidies
         data['subsidies'] = MulandData(
             header=['H_IDX', 'V_IDX', 'I_IDX', 'SUBSIDIES'],
-            records=self._get_subsidies()
+            values=self._get_subsidies()
         )
         self._apply_overrides(data['subsidies'])
 
         # supply
         data['supply'] = MulandData(
             header=['V_IDX', 'I_IDX', 'NREST'],
-            records=self._get_supply()
+            values=self._get_supply()
         )
         self._apply_overrides(data['supply'])
 
+        # agents, bids_functions, demand and rent_functions are the same for
+        # every request to this model version
+        data['static_key'] = '%d-%d' % (self.models_id, self.version)
+
         return data
 
+    def _get_snapshot(self):
+        '''Get location independent tables from cache or database'''
+        snapshot = snapshots.get(self.model, self.models_id, self.version)
+        if snapshot is not None:
+            return snapshot
+
+        snapshot = ModelSnapshot(self.models_id, self.version,
+                                 self._get_headers(), {
+            'agents': self._get_agents_records(),
+            'bids_functions': self._get_bids_functions_records(),
+            'demand': self._get_demand_records(),
+            'rent_functions': self._get_rent_functions(),
+        })
+        snapshots.put(self.model, snapshot)
+        return snapshot
+
     def _get_headers(self):
         '''Get CSV header records'''
         db_models = db.models
@@ -234,40 +384,74 @@ class MulandDB:
     # zones
     #"I_IDX";"INDAREA";"COMAREA";"SERVAREA";"TOTAREA";"TOTBUILT";"INCOMEHH";"DIST_ACC"
     #1.00;2.7441056;0.4679935;3.2301371;8968.0590000;10.9089400;0.00;2.8959340
+    _zones_query = PreparedQuery('zones',
+        select([text('locs.id'),
+                db.zones.c.id,
+                db.zones.c.data])
+        .select_from(db.zones
+            .join(text('unnest(:ids, :lngs, :lats) AS locs (id, lng, lat)'),
+                  func.ST_Contains(db.zones.c.area,
+                      func.ST_Transform(
+                          func.ST_SetSRID(
+                              func.ST_Point(text('locs.lng'), text('locs.lat')),
+                              literal_column('4326')),
+                          literal_column('900913')))))
+        .where(db.zones.c.models_id == bindparam('models_id'))
+        .order_by(text('locs.id')),
+        [('models_id', 'integer'), ('ids', 'integer[]'),
+         ('lngs', 'float8[]'), ('lats', 'float8[]')])
+
     def _get_zones(self):
-        '''Get zones records
+        '''Get zones values
 
-        Returns tuple (zone_map, records). The zone_map field carries a
-        list of tuples (point_id, zone_id). The records field carries a list
-        of records for the zones file.
+        Returns tuple (location_ids, zones_ids, values). The first two are
+        integer arrays of each location index and the id of a zone
+        containing it. The values field carries a flat array of values of
+        the zones file.
         '''
-        db_zones = db.zones
-
-        values = ', '.join(
-            ['(%s, ST_Transform(ST_SetSRID(ST_Point(%s, %s), 4326), 900913))' %
-             (loc['location_id'], loc['lng'], loc['lat'])
-             for loc in self.locations])
-
-        s = (select([text('locs.id'),
-                     db_zones.c.id,
-                     db_zones.c.data])
-            .select_from(db_zones
-                .join(text('(VALUES %s) AS locs (id, geom) ' % values),
-                      func.ST_Contains(db_zones.c.area, text('locs.geom'))))
-            .where(db_zones.c.models_id == self.models_id)
-            .order_by(text('locs.id')))
-
-        result = self.conn.execute(s)
-        zone_map = []
-        records = []
-        for row in result:
-            data = [row[0] + 1]
-            data.extend(row[2])
-            records.append(data)
-            zone_map.append([row[0], row[1]])
+        scenario = self.scenario
+        if not len(scenario):
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), []
+
+        index = self._get_zone_index() if config.mulandweb_zone_index else None
+        if index is not None:
+            return index.lookup(np.arange(len(scenario)), scenario.lng, scenario.lat)
+
+        result = self._zones_query.execute(self.conn,
+            models_id=self.models_id,
+            ids=list(range(len(scenario))),
+            lngs=scenario.lng.tolist(),
+            lats=scenario.lat.tolist())
+        rows = result.fetchall()
         result.close()
+        location_ids = np.fromiter((row[0] for row in rows), dtype=np.int64,
+                                   count=len(rows))
+        zones_ids = np.fromiter((row[1] for row in rows), dtype=np.int64,
+                                count=len(rows))
+        values = np.fromiter(chain.from_iterable(chain((row[0] + 1,), row[2])
+                                                 for row in rows), dtype=float)
 
-        return zone_map, records
+        return location_ids, zones_ids, values
+
+    def _get_zone_index(self):
+        '''Get zone index of model from cache or database
+
+        Returns None if the index of this version of model is larger than
+        MULANDWEB_ZONE_INDEX_MAX, so that zones are queried instead.
+        '''
+        if _oversized_indexes.get(self.model) == (self.models_id, self.version):
+            return None
+        index = zone_indexes.get(self.model, self.models_id, self.version)
+        if index is None:
+            index = ZoneIndex.load(self.conn, self.models_id, self.version)
+            if index.nbytes > zone_indexes.max_bytes:
+                _oversized_indexes[self.model] = (self.models_id, self.version)
+                warnings.warn('Zone index of %s takes %d bytes, over '
+                              'MULANDWEB_ZONE_INDEX_MAX, zones will be queried '
+                              'from the database' % (self.model, index.nbytes))
+            else:
+                zone_indexes.put(self.model, index)
+        return index
 
     # agents
     #"IDAGENT";"IDMARKET";"IDAGGRA";"UPPERBB";"HHINC";"RHO";"FNIP";"ONES"
@@ -284,80 +468,55 @@ class MulandDB:
             .where(db_agents.c.models_id == self.models_id))
 
         result = self.conn.execute(s)
-        records = []
-        for row in db.engine.execute(s):
-            data = list(row[0:4])
-            data.extend(row[4])
-            records.append(data)
-        result.close()
-
-        return records
+        return _fetch_values(result, expand=True)
 
     # agents_zones
     #"H_IDX";"I_IDX";"ACC";"P_LN_ATT"
     #1.00;1.00;0.7308194;0.0000000
+    _agents_zones_query = PreparedQuery('agents_zones',
+        select([db.agents_zones.c.agents_id,
+                text('locs.id'),
+                db.agents_zones.c.acc,
+                db.agents_zones.c.att,
+                db.agents_zones.c.data])
+        .select_from(db.agents_zones
+            .join(text('unnest(:ids, :zones_ids) AS locs (id, zones_id)'),
+                  db.agents_zones.c.zones_id == text('locs.zones_id')))
+        .where(db.agents_zones.c.models_id == bindparam('models_id')),
+        [('models_id', 'integer'), ('ids', 'integer[]'),
+         ('zones_ids', 'integer[]')])
+
     def _get_agents_zones_records(self):
         '''Get agents records'''
-        db_azones = db.agents_zones
-
-        values = ', '.join(['(%s, %s)' %
-                            (location['location_id'] + 1, location['zones_id'])
-                            for location in self.locations])
-
-        if not values:
+        if not self.locations_params['ids']:
             return []
 
-        s = (select([db_azones.c.agents_id,
-                     text('locs.id'),
-                     db_azones.c.acc,
-                     db_azones.c.att,
-                     db_azones.c.data])
-            .select_from(db_azones
-                .join(text('(VALUES %s) AS locs (id, zones_id) ' % values),
-                      db_azones.c.zones_id == text('locs.zones_id')))
-            .where(db_azones.c.models_id == self.models_id))
-
-        result = self.conn.execute(s)
-        records = []
-        for row in db.engine.execute(s):
-            data = list(row[0:4])
-            data.extend(row[4])
-            records.append(data)
-        result.close()
-
-        return records
+        result = self._agents_zones_query.execute(self.conn, **self.locations_params)
+        return _fetch_values(result, expand=True)
 
     # bids_adjustments
     #"H_IDX";"V_IDX";"I_IDX";"BIDADJ"
     #1.00;1.00;1.00;0.0000000000
+    _bids_adjustments_query = PreparedQuery('bids_adjustments',
+        select([db.bids_adjustments.c.agents_id,
+                db.bids_adjustments.c.types_id,
+                text('units.lid'),
+                db.bids_adjustments.c.bidadj])
+        .select_from(db.bids_adjustments
+            .join(text('unnest(:lids, :zones_ids, :types_ids) AS units (lid, zones_id, types_id)'),
+                  and_(db.bids_adjustments.c.zones_id == text('units.zones_id'),
+                       db.bids_adjustments.c.types_id == text('units.types_id'))))
+        .where(db.bids_adjustments.c.models_id == bindparam('models_id')),
+        [('models_id', 'integer'), ('lids', 'integer[]'),
+         ('zones_ids', 'integer[]'), ('types_ids', 'integer[]')])
+
     def _get_bids_adjustments_records(self):
         '''Get bids_adjustments records'''
-        db_badj = db.bids_adjustments
-
-        values = ', '.join(['(%s, %s, %s)' %
-                            (unit['location']['location_id'] + 1,
-                             unit['location']['zones_id'],
-                             unit['types_id'])
-                            for unit in self.units])
-
-        if not values:
+        if not self.units_params['lids']:
             return []
 
-        s = (select([db_badj.c.agents_id,
-                     db_badj.c.types_id,
-                     text('units.lid'),
-                     db_badj.c.bidadj])
-            .select_from(db_badj
-                .join(text('(VALUES %s) AS units (lid, zones_id, types_id) ' % values),
-                      and_(db_badj.c.zones_id == text('units.zones_id'),
-                           db_badj.c.types_id == text('units.types_id'))))
-            .where(db_badj.c.models_id == self.models_id))
-
-        result = self.conn.execute(s)
-        records = [list(row) for row in result]
-        result.close()
-
-        return records
+        result = self._bids_adjustments_query.execute(self.conn, **self.units_params)
+        return _fetch_values(result)
 
     # bids_functions
     #"IDMARKET";"IDAGGRA";"IDATTRIB";"LINEAPAR";"CAGENT_X";"CREST_X";"CACC_X";"CZONES_X";"EXPPAR_X";"CAGENT_Y";"CREST_Y";"CACC_Y";"CZONES_Y";"EXPPAR_Y"
@@ -383,10 +542,7 @@ class MulandDB:
             .where(db_bfunc.c.models_id == self.models_id))
 
         result = self.conn.execute(s)
-        records = [list(row) for row in result]
-        result.close()
-
-        return records
+        return _fetch_values(result)
 
     # demand
     #"H_IDX";"DEMAND"
@@ -400,109 +556,78 @@ class MulandDB:
             .where(db_demand.c.models_id == self.models_id))
 
         result = self.conn.execute(s)
-        records = [list(row) for row in result]
-        result.close()
-
-        return records
+        return _fetch_values(result)
 
     # demand_exogenous_cutoff
     #"H_IDX";"V_IDX";"I_IDX";"DCUTOFF"
     #1.00;1.00;1.00;1.00
+    _demand_exogenous_cutoff_query = PreparedQuery('demand_exogenous_cutoff',
+        select([db.demand_exogenous_cutoff.c.agents_id,
+                db.demand_exogenous_cutoff.c.types_id,
+                text('units.lid'),
+                db.demand_exogenous_cutoff.c.dcutoff])
+        .select_from(db.demand_exogenous_cutoff
+            .join(text('unnest(:lids, :zones_ids, :types_ids) AS units (lid, zones_id, types_id)'),
+                  and_(db.demand_exogenous_cutoff.c.zones_id == text('units.zones_id'),
+                       db.demand_exogenous_cutoff.c.types_id == text('units.types_id'))))
+        .where(db.demand_exogenous_cutoff.c.models_id == bindparam('models_id')),
+        [('models_id', 'integer'), ('lids', 'integer[]'),
+         ('zones_ids', 'integer[]'), ('types_ids', 'integer[]')])
+
     def _get_demand_exogenous_cutoff_records(self):
         '''Get demand_exogenous_cutoff records'''
-        db_decutoff = db.demand_exogenous_cutoff
-
-        values = ', '.join(['(%s, %s, %s)' %
-                            (unit['location']['location_id'] + 1,
-                             unit['location']['zones_id'],
-                             unit['types_id'])
-                            for unit in self.units])
-
-        if not values:
+        if not self.units_params['lids']:
             return []
 
-        s = (select([db_decutoff.c.agents_id,
-                     db_decutoff.c.types_id,
-                     text('units.lid'),
-                     db_decutoff.c.dcutoff])
-            .select_from(db_decutoff
-                .join(text('(VALUES %s) AS units (lid, zones_id, types_id) ' % values),
-                      and_(db_decutoff.c.zones_id == text('units.zones_id'),
-                           db_decutoff.c.types_id == text('units.types_id'))))
-            .where(db_decutoff.c.models_id == self.models_id))
-
-        result = self.conn.execute(s)
-        records = [list(row) for row in result]
-        result.close()
-
-        return records
+        result = self._demand_exogenous_cutoff_query.execute(self.conn, **self.units_params)
+        return _fetch_values(result)
 
     # real_estates_zones
     #"V_IDX";"I_IDX";"M_IDX";"LOTSIZE";"BUILT";"IS_HOUSE";"IS_APT"
     #1.00;1.00;1.00;3.4800000;0.027670;1.00;0.00
+    _real_estates_zones_query = PreparedQuery('real_estates_zones',
+        select([db.real_estates_zones.c.types_id,
+                text('units.lid'),
+                db.real_estates_zones.c.markets_id,
+                db.real_estates_zones.c.data])
+        .select_from(db.real_estates_zones
+            .join(text('unnest(:lids, :zones_ids, :types_ids) AS units (lid, zones_id, types_id)'),
+                  and_(db.real_estates_zones.c.zones_id == text('units.zones_id'),
+                       db.real_estates_zones.c.types_id == text('units.types_id'))))
+        .where(db.real_estates_zones.c.models_id == bindparam('models_id')),
+        [('models_id', 'integer'), ('lids', 'integer[]'),
+         ('zones_ids', 'integer[]'), ('types_ids', 'integer[]')])
+
     def _get_real_estates_zones(self):
         '''Get real_estates_zones records'''
-        db_rezones = db.real_estates_zones
-
-        values = ', '.join(['(%s, %s, %s)' %
-                            (unit['location']['location_id'] + 1,
-                             unit['location']['zones_id'],
-                             unit['types_id'])
-                            for unit in self.units])
-
-        if not values:
+        if not self.units_params['lids']:
             return []
 
-        s = (select([db_rezones.c.types_id,
-                     text('units.lid'),
-                     db_rezones.c.markets_id,
-                     db_rezones.c.data])
-            .select_from(db_rezones
-                .join(text('(VALUES %s) AS units (lid, zones_id, types_id) ' % values),
-                      and_(db_rezones.c.zones_id == text('units.zones_id'),
-                           db_rezones.c.types_id == text('units.types_id'))))
-            .where(db_rezones.c.models_id == self.models_id))
-
-        result = self.conn.execute(s)
-        records = []
-        for row in result:
-            data = list(row[:3])
-            data.extend(row[3])
-            records.append(data)
-
-        result.close()
-        return records
+        result = self._real_estates_zones_query.execute(self.conn, **self.units_params)
+        return _fetch_values(result, expand=True)
 
     # rent_adjustments
     #"V_IDX";"I_IDX";"RENTADJ"
     #1.00;1.00;0.00
+    _rent_adjustments_query = PreparedQuery('rent_adjustments',
+        select([db.rent_adjustments.c.types_id,
+                text('units.lid'),
+                db.rent_adjustments.c.adjustment])
+        .select_from(db.rent_adjustments
+            .join(text('unnest(:lids, :zones_ids, :types_ids) AS units (lid, zones_id, types_id)'),
+                  and_(db.rent_adjustments.c.zones_id == text('units.zones_id'),
+                       db.rent_adjustments.c.types_id == text('units.types_id'))))
+        .where(db.rent_adjustments.c.models_id == bindparam('models_id')),
+        [('models_id', 'integer'), ('lids', 'integer[]'),
+         ('zones_ids', 'integer[]'), ('types_ids', 'integer[]')])
+
     def _get_rent_adjustments(self):
         '''Get rent_adjustments records'''
-        db_rentadj = db.rent_adjustments
-
-        values = ', '.join(['(%s, %s, %s)' %
-                            (unit['location']['location_id'] + 1,
-                             unit['location']['zones_id'],
-                             unit['types_id'])
-                            for unit in self.units])
-
-        if not values:
+        if not self.units_params['lids']:
             return []
 
-        s = (select([db_rentadj.c.types_id,
-                     text('units.lid'),
-                     db_rentadj.c.adjustment])
-            .select_from(db_rentadj
-                .join(text('(VALUES %s) AS units (lid, zones_id, types_id) ' % values),
-                      and_(db_rentadj.c.zones_id == text('units.zones_id'),
-                           db_rentadj.c.types_id == text('units.types_id'))))
-            .where(db_rentadj.c.models_id == self.models_id))
-
-        result = self.conn.execute(s)
-        records = [list(row) for row in result]
-        result.close()
-
-        return records
+        result = self._rent_adjustments_query.execute(self.conn, **self.units_params)
+        return _fetch_values(result)
 
     # rent_functions
     #"IDMARKET";"IDATTRIB";"SCALEPAR";"LINEAPAR";"CREST_X";"CZONES_X";"EXPPAR_X";"CREST_Y";"CZONES_Y";"EXPPAR_Y"
@@ -524,80 +649,88 @@ class MulandDB:
             .where(db_rentfunc.c.models_id == self.models_id))
 
         result = self.conn.execute(s)
-        records = [list(row) for row in result]
-        result.close()
-
-        return records
+        return _fetch_values(result)
 
     # subsidies
     #"H_IDX";"V_IDX";"I_IDX";"SUBSIDIES"
     #1.00;1.00;1.00;0.0000000000
+    _subsidies_query = PreparedQuery('subsidies',
+        select([db.subsidies.c.agents_id,
+                db.subsidies.c.types_id,
+                text('unit.lid'),
+                db.subsidies.c.subsidies])
+        .select_from(db.subsidies
+            .join(text('unnest(:lids, :zones_ids, :types_ids) AS unit (lid, zones_id, types_id)'),
+                  and_(db.subsidies.c.zones_id == text('unit.zones_id'),
+                       db.subsidies.c.types_id == text('unit.types_id'))))
+        .where(db.subsidies.c.models_id == bindparam('models_id')),
+        [('models_id', 'integer'), ('lids', 'integer[]'),
+         ('zones_ids', 'integer[]'), ('types_ids', 'integer[]')])
+
     def _get_subsidies(self):
         '''Get subsidies records'''
-        db_subsidies = db.subsidies
-
-        values = ', '.join(['(%s, %s, %s)' %
-                            (unit['location']['location_id'] + 1,
-                             unit['location']['zones_id'],
-                             unit['types_id'])
-                            for unit in self.units])
-
-        if not values:
+        if not self.units_params['lids']:
             return []
 
-        s = (select([db_subsidies.c.agents_id,
-                     db_subsidies.c.types_id,
-                     text('unit.lid'),
-                     db_subsidies.c.subsidies])
-            .select_from(db_subsidies
-                .join(text('(VALUES %s) AS unit (lid, zones_id, types_id) ' % values),
-                      and_(db_subsidies.c.zones_id == text('unit.zones_id'),
-                           db_subsidies.c.types_id == text('unit.types_id'))))
-            .where(db_subsidies.c.models_id == self.models_id))
-
-        result = self.conn.execute(s)
-        records = [list(row) for row in result]
-        result.close()
-
-        return records
+        result = self._subsidies_query.execute(self.conn, **self.units_params)
+        return _fetch_values(result)
 
     # supply
     #"V_IDX";"I_IDX";"NREST"
     #1.00;1.00;0.0000000000
+    _supply_query = PreparedQuery('supply',
+        select([db.supply.c.types_id,
+                text('unit.lid'),
+                db.supply.c.nrest])
+        .select_from(db.supply
+            .join(text('unnest(:lids, :zones_ids, :types_ids) AS unit (lid, zones_id, types_id)'),
+                  and_(db.supply.c.zones_id == text('unit.zones_id'),
+                       db.supply.c.types_id == text('unit.types_id'))))
+        .where(db.supply.c.models_id == bindparam('models_id')),
+        [('models_id', 'integer'), ('lids', 'integer[]'),
+         ('zones_ids', 'integer[]'), ('types_ids', 'integer[]')])
+
     def _get_supply(self):
         '''Get supply records'''
-        db_supply = db.supply
-
-        values = ', '.join(['(%s, %s, %s)' %
-                            (unit['location']['location_id'] + 1,
-                             unit['location']['zones_id'],
-                             unit['types_id'])
-                            for unit in self.units])
-
-        if not values:
+        if not self.units_params['lids']:
             return []
 
-        s = (select([db_supply.c.types_id,
-                     text('unit.lid'),
-                     db_supply.c.nrest])
-            .select_from(db_supply
-                .join(text('(VALUES %s) AS unit (lid, zones_id, types_id) ' % values),
-                      and_(db_supply.c.zones_id == text('unit.zones_id'),
-                           db_supply.c.types_id == text('unit.types_id'))))
-            .where(db_supply.c.models_id == self.models_id))
-
-        result = self.conn.execute(s)
-        records = [list(row) for row in result]
-        result.close()
-
-        return records
+        result = self._supply_query.execute(self.conn, **self.units_params)
+        return _fetch_values(result)
 
 class ModelImporter:
-    '''Import models into the database'''
+    '''Import models into the database
+
+    CSV files are streamed into unlogged staging tables with COPY,
+    concurrently on separate connections. Staging tables have no indexes or
+    constraints. Staged rows are then moved into the model tables in a single
+    transaction, so a model is either fully imported or not at all.
+    '''
     # pylint: disable=too-few-public-methods,too-many-instance-attributes,no-value-for-parameter
-    _insert_limit = 3000 # how many rows will be inserted at once
 
-    def __init__(self, name, srid=4326, verbose=False):
+    # Tables in insertion order, with the columns filled by the leading CSV
+    # columns, whether remaining CSV columns go into a data array and
+    # whether id is the record number.
+    _tables = [
+        ('zones', ['id'], True, False),
+        ('agents', ['id', 'markets_id', 'aggra_id', 'upperbb'], True, False),
+        ('rent_adjustments', ['types_id', 'zones_id', 'adjustment'], False, False),
+        ('supply', ['types_id', 'zones_id', 'nrest'], False, False),
+        ('real_estates_zones', ['types_id', 'zones_id', 'markets_id'], True, False),
+        ('demand', ['agents_id', 'demand'], False, False),
+        ('subsidies', ['agents_id', 'types_id', 'zones_id', 'subsidies'], False, False),
+        ('demand_exogenous_cutoff', ['agents_id', 'types_id', 'zones_id', 'dcutoff'], False, False),
+        ('agents_zones', ['agents_id', 'zones_id', 'acc', 'att'], True, False),
+        ('bids_adjustments', ['agents_id', 'types_id', 'zones_id', 'bidadj'], False, False),
+        ('bids_functions', ['markets_id', 'aggra_id', 'idattrib', 'lineapar',
+                            'cagent_x', 'crest_x', 'cacc_x', 'czones_x', 'exppar_x',
+                            'cagent_y', 'crest_y', 'cacc_y', 'czones_y', 'exppar_y'], False, True),
+        ('rent_functions', ['markets_id', 'idattrib', 'scalepar', 'lineapar',
+                            'crest_x', 'czones_x', 'exppar_x',
+                            'crest_y', 'czones_y', 'exppar_y'], False, True),
+    ]
+
+    def __init__(self, name, srid=4326, verbose=False, update=False):
         self.name = name
         self.zones_csv = '%s/zones.csv' % name
         self.agents_csv = '%s/agents.csv' % name
@@ -615,26 +748,146 @@ class ModelImporter:
         self.models_id = None
         self.srid = srid
         self.verbose = verbose
+        self.update = update
 
     def import_model(self):
-        '''Run all the steps to import a model'''
-        self.models_id = self.db_create_model()
-        self.db_import_zones()
-        self.db_import_rent_adjustments()
-        self.db_import_supply()
-        self.db_import_real_estates_zones()
-        self.db_import_agents()
-        self.db_import_demand()
-        self.db_import_subsidies()
-        self.db_import_demand_exogenous_cutoff()
-        self.db_import_agents_zones()
-        self.db_import_bids_adjustments()
-        self.db_import_bids_functions()
-        self.db_import_rent_functions()
-
-    def db_create_model(self):
-        '''Create entry for the model at the db and returns its id'''
-        # Find headers
+        '''Run all the steps to import a model
+
+        When updating, only tables whose files changed since the current
+        version are loaded from files, the others are copied from it. The new
+        version replaces the current one atomically. The replaced version is
+        kept for requests still using it until the next update.
+        '''
+        checksums = self.file_checksums()
+        with db.connect() as conn:
+            current = self.db_get_current(conn)
+        if current is not None and not self.update:
+            raise MulandDBException("Model '%s' already exists" % self.name)
+
+        changed = [table for table, _, _, _ in self._tables
+                   if current is None or current['checksums'].get(table) != checksums[table]]
+        if self.verbose:
+            print('Loading tables: %s' % (', '.join(changed) or 'none'))
+
+        self.db_drop_staged()
+        try:
+            csv_columns = self.db_stage_files(changed)
+            with db.connect() as conn, conn.begin():
+                if current is not None:
+                    if self.db_get_current(conn, lock=True) != current:
+                        raise MulandDBException("Model '%s' changed during import" % self.name)
+                    self.db_purge_retired(conn)
+                    self.db_retire(conn, current['id'])
+                version = current['version'] + 1 if current is not None else 1
+                self.models_id = self.db_create_model(conn, version)
+                for table, columns, has_data, numbered in self._tables:
+                    if table in changed:
+                        self.db_insert_staged(conn, table, columns, has_data,
+                                              numbered, csv_columns[table])
+                    else:
+                        self.db_copy_current(conn, table, current['id'])
+                self.db_store_checksums(conn, checksums)
+        finally:
+            self.db_drop_staged()
+
+    def file_checksums(self):
+        '''Return dict mapping each table to checksum of its source files'''
+        shapefile_parts = [self.shapefile[:-4] + ext for ext in ('.shp', '.shx', '.dbf')]
+        checksums = {}
+        for table, _, _, _ in self._tables:
+            files = [getattr(self, table + '_csv')]
+            if table == 'zones':
+                files.extend(part for part in shapefile_parts if os.path.exists(part))
+            digest = hashlib.sha256()
+            for filename in files:
+                with open(filename, 'rb') as f:
+                    for chunk in iter(lambda: f.read(1024 * 1024), b''): # pylint: disable=cell-var-from-loop
+                        digest.update(chunk)
+            checksums[table] = digest.hexdigest()
+        return checksums
+
+    def db_get_current(self, conn, lock=False):
+        '''Get id, version and file checksums of current version of model
+
+        Returns None if model doesn't exist.
+        '''
+        s = (select([db.models.c.id, db.models.c.version])
+            .where(db.models.c.name == self.name))
+        if lock:
+            s = s.with_for_update()
+        result = conn.execute(s)
+        row = result.fetchone()
+        result.close()
+        if row is None:
+            return None
+
+        s = (select([db.model_files.c.table_name, db.model_files.c.checksum])
+            .where(db.model_files.c.models_id == row[0]))
+        result = conn.execute(s)
+        checksums = dict(result.fetchall())
+        result.close()
+
+        return {'id': row[0], 'version': row[1], 'checksums': checksums}
+
+    def db_retire(self, conn, models_id):
+        '''Rename model version so it can't be found, keeping its data'''
+        s = (db.models.update()
+            .where(db.models.c.id == models_id)
+            .values(name=self._retired_name(models_id)))
+        conn.execute(s).close()
+
+    def db_purge_retired(self, conn):
+        '''Delete versions of model retired by previous updates'''
+        s = (select([db.models.c.id])
+            .where(db.models.c.name.startswith(self._retired_name(''),
+                                               autoescape=True)))
+        result = conn.execute(s)
+        retired = [row[0] for row in result]
+        result.close()
+        if not retired:
+            return
+
+        for table, _, _, _ in reversed(self._tables):
+            db_table = getattr(db, table)
+            conn.execute(db_table.delete()
+                         .where(db_table.c.models_id.in_(retired))).close()
+        conn.execute(db.model_files.delete()
+                     .where(db.model_files.c.models_id.in_(retired))).close()
+        conn.execute(db.models.delete()
+                     .where(db.models.c.id.in_(retired))).close()
+        if self.verbose:
+            print('Purged %d retired versions' % len(retired))
+
+    def db_copy_current(self, conn, table, current_id):
+        '''Copy rows of table from current version into the new one'''
+        assert self.models_id is not None
+
+        db_table = getattr(db, table)
+        columns = [c.name for c in db_table.columns if c.name != 'models_id']
+        s = db_table.insert().from_select(
+            ['models_id'] + columns,
+            select([literal(self.models_id)] + [db_table.c[c] for c in columns])
+            .where(db_table.c.models_id == current_id))
+        result = conn.execute(s)
+        if self.verbose:
+            print('Copied %d unchanged rows into %s' % (result.rowcount,
+                                                        db_table.name))
+        result.close()
+
+    def db_store_checksums(self, conn, checksums):
+        '''Store file checksums of the new version'''
+        assert self.models_id is not None
+
+        conn.execute(db.model_files.insert(), [
+            {'models_id': self.models_id, 'table_name': table, 'checksum': checksum}
+            for table, checksum in checksums.items()]).close()
+
+    def _retired_name(self, models_id):
+        '''Name of retired model version, unreachable by requests'''
+        return '~%s~%s' % (self.name, models_id)
+
+    def get_headers(self):
+        '''Get headers of data arrays from CSV files, by models column'''
         with open(self.zones_csv) as f:
             reader = csv.reader(f, delimiter=';', quoting=csv.QUOTE_NONNUMERIC)
             zones_header = tuple(next(reader)[1:])
@@ -651,27 +904,129 @@ class ModelImporter:
             reader = csv.reader(f, delimiter=';', quoting=csv.QUOTE_NONNUMERIC)
             real_estates_zones_header = tuple(next(reader)[3:])
 
-        # Insert model
+        return {'zones_header': zones_header,
+                'agents_header': agents_header,
+                'agents_zones_header': agents_zones_header,
+                'real_estates_zones_header': real_estates_zones_header}
+
+    def db_create_model(self, conn, version=1):
+        '''Create entry for the model at the db and returns its id'''
         s = db.models.insert().values(
             name=self.name,
-            zones_header=zones_header,
-            agents_header=agents_header,
-            agents_zones_header=agents_zones_header,
-            real_estates_zones_header=real_estates_zones_header
+            version=version,
+            **self.get_headers()
         ).returning(db.models.c.id)
 
-        result = db.engine.execute(s)
+        result = conn.execute(s)
         models_id = result.fetchone()[0]
         result.close()
 
         return models_id
 
-    def _get_zone_shapes(self):
-        '''Parse shapefile and return mapping between zone_id and polygon wkt'''
+    def db_stage_files(self, tables):
+        '''Copy CSV files of tables into staging tables concurrently
+
+        Zone shapes are staged too when zones is among tables. Returns dict
+        mapping each table to the number of columns of its CSV.
+        '''
+        csv_columns = {}
+        with ThreadPoolExecutor(max_workers=config.db_import_workers) as pool:
+            futures = {pool.submit(self._stage_csv, table): table
+                       for table in tables}
+            if 'zones' in tables:
+                futures[pool.submit(self._stage_zone_areas)] = None
+            for future in as_completed(futures):
+                table = futures[future]
+                if table is not None:
+                    csv_columns[table] = future.result()
+                else:
+                    future.result()
+        return csv_columns
+
+    def db_insert_staged(self, conn, table, columns, has_data, numbered, ncolumns):
+        '''Move staged rows of table into the model table'''
+        # pylint: disable=too-many-arguments
+        assert self.models_id is not None
+
+        target = ['models_id']
+        values = ['%d' % self.models_id]
+        if numbered:
+            target.append('id')
+            values.append('s.n')
+        target.extend(columns)
+        values.extend('s.c%d' % i for i in range(len(columns)))
+        if has_data:
+            target.append('data')
+            values.append('ARRAY[%s]::float8[]' % ', '.join(
+                's.c%d' % i for i in range(len(columns), ncolumns)))
+
+        source = '%s AS s' % self._staging_name(table)
+        if table == 'zones':
+            target.append('area')
+            values.append('ST_Transform(ST_GeomFromText(a.wkt, %d), 900913)' % self.srid)
+            source += ' LEFT JOIN %s AS a ON a.id = s.c0' % self._staging_name('zone_areas')
+
+        result = conn.execute('INSERT INTO %s (%s) SELECT %s FROM %s' % (
+            getattr(db, table).name, ', '.join(target), ', '.join(values), source))
+        if self.verbose:
+            print('Inserted %d rows into %s' % (result.rowcount,
+                                                getattr(db, table).name))
+        result.close()
+
+    def db_drop_staged(self):
+        '''Drop staging tables'''
+        names = [self._staging_name(table) for table, _, _, _ in self._tables]
+        names.append(self._staging_name('zone_areas'))
+        with db.connect() as conn:
+            conn.execute('DROP TABLE IF EXISTS %s' % ', '.join(names)).close()
+
+    def _staging_name(self, table):
+        '''Name of staging table of table for this import'''
+        return '%simport_%d_%s' % (config.db_prefix, os.getpid(), table)
+
+    def _stage_csv(self, table):
+        '''Copy CSV file of table into its staging table
+
+        Returns number of columns of the CSV file.
+        '''
+        name = self._staging_name(table)
+        with open(getattr(self, table + '_csv')) as f:
+            ncolumns = len(f.readline().split(';'))
+            f.seek(0)
+            columns = ['c%d' % i for i in range(ncolumns)]
+            with db.connect() as conn, conn.begin():
+                conn.execute('CREATE UNLOGGED TABLE %s (n serial, %s)' % (
+                    name, ', '.join('%s float8' % c for c in columns))).close()
+                cursor = conn.connection.cursor()
+                cursor.copy_expert("COPY %s (%s) FROM STDIN "
+                                   "WITH (FORMAT csv, DELIMITER ';', HEADER true)" %
+                                   (name, ', '.join(columns)), f)
+                rows = cursor.rowcount
+                cursor.close()
+        if self.verbose:
+            print('Copied %d rows into %s' % (rows, name))
+        return ncolumns
+
+    def _stage_zone_areas(self):
+        '''Copy zone polygons from shapefile into staging table'''
+        name = self._staging_name('zone_areas')
+        buffer = StringIO(''.join('%d\t%s\n' % (int(zones_id), polygon.wkt)
+                                  for zones_id, polygon in self.get_zone_polygons().items()))
+        with db.connect() as conn, conn.begin():
+            conn.execute('CREATE UNLOGGED TABLE %s (id integer, wkt text)' % name).close()
+            cursor = conn.connection.cursor()
+            cursor.copy_expert('COPY %s (id, wkt) FROM STDIN' % name, buffer)
+            rows = cursor.rowcount
+            cursor.close()
+        if self.verbose:
+            print('Copied %d rows into %s' % (rows, name))
+
+    def get_zone_polygons(self):
+        '''Parse shapefile and return mapping between zone_id and polygon'''
         sf = shapefile.Reader(self.shapefile)
         fields = [x[0] for x in sf.fields[1:]]
 
-        zone_wkt = {}
+        zone_polygons = {}
         for sr in sf.shapeRecords():
             assert sr.shape.shapeType == 5 # Polygon
 
@@ -686,213 +1041,6 @@ class ModelImporter:
             exterior = points[ringidx[0][0]:ringidx[0][1]]
             interior = [points[i:j] for i, j in ringidx[1:]]
 
-            # generate polygon wkt
-            polygon = Polygon(exterior, interior)
-            wkt = polygon.wkt
-            zone_wkt[zones_id] = wkt
-
-        return zone_wkt
-
-    def _insert_with_limit(self, table, values):
-        '''Insert values into table respecting limit per query'''
-        verbose = self.verbose
-        insert_limit = self._insert_limit
-        conn = db.engine.connect()
-        while True:
-            viter = iter(values)
-            partial_values = []
-            for _ in range(insert_limit):
-                try:
-                    partial_values.append(next(viter))
-                except StopIteration:
-                    break
-            if len(partial_values) == 0:
-                return
-            result = conn.execute(table.insert().values(partial_values))
-            result.close()
-            if verbose is True and len(partial_values) > 0:
-                print('Inserted %d rows into %s' % (len(partial_values),
-                                                    str(table)))
-            if len(partial_values) < insert_limit:
-                return
-
-    def db_import_zones(self):
-        '''Import zones.csv'''
-        assert self.models_id is not None
-
-        zone_wkt = self._get_zone_shapes()
-
-        # Parse zone file
-        with open(self.zones_csv) as f:
-            r = csv.reader(f, delimiter=';', quoting=csv.QUOTE_NONNUMERIC)
-            next(r) # skip header
-            models_id = self.models_id
-            srid = self.srid
-            values = ({
-                'models_id': models_id,
-                'id': int(row[0]),
-                'data': tuple(row[1:]),
-                'area': func.ST_Transform(
-                            func.ST_GeomFromText(zone_wkt[int(row[0])],
-                                                 srid),
-                            900913)
-            } for row in r)
-            self._insert_with_limit(db.zones, values)
-
-    def db_import_rent_adjustments(self):
-        '''Import rent_adjustments.csv'''
-        assert self.models_id is not None
-
-        values = []
-        with open(self.rent_adjustments_csv) as f:
-            r = csv.reader(f, delimiter=';', quoting=csv.QUOTE_NONNUMERIC)
-            next(r)
-            values = ({'types_id': int(row[0]), 'zones_id': int(row[1]),
-                       'models_id': self.models_id, 'adjustment': row[2]}
-                       for row in r)
-            self._insert_with_limit(db.rent_adjustments, values)
-
-    def db_import_supply(self):
-        '''Import supply.csv'''
-        assert self.models_id is not None
-
-        with open(self.supply_csv) as f:
-            r = csv.reader(f, delimiter=';', quoting=csv.QUOTE_NONNUMERIC)
-            next(r)
-            values = ({'types_id': int(row[0]),
-                       'zones_id': int(row[1]),
-                       'models_id': self.models_id,
-                       'nrest': row[2]}
-                      for row in r)
-            self._insert_with_limit(db.supply, values)
-
-    def db_import_real_estates_zones(self):
-        '''Import real_estates_zones.csv'''
-        assert self.models_id is not None
-
-        with open(self.real_estates_zones_csv) as f:
-            r = csv.reader(f, delimiter=';', quoting=csv.QUOTE_NONNUMERIC)
-            next(r)
-            values = ({'models_id': self.models_id,
-                       'types_id': int(row[0]),
-                       'zones_id': int(row[1]),
-                       'markets_id': int(row[2]),
-                       'data': tuple(row[3:])}
-                      for row in r)
-            self._insert_with_limit(db.real_estates_zones, values)
-
-    def db_import_agents(self):
-        '''Import agents.csv'''
-        assert self.models_id is not None
-
-        with open(self.agents_csv) as f:
-            r = csv.reader(f, delimiter=';', quoting=csv.QUOTE_NONNUMERIC)
-            next(r) # skip header
-            values = ({'models_id': self.models_id,
-                       'id': row[0],
-                       'markets_id': row[1],
-                       'aggra_id': row[2],
-                       'upperbb': row[3],
-                       'data': tuple(row[4:])}
-                      for row in r)
-            self._insert_with_limit(db.agents, values)
-
-    def db_import_demand(self):
-        '''Import demand.csv'''
-        assert self.models_id is not None
-
-        with open(self.demand_csv) as f:
-            r = csv.reader(f, delimiter=';', quoting=csv.QUOTE_NONNUMERIC)
-            next(r) # skip header
-            values = ({'models_id': self.models_id,
-                       'agents_id': row[0],
-                       'demand': row[1]}
-                      for row in r)
-            self._insert_with_limit(db.demand, values)
-
-    def db_import_subsidies(self):
-        '''Import subsidies.csv'''
-        assert self.models_id is not None
-
-        with open(self.subsidies_csv) as f:
-            r = csv.reader(f, delimiter=';', quoting=csv.QUOTE_NONNUMERIC)
-            next(r) # skip header
-            values = ({'models_id': self.models_id, 'agents_id': row[0],
-                       'types_id': row[1], 'zones_id': row[2],
-                       'subsidies': row[3]}
-                       for row in r)
-            self._insert_with_limit(db.subsidies, values)
-
-    def db_import_demand_exogenous_cutoff(self):
-        '''Import demand_exogenous_cutoff.csv'''
-        assert self.models_id is not None
-
-        with open(self.demand_exogenous_cutoff_csv) as f:
-            r = csv.reader(f, delimiter=';', quoting=csv.QUOTE_NONNUMERIC)
-            next(r) # skip header
-            values = ({'models_id': self.models_id, 'agents_id': row[0],
-                       'types_id': row[1], 'zones_id': row[2],
-                       'dcutoff': row[3]}
-                       for row in r)
-            self._insert_with_limit(db.demand_exogenous_cutoff, values)
-
-    def db_import_agents_zones(self):
-        '''Import agents_zones.csv'''
-        assert self.models_id is not None
-
-        with open(self.agents_zones_csv) as f:
-            r = csv.reader(f, delimiter=';', quoting=csv.QUOTE_NONNUMERIC)
-            next(r) # skip header
-            values = ({'models_id': self.models_id, 'agents_id': row[0],
-                       'zones_id': row[1], 'acc': row[2], 'att': row[3],
-                       'data': tuple(row[4:])}
-                      for row in r)
-            self._insert_with_limit(db.agents_zones, values)
-
-    def db_import_bids_adjustments(self):
-        '''Import bids_adjustments.csv'''
-        assert self.models_id is not None
-
-        with open(self.bids_adjustments_csv) as f:
-            r = csv.reader(f, delimiter=';', quoting=csv.QUOTE_NONNUMERIC)
-            next(r) # skip header
-            values = ({'models_id': self.models_id, 'agents_id': row[0],
-                       'types_id': row[1], 'zones_id': row[2],
-                       'bidadj': row[3]}
-                      for row in r)
-            self._insert_with_limit(db.bids_adjustments, values)
-
-    def db_import_bids_functions(self):
-        '''Import bids_functions.csv'''
-        assert self.models_id is not None
-
-        with open(self.bids_functions_csv) as f:
-            r = csv.reader(f, delimiter=';', quoting=csv.QUOTE_NONNUMERIC)
-            next(r) # skip header
-            values = ({'models_id': self.models_id, 'markets_id': row[0],
-                       'aggra_id': row[1], 'idattrib': row[2],
-                       'lineapar': row[3], 'cagent_x': row[4],
-                       'crest_x': row[5], 'cacc_x': row[6],
-                       'czones_x': row[7], 'exppar_x': row[8],
-                       'cagent_y': row[9], 'crest_y': row[10],
-                       'cacc_y': row[11], 'czones_y': row[12],
-                       'exppar_y': row[13]}
-                      for row in r)
-            self._insert_with_limit(db.bids_functions, values)
-
-
-    def db_import_rent_functions(self):
-        '''Import rent_functions.csv'''
-        assert self.models_id is not None
+            zone_polygons[zones_id] = Polygon(exterior, interior)
 
-        with open(self.rent_functions_csv) as f:
-            r = csv.reader(f, delimiter=';', quoting=csv.QUOTE_NONNUMERIC)
-            next(r) # skip header
-            values = ({'models_id': self.models_id, 'markets_id': row[0],
-                       'idattrib': row[1], 'scalepar': row[2],
-                       'lineapar': row[3], 'crest_x': row[4],
-                       'czones_x': row[5], 'exppar_x': row[6],
-                       'crest_y': row[7], 'czones_y': row[8],
-                       'exppar_y': row[9]}
-                      for row in r)
-            self._insert_with_limit(db.rent_functions, values)
+        return zone_polygons
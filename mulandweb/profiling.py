@@ -0,0 +1,121 @@
+# coding: utf-8
+'''Provides opt-in profiling of requests
+
+POST requests sent with an X-MulandWeb-Profile header holding
+MULANDWEB_PROFILE_TOKEN are run under cProfile, bypassing the result cache.
+Statistics are saved to MULANDWEB_PROFILE_PATH as <id>.prof, readable by
+pstats, along with <id>.json, a summary of the slowest functions, the
+database queries and the resource usage of the Mu-Land process. Only the
+latest MULANDWEB_PROFILE_KEEP profiles are kept. Requests without the
+header aren't affected.
+'''
+
+import os
+import re
+import hmac
+import json
+import time
+import uuid
+import pstats
+import cProfile
+from pathlib import Path
+from threading import Lock
+
+from . import config
+
+__all__ = ['RequestProfile', 'authorized', 'load_summary', 'header', 'id_header']
+
+header = 'X-MulandWeb-Profile'
+id_header = 'X-MulandWeb-Profile-Id'
+
+_id_re = re.compile('^[0-9a-f]{32}$')
+# Python allows a single active profiler, so profiled requests take turns
+_lock = Lock()
+
+class RequestProfile:
+    '''Profile of a request, collected while used as a context manager
+
+    Database query statistics are appended to query_stats and resource
+    usage of Mu-Land, as Muland.rusage, is set at rusage.
+    '''
+    def __init__(self, model: str):
+        self.id = uuid.uuid4().hex # pylint: disable=invalid-name
+        self.model = model
+        self.profiler = cProfile.Profile()
+        self.seconds = None
+        self.query_stats = []
+        self.rusage = None
+        self._start = None
+
+    def __enter__(self):
+        _lock.acquire()
+        self._start = time.perf_counter()
+        self.profiler.enable()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profiler.disable()
+        self.seconds = time.perf_counter() - self._start
+        _lock.release()
+
+    def summary(self, limit: int = 50):
+        '''Get summary of profile, with functions of most cumulative time'''
+        stats = pstats.Stats(self.profiler).stats # pylint: disable=no-member
+        functions = []
+        for (filename, line, name), (_, ncalls, tottime, cumtime, _) in sorted(
+                stats.items(), key=lambda item: item[1][3], reverse=True)[:limit]:
+            functions.append({'function': '%s:%d(%s)' % (filename, line, name),
+                              'ncalls': ncalls, 'tottime': tottime,
+                              'cumtime': cumtime})
+        return {'id': self.id, 'model': self.model, 'seconds': self.seconds,
+                'queries': [{'name': stat.name, 'seconds': stat.seconds,
+                             'rows': stat.rows} for stat in self.query_stats],
+                'muland_rusage': self.rusage, 'functions': functions}
+
+    def save(self, path: str = None, keep: int = None):
+        '''Save statistics and summary of profile to path
+
+        Older profiles are removed, keeping the latest keep ones.
+        '''
+        path = config.mulandweb_profile_path if path is None else path
+        keep = config.mulandweb_profile_keep if keep is None else keep
+        os.makedirs(path, exist_ok=True)
+        self.profiler.dump_stats(str(Path(path, self.id + '.prof')))
+        with open(str(Path(path, self.id + '.json')), 'w') as file:
+            json.dump(self.summary(), file)
+        _prune(path, keep)
+
+def authorized(token: str):
+    '''Whether token allows profiling requests'''
+    if not config.mulandweb_profile_token or token is None:
+        return False
+    return hmac.compare_digest(token.encode('utf-8'),
+                               config.mulandweb_profile_token.encode('utf-8'))
+
+def _prune(path, keep):
+    '''Remove profiles at path but the latest keep ones'''
+    profiles = []
+    for filename in Path(path).glob('*.json'):
+        if _id_re.match(filename.stem) is None:
+            continue
+        try:
+            profiles.append((filename.stat().st_mtime, filename.stem))
+        except FileNotFoundError:
+            continue
+    for _, profile_id in sorted(profiles, reverse=True)[keep:]:
+        for suffix in ('.json', '.prof'):
+            try:
+                os.unlink(str(Path(path, profile_id + suffix)))
+            except FileNotFoundError:
+                pass
+
+def load_summary(profile_id: str, path: str = None):
+    '''Load summary of saved profile, None if there is none'''
+    path = config.mulandweb_profile_path if path is None else path
+    if _id_re.match(profile_id) is None:
+        return None
+    try:
+        with open(str(Path(path, profile_id + '.json'))) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return None
@@ -0,0 +1,108 @@
+# coding: utf-8
+'''Provides reducers summarizing Mu-Land output next to the model
+
+A reducer takes the input and output data of a run and returns a dict of
+compact tables, which are sent instead of the output data. Besides Muland
+input tables, input data has 'location_zones', with columns I_IDX and ZONE
+giving the model zone of each location.
+'''
+
+import numpy as np
+
+__all__ = ['ReducerError', 'reduce', 'reducers']
+
+class ReducerError(Exception):
+    '''Reducer can't be applied with the parameters given'''
+    pass
+
+def reduce(names: list, params: dict, input_data: dict, output_data: dict):
+    '''Apply reducers by name, returning dict of their tables'''
+    ret = {}
+    for name in names:
+        function, _ = reducers[name]
+        ret.update(function(input_data, output_data, params))
+    return ret
+
+def affordability(input_data, output_data, params):
+    '''Housing cost burden of households by real estate
+
+    Cost burden of agent h at real estate vi is its rent times periods
+    (12 by default, for monthly rents) over the agent's income, taken from
+    agents attribute income_attr. Returns table 'affordability' with rows
+    Realestate;Zone;Households;CostBurden;Share30;Share50, where cost burden
+    is averaged over located households and shares are of households whose
+    burden exceeds 30% and 50%.
+    '''
+    income = _agents_column(input_data, params, 'income_attr')
+    periods = _float_param(params, 'periods', 12.0)
+
+    rents = output_data['rents']
+    households = output_data['location'][:, 2:]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        burden = rents[:, 2, None] * periods / income[None, :]
+        located = households > 0
+        total = households.sum(axis=1)
+        weighted = np.where(located, households * burden, 0.0).sum(axis=1)
+        over30 = np.where(located & (burden > 0.3), households, 0.0).sum(axis=1)
+        over50 = np.where(located & (burden > 0.5), households, 0.0).sum(axis=1)
+        has_households = total > 0
+        ret = np.column_stack((rents[:, 0:2], total,
+                               np.where(has_households, weighted / total, 0.0),
+                               np.where(has_households, over30 / total, 0.0),
+                               np.where(has_households, over50 / total, 0.0)))
+    return {'affordability': ret}
+
+def zone_rollup(input_data, output_data, params):
+    '''Households and rents by zone
+
+    Returns table 'zone_rollup' with rows Zone;Households;Rent;H_Type[..],
+    where Zone is the model zone containing locations, Rent is averaged over
+    located households, or over real estates of zones without households,
+    and H_Type are households by agent.
+    '''
+    # pylint: disable=unused-argument
+    rents = output_data['rents']
+    households = output_data['location'][:, 2:]
+    lids, zones_ids = input_data['location_zones'].values.T
+    order = np.argsort(lids)
+    pos = np.searchsorted(lids, rents[:, 1], sorter=order)
+    if (pos >= lids.shape[0]).any() or (lids[order[pos]] != rents[:, 1]).any():
+        raise ReducerError('Location without zone')
+    zones, rows = np.unique(zones_ids[order[pos]], return_inverse=True)
+    rows = rows.reshape(-1)
+
+    by_agent = np.zeros((zones.shape[0], households.shape[1]))
+    np.add.at(by_agent, rows, households)
+    total_vi = households.sum(axis=1)
+    total = np.bincount(rows, weights=total_vi, minlength=zones.shape[0])
+    weighted_rent = np.bincount(rows, weights=total_vi * rents[:, 2],
+                                minlength=zones.shape[0])
+    mean_rent = (np.bincount(rows, weights=rents[:, 2], minlength=zones.shape[0]) /
+                 np.bincount(rows, minlength=zones.shape[0]))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rent = np.where(total > 0, weighted_rent / total, mean_rent)
+    return {'zone_rollup': np.column_stack((zones, total, rent, by_agent))}
+
+def _agents_column(input_data, params, name):
+    '''Get column of agents named by parameter'''
+    attr = params.get(name)
+    if not attr:
+        raise ReducerError("'%s' is required" % name)
+    agents = input_data['agents']
+    try:
+        return agents.values[:, agents.columns[attr.upper()]]
+    except KeyError:
+        raise ReducerError("Unknown agents attribute '%s'" % attr)
+
+def _float_param(params, name, default):
+    '''Get parameter as a float'''
+    try:
+        return float(params.get(name, default))
+    except ValueError:
+        raise ReducerError("'%s' isn't a number" % name)
+
+# Reducers by name, with the request parameters they take
+reducers = {
+    'affordability': (affordability, ['income_attr', 'periods']),
+    'zone_rollup': (zone_rollup, []),
+}
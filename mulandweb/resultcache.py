@@ -0,0 +1,212 @@
+# coding: utf-8
+'''Provides cache of Mu-Land results keyed by request content'''
+
+import os
+import json
+import time
+import fcntl
+import hashlib
+import tempfile
+from collections import OrderedDict
+from concurrent.futures import Future
+from pathlib import Path
+from threading import Lock
+
+import numpy as np
+
+from . import config
+
+__all__ = ['ResultCache', 'request_key', 'results']
+
+_sweep_interval = 60 # seconds between sweeps of disk tier by each process
+
+def request_key(model: str, models_id: int, version: int, engine: str,
+                scenario, reduce=None):
+    '''Return canonical hash of a validated request'''
+    # pylint: disable=too-many-arguments
+    canonical = json.dumps({'model': model, 'models_id': models_id,
+                            'version': version, 'engine': engine,
+                            'scenario': scenario.digest(), 'reduce': reduce},
+                           sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+class ResultCache:
+    '''Two tier cache of Mu-Land output data
+
+    Results are kept in an in-memory LRU of up to size entries and, if path
+    is given, in files under path that survive restarts. Entries expire
+    after ttl seconds. Concurrent lookups of a missing key wait for a single
+    computation: threads of a process through a shared future, processes
+    through a lock file when the disk tier is enabled.
+
+    Expired files are removed when read, and writers periodically sweep the
+    disk tier, removing expired files and then the oldest ones while it
+    takes more than max_bytes.
+    '''
+    def __init__(self, size: int, ttl: int, path: str, max_bytes: int = 0):
+        self.size = size
+        self.ttl = ttl
+        self.path = Path(path) if path else None
+        self.max_bytes = max_bytes # 0 for no limit
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._next_sweep = 0
+        self._lock = Lock()
+
+    @property
+    def enabled(self):
+        '''Whether any tier is enabled'''
+        return self.size > 0 or self.path is not None
+
+    def get_or_compute(self, key: str, compute):
+        '''Return tuple (output data, hit) computing output data if needed'''
+        value = self._get_memory(key)
+        if value is not None:
+            return value, True
+
+        with self._lock:
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self._inflight[key] = Future()
+        if not leader:
+            return future.result(), True
+
+        try:
+            value, hit = self._get_disk_or_compute(key, compute)
+            self._put_memory(key, value)
+            future.set_result(value)
+            return value, hit
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+
+    def _get_memory(self, key):
+        '''Get value from memory tier'''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def _put_memory(self, key, value):
+        '''Store value at memory tier'''
+        if self.size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.time() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def _get_disk_or_compute(self, key, compute):
+        '''Get value from disk tier or compute it holding key's lock file'''
+        if self.path is None:
+            return compute(), False
+
+        value = self._read_disk(key)
+        if value is not None:
+            return value, True
+
+        filename = self._filename(key)
+        filename.parent.mkdir(parents=True, exist_ok=True)
+        lockname = filename.with_suffix('.lock')
+        with open(str(lockname), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                value = self._read_disk(key)
+                if value is not None:
+                    return value, True
+                value = compute()
+                self._write_disk(key, value)
+            finally:
+                # Waiters holding the unlinked file read the stored value
+                _unlink(lockname)
+        self._sweep()
+        return value, False
+
+    def _filename(self, key):
+        '''Path of file storing key'''
+        return self.path / key[:2] / (key + '.npz')
+
+    def _read_disk(self, key):
+        '''Read value from disk tier, None if missing or expired'''
+        filename = self._filename(key)
+        try:
+            if os.stat(str(filename)).st_mtime + self.ttl < time.time():
+                _unlink(filename)
+                return None
+            with np.load(str(filename)) as npz:
+                return {name: npz[name] for name in npz.files}
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def _write_disk(self, key, value):
+        '''Write value to disk tier atomically'''
+        filename = self._filename(key)
+        fd, tmpname = tempfile.mkstemp(dir=str(filename.parent), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, **value)
+            os.replace(tmpname, str(filename))
+        except BaseException:
+            os.unlink(tmpname)
+            raise
+
+    def _sweep(self):
+        '''Remove expired files of disk tier, then oldest ones over budget
+
+        Runs at most every _sweep_interval seconds in each process, and is
+        skipped while another process sweeps.
+        '''
+        now = time.time()
+        with self._lock:
+            if now < self._next_sweep:
+                return
+            self._next_sweep = now + _sweep_interval
+
+        with open(str(self.path / 'sweep.lock'), 'w') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+            files = []
+            for filename in self.path.glob('*/*'):
+                # Temporary files are left by writers which were killed
+                if filename.suffix not in ('.npz', '.tmp'):
+                    continue
+                try:
+                    stat = filename.stat()
+                except FileNotFoundError:
+                    continue
+                if stat.st_mtime + self.ttl < now:
+                    _unlink(filename)
+                elif filename.suffix == '.npz':
+                    files.append((stat.st_mtime, stat.st_size, filename))
+
+            total = sum(size for _, size, _ in files)
+            for _, size, filename in sorted(files):
+                if not self.max_bytes or total <= self.max_bytes:
+                    break
+                _unlink(filename)
+                total -= size
+
+def _unlink(filename):
+    '''Remove file, which may have been removed already'''
+    try:
+        os.unlink(str(filename))
+    except FileNotFoundError:
+        pass
+
+results = ResultCache(config.mulandweb_result_cache_size,
+                      config.mulandweb_result_cache_ttl,
+                      config.mulandweb_result_cache_path,
+                      config.mulandweb_result_cache_disk_max)
@@ -0,0 +1,76 @@
+# coding: utf-8
+'''Provides per-worker cache of location independent model tables'''
+
+from collections import OrderedDict
+from threading import Lock
+
+import numpy as np
+
+from . import config
+
+__all__ = ['ModelSnapshot', 'SnapshotCache', 'snapshots']
+
+class ModelSnapshot:
+    '''Location independent tables of a model version'''
+    def __init__(self, models_id: int, version: int, headers: dict, tables: dict):
+        self.models_id = models_id
+        self.version = version
+        self.headers = headers
+        # Arrays are taken as they are, so tables mapped from files aren't copied
+        self.tables = {key: np.asarray(values, dtype=float)
+                       for key, values in tables.items()}
+        for array in self.tables.values():
+            array.flags.writeable = False
+        self.nbytes = sum(array.nbytes for array in self.tables.values())
+
+    def values(self, name):
+        '''Return read-only array of table, shared by every request'''
+        return self.tables[name]
+
+class SnapshotCache:
+    '''LRU cache of model data by model name under a memory budget
+
+    Cached objects carry models_id, version and nbytes attributes, as
+    ModelSnapshot does.
+    '''
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._snapshots = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, name: str, models_id: int, version: int):
+        '''Return snapshot of model if cached and current, else None'''
+        with self._lock:
+            snapshot = self._snapshots.get(name)
+            if snapshot is None:
+                return None
+            if snapshot.models_id != models_id or snapshot.version != version:
+                self._remove(name)
+                return None
+            self._snapshots.move_to_end(name)
+            return snapshot
+
+    def put(self, name: str, snapshot):
+        '''Store snapshot evicting least recently used ones over budget'''
+        if snapshot.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if name in self._snapshots:
+                self._remove(name)
+            self._snapshots[name] = snapshot
+            self.nbytes += snapshot.nbytes
+            while self.nbytes > self.max_bytes:
+                self._remove(next(iter(self._snapshots)))
+
+    def clear(self):
+        '''Remove all snapshots'''
+        with self._lock:
+            self._snapshots.clear()
+            self.nbytes = 0
+
+    def _remove(self, name):
+        '''Remove snapshot from cache. Caller must hold lock.'''
+        self.nbytes -= self._snapshots.pop(name).nbytes
+
+snapshots = SnapshotCache(config.mulandweb_snapshot_cache_max)
@@ -0,0 +1,251 @@
+# coding: utf-8
+'''Provides compressed transport of request and response bodies
+
+Request bodies sent with Content-Encoding gzip, or zstd if zstandard is
+installed, are decompressed as they are read into a spooled file, which
+spills to disk past MULANDWEB_MEMFILE_MAX and is rejected past
+MULANDWEB_BODY_MAX. So are chunked bodies without Content-Encoding, whose
+size isn't known in advance. Responses are compressed as they are streamed, by the
+best encoding named in Accept-Encoding.
+'''
+
+import gzip
+import zlib
+from tempfile import SpooledTemporaryFile
+
+from . import config
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+__all__ = ['TransportMiddleware']
+
+_read_size = 64 * 1024
+_status = {400: '400 Bad Request', 413: '413 Request Entity Too Large',
+           415: '415 Unsupported Media Type'}
+
+class BodyError(Exception):
+    '''Request body couldn't be decoded'''
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+class TransportMiddleware:
+    '''WSGI middleware decoding requests and encoding responses'''
+    def __init__(self, wsgi_app, body_max: int = config.mulandweb_body_max,
+                 spool_max: int = config.mulandweb_memfile_max,
+                 level: int = config.mulandweb_compress_level,
+                 minimum: int = config.mulandweb_compress_min):
+        # pylint: disable=too-many-arguments
+        self.wsgi_app = wsgi_app
+        self.body_max = body_max
+        self.spool_max = spool_max
+        self.level = level
+        self.minimum = minimum
+
+    def __call__(self, environ, start_response):
+        try:
+            self._decode_body(environ)
+        except BodyError as e:
+            message = str(e).encode('utf-8')
+            start_response(_status[e.status],
+                           [('Content-Type', 'text/plain'),
+                            ('Content-Length', str(len(message)))])
+            return [message]
+
+        encoding = _accepted_encoding(environ.get('HTTP_ACCEPT_ENCODING', ''))
+        if encoding is None:
+            return self.wsgi_app(environ, start_response)
+
+        state = {}
+        def encoding_start_response(status, headers, exc_info=None):
+            '''Set headers of compressed response, if it's compressed'''
+            if self._compressible(status, headers):
+                state['compressor'] = _encoders[encoding](self.level)
+                headers = _compressed_headers(headers, encoding)
+            write = start_response(status, headers, exc_info)
+            if 'compressor' not in state:
+                return write
+            return lambda data: write(state['compressor'](data))
+
+        result = self.wsgi_app(environ, encoding_start_response)
+        return _ClosingIterator(self._iter_compressed(result, state), result)
+
+    def _decode_body(self, environ):
+        '''Replace encoded request body by decoded spooled file'''
+        length = environ.get('CONTENT_LENGTH') or ''
+        if length.isdigit() and int(length) > self.body_max:
+            raise BodyError(413, 'Request body is too large.')
+
+        encoding = environ.pop('HTTP_CONTENT_ENCODING', 'identity').strip().lower()
+        if encoding == 'identity':
+            # Bodies of known length are read as they are
+            if length.isdigit() or 'chunked' not in environ.get(
+                    'HTTP_TRANSFER_ENCODING', '').lower():
+                return
+        elif encoding not in _decoders:
+            raise BodyError(415, 'Unsupported Content-Encoding.')
+
+        raw = _LimitedReader(environ['wsgi.input'],
+                             int(length) if length.isdigit() else None)
+        body = SpooledTemporaryFile(max_size=self.spool_max)
+        size = 0
+        try:
+            reader = raw if encoding == 'identity' else _decoders[encoding](raw)
+            while True:
+                # Reads are bounded, so bombs are caught before inflating
+                data = reader.read(_read_size)
+                if not data:
+                    break
+                size += len(data)
+                if size > self.body_max:
+                    raise BodyError(413, 'Request body is too large.'
+                                    if encoding == 'identity' else
+                                    'Decompressed request body is too large.')
+                body.write(data)
+        except _decode_errors as e:
+            body.close()
+            raise BodyError(400, 'Invalid %s request body: %s' % (encoding, e))
+        except BodyError:
+            body.close()
+            raise
+        body.seek(0)
+
+        environ['wsgi.input'] = body
+        environ['CONTENT_LENGTH'] = str(size)
+        environ.pop('HTTP_TRANSFER_ENCODING', None)
+        # Used by bottle as the request body as is, instead of copying it
+        environ['bottle.request.body'] = body
+
+    def _compressible(self, status, headers):
+        '''Whether response should be compressed'''
+        code = int(status.split(' ', 1)[0])
+        if code < 200 or code in (204, 206, 304):
+            return False
+        for key, value in headers:
+            key = key.lower()
+            if key == 'content-encoding':
+                return False
+            if key == 'content-length' and int(value) < self.minimum:
+                return False
+        return True
+
+    @staticmethod
+    def _iter_compressed(result, state):
+        '''Yield chunks of result, compressed if response is'''
+        for chunk in result:
+            compressor = state.get('compressor')
+            if compressor is None:
+                yield chunk
+            elif chunk:
+                yield compressor(chunk)
+        if state.get('compressor') is not None:
+            yield state['compressor'](None)
+
+class _ClosingIterator:
+    '''Iterator closing WSGI result once done'''
+    def __init__(self, iterator, result):
+        self.iterator = iterator
+        self.result = result
+
+    def __iter__(self):
+        return self.iterator
+
+    def close(self):
+        '''Close WSGI result'''
+        if hasattr(self.result, 'close'):
+            self.result.close()
+
+class _LimitedReader:
+    '''File reading at most length bytes of another file'''
+    def __init__(self, file, length=None):
+        self.file = file
+        self.remaining = length
+
+    def read(self, size=-1):
+        '''Read up to size bytes'''
+        if self.remaining is None:
+            return self.file.read(size)
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size) if size else b''
+        self.remaining -= len(data)
+        return data
+
+    def readable(self):
+        '''File is readable'''
+        return True
+
+def _accepted_encoding(accept_encoding):
+    '''Get preferred encoding of Accept-Encoding, None if there is none'''
+    accepted = {}
+    for item in accept_encoding.lower().split(','):
+        name, _, params = item.partition(';')
+        quality = 1.0
+        for param in params.split(';'):
+            key, _, value = param.strip().partition('=')
+            if key == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[name.strip()] = quality
+
+    best = None
+    for name in _encoders:
+        quality = accepted.get(name, accepted.get('*', 0.0))
+        if quality > 0 and (best is None or quality > accepted.get(best, 0.0)):
+            best = name
+    return best
+
+def _compressed_headers(headers, encoding):
+    '''Get headers of response compressed with encoding'''
+    ret = []
+    vary = None
+    for key, value in headers:
+        lower = key.lower()
+        if lower == 'content-length':
+            continue
+        if lower == 'vary':
+            vary = value
+            continue
+        if lower == 'etag' and not value.startswith('W/'):
+            # Compressed bytes differ, so the entity tag is weak
+            value = 'W/' + value
+        ret.append((key, value))
+    ret.append(('Vary', 'Accept-Encoding' if vary is None
+                        else vary + ', Accept-Encoding'))
+    ret.append(('Content-Encoding', encoding))
+    return ret
+
+def _gzip_encoder(level):
+    '''Get gzip compressor of chunks, flushed after each one'''
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    def compress(data):
+        '''Compress chunk, or finish stream if None'''
+        if data is None:
+            return compressor.flush()
+        return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    return compress
+
+def _zstd_encoder(level):
+    '''Get zstd compressor of chunks, flushed after each one'''
+    compressor = zstandard.ZstdCompressor(level=level).compressobj()
+    def compress(data):
+        '''Compress chunk, or finish stream if None'''
+        if data is None:
+            return compressor.flush()
+        return compressor.compress(data) + compressor.flush(
+            zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+    return compress
+
+# Decoders of request bodies and encoders of responses, by preference
+_decoders = {'gzip': lambda file: gzip.GzipFile(fileobj=file, mode='rb')}
+_encoders = {'gzip': _gzip_encoder}
+_decode_errors = (OSError, EOFError, zlib.error)
+if zstandard is not None:
+    _decoders['zstd'] = lambda file: zstandard.ZstdDecompressor().stream_reader(file)
+    _encoders = {'zstd': _zstd_encoder, 'gzip': _gzip_encoder}
+    _decode_errors += (zstandard.ZstdError,)
@@ -1,62 +1,92 @@
 # coding: utf-8
 '''Provides an XML parser for MulandWeb interface'''
 
-from xml.etree.ElementTree import Element, SubElement, ParseError
-from xml.etree.ElementTree import ElementTree as ElementWrapper
+from xml.etree.ElementTree import ParseError
 from io import BytesIO
-from defusedxml import ElementTree
+import numpy as np
+from defusedxml import ElementTree, DefusedXmlException
 
-__all__ = ['load', 'loads', 'dump', 'dumps']
+__all__ = ['XMLParseError', 'load', 'loads', 'iterload', 'dump', 'dumps', 'iterdump']
+
+class XMLParseError(Exception):
+    '''XML input couldn't be parsed'''
+    pass
+
+_chunk_rows = 1024
 
 def dump(datain, file):
-    '''Build and return XML file from data generated by Muland'''
-    ElementWrapper(_build(datain)).write(file, encoding='utf-8',
-                                         xml_declaration=True)
+    '''Write XML of data generated by Muland to binary file, as generated'''
+    for chunk in iterdump(datain):
+        file.write(chunk)
 
 def dumps(datain):
     '''Build and return XML string from data generated by Muland'''
-    buffer = BytesIO()
-    dump(datain, buffer)
-    return buffer.getvalue().decode('utf-8')
+    return b''.join(iterdump(datain)).decode('utf-8')
 
-def _build(datain):
-    '''Build and return XML Element from Muland Output dict'''
-    datatag = Element('data')
+def iterdump(datain):
+    '''Generate XML from Muland output dict as chunks of bytes
+
+    Records are formatted a block of rows at a time, so memory used doesn't
+    grow with the size of output data.
+    '''
+    if not datain:
+        yield b"<?xml version='1.0' encoding='utf-8'?>\n<data />"
+        return
+
+    # Tags are sent along with the next block of records
+    prefix = "<?xml version='1.0' encoding='utf-8'?>\n<data>"
     for file_key, file_value in datain.items():
-        filetag = SubElement(datatag, file_key)
-        for record in file_value:
-            recordtag = SubElement(filetag, 'record')
-            for recdata in record:
-                SubElement(recordtag, 'rd').text = str(recdata)
-    return datatag
+        if not len(file_value):
+            prefix += '<%s />' % file_key
+            continue
+        prefix += '<%s>' % file_key
+        record_format = '<record>' + '<rd>%r</rd>' * len(file_value[0]) + '</record>'
+        for start in range(0, len(file_value), _chunk_rows):
+            block = np.asarray(file_value[start:start + _chunk_rows], dtype=float)
+            yield (prefix + (record_format * block.shape[0]) %
+                   tuple(block.ravel().tolist())).encode('utf-8')
+            prefix = ''
+        prefix += '</%s>' % file_key
+    yield (prefix + '</data>').encode('utf-8')
 
 def load(file):
-    '''Load XML from file-like object and returns location list'''
+    '''Load XML from file-like object and returns location list
+
+    Raises XMLParseError if XML is malformed or uses forbidden constructs.
+    '''
+    return list(iterload(file))
+
+def iterload(file):
+    '''Load XML from file-like object, yielding locations as they're parsed
+
+    Locations are converted as soon as they are parsed and then dropped from
+    the tree, so memory doesn't grow with the number of locations. Raises
+    XMLParseError if XML is malformed or uses forbidden constructs.
+    '''
+    root = None
+    depth = 0
     try:
-        tree = ElementTree.parse(file)
-        root = tree.getroot()
-    except ParseError:
-        return
-    return _parse_root(root)
+        for event, element in ElementTree.iterparse(file, events=('start', 'end')):
+            if event == 'start':
+                if root is None:
+                    root = element
+                depth += 1
+                continue
+            depth -= 1
+            if depth == 1:
+                if element.tag == 'location':
+                    location = _parse_location(element)
+                    if location is not None:
+                        yield location
+                root.clear()
+    except (ParseError, DefusedXmlException) as e:
+        raise XMLParseError(str(e))
 
 def loads(string):
     '''Load XML from string and returns location list'''
-    try:
-        tree = ElementTree.fromstring(string)
-        root = tree.getroot()
-    except ParseError:
-        return
-    return _parse_root(root)
-
-def _parse_root(root):
-    '''Parse Tree's root returning location list'''
-    ret = []
-    for element in root:
-        if element.tag == 'location':
-            location = _parse_location(element)
-            if location is not None:
-                ret.append(location)
-    return ret
+    if isinstance(string, str):
+        string = string.encode('utf-8')
+    return load(BytesIO(string))
 
 def _parse_location(location):
     '''Parse location tag returning dict of it.'''
@@ -100,6 +130,6 @@ def _parse_override(override):
     '''Parse override tags returning value of override.'''
     try:
         value = float(override.text)
-    except ValueError:
+    except (TypeError, ValueError):
         return
     return value
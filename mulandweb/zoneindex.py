@@ -0,0 +1,90 @@
+# coding: utf-8
+'''Provides in-process spatial index of model zones'''
+
+import numpy as np
+import shapely
+from sqlalchemy import select, func
+
+from .snapshot import SnapshotCache
+from . import config
+from . import db
+
+__all__ = ['ZoneIndex', 'zone_indexes']
+
+_earth_radius = 6378137.0 # sphere used by EPSG:900913
+
+class ZoneIndex:
+    '''STRtree of zone polygons of a model version, in EPSG:900913'''
+    def __init__(self, models_id: int, version: int, ids, areas, data):
+        self.models_id = models_id
+        self.version = version
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.data = np.array(data, dtype=float).reshape(len(self.ids), -1)
+        self.tree = shapely.STRtree(areas)
+        self.nbytes = (int(shapely.get_num_coordinates(areas).sum()) * 16 +
+                       self.ids.nbytes + self.data.nbytes)
+
+    @classmethod
+    def load(cls, conn, models_id: int, version: int):
+        '''Load zones of model from the database'''
+        db_zones = db.zones
+
+        s = (select([db_zones.c.id,
+                     func.ST_AsBinary(db_zones.c.area),
+                     db_zones.c.data])
+            .where(db_zones.c.models_id == models_id))
+
+        result = conn.execute(s)
+        ids = []
+        areas = []
+        data = []
+        for row in result:
+            ids.append(row[0])
+            areas.append(bytes(row[1]))
+            data.append(row[2])
+        result.close()
+
+        return cls(models_id, version, ids, shapely.from_wkb(areas), data)
+
+    def lookup(self, location_ids, lngs, lats):
+        '''Find zones containing locations
+
+        Returns tuple (location_ids, zones_ids, values) in the same format
+        returned by MulandDB._get_zones.
+        '''
+        points = np.column_stack((np.asarray(lngs, dtype=float),
+                                  np.asarray(lats, dtype=float)))
+        rows, zones = self._query(points)
+        location_ids = np.asarray(location_ids, dtype=np.int64)[rows]
+        values = np.column_stack((location_ids + 1, self.data[zones]))
+        return location_ids, self.ids[zones], values
+
+    def _query(self, points):
+        '''Return arrays (point row, zone row) of zones containing points
+
+        Each distinct point is queried only once.
+        '''
+        unique, inverse = np.unique(points, axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        unique_rows, zones = self.tree.query(shapely.points(_to_mercator(unique)),
+                                             predicate='within')
+
+        # Group matches by distinct point, then expand them to every point
+        order = np.argsort(unique_rows, kind='stable')
+        zones = zones[order]
+        counts = np.bincount(unique_rows, minlength=unique.shape[0])
+        starts = np.cumsum(counts) - counts
+        matches = counts[inverse]
+        rows = np.repeat(np.arange(points.shape[0]), matches)
+        offsets = np.arange(rows.shape[0]) - np.repeat(np.cumsum(matches) - matches,
+                                                       matches)
+        return rows, zones[np.repeat(starts[inverse], matches) + offsets]
+
+def _to_mercator(lnglat):
+    '''Project EPSG:4326 lng/lat pairs into EPSG:900913'''
+    lng = np.radians(lnglat[:, 0])
+    lat = np.radians(lnglat[:, 1])
+    return np.column_stack((_earth_radius * lng,
+                            _earth_radius * np.log(np.tan(np.pi / 4 + lat / 2))))
+
+zone_indexes = SnapshotCache(config.mulandweb_zone_index_max)
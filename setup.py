@@ -9,15 +9,21 @@ setup(name='mulandweb',
       author='Leandro Pereira de Lima e Silva',
       author_email='leandro@limaesilva.com.br',
       license='MIT',
-      packages=['mulandweb'],
+      packages=['mulandweb', 'mulandweb.benchmark'],
       install_requires=[
         'bottle',
-        'gunicorn',
+        'gunicorn>=24.0', # first with the asgi worker
         'GeoAlchemy2',
         'psycopg2',
         'SQLAlchemy',
         'pyshp',
-        'shapely',
+        'shapely>=2.0',
         'defusedxml',
+        'numpy',
       ],
+      extras_require={
+        'msgpack': ['msgpack'],
+        'orjson': ['orjson'],
+        'zstd': ['zstandard'],
+      },
       zip_safe=False)
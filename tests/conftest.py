@@ -0,0 +1,9 @@
+# coding: utf-8
+'''Test configuration, set before mulandweb reads it at import'''
+
+import os
+import tempfile
+
+os.environ.setdefault('MULAND_ENGINE', 'numpy')
+os.environ.setdefault('MULAND_WORK_PATH', tempfile.mkdtemp(prefix='muland-work-'))
+os.environ.setdefault('MULANDWEB_METRICS_PATH', '')
@@ -0,0 +1,38 @@
+# coding: utf-8
+'''Compares the numpy engine against mu-land outputs of demo-city'''
+
+import csv
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from mulandweb.muland import Muland, MulandData
+from mulandweb.engine import MulandEngine
+
+demo_city = Path(__file__).parent.parent / 'muLand' / 'test' / 'demo-city'
+
+def load_input():
+    '''Load demo-city input as Muland arguments'''
+    kwargs = {}
+    for name in Muland.input_files:
+        with open(str(demo_city / 'input' / (name + '.csv'))) as file:
+            reader = csv.reader(file, delimiter=';', quoting=csv.QUOTE_NONNUMERIC)
+            header = next(reader)
+            kwargs[name] = MulandData(header, [row for row in reader if row])
+    return kwargs
+
+@pytest.fixture(scope='module')
+def engine():
+    mu = MulandEngine(**load_input())
+    mu.run()
+    return mu
+
+@pytest.mark.parametrize('name', Muland.output_files)
+def test_demo_city_parity(engine, name):
+    # Reference outputs were written by mu-land with 6 significant digits
+    expected = np.loadtxt(str(demo_city / 'output' / (name + '.csv')),
+                          delimiter=';', skiprows=1, ndmin=2)
+    actual = np.asarray(engine.output_data[name], dtype=float)
+    assert actual.shape == expected.shape
+    np.testing.assert_allclose(actual, expected, rtol=1e-4, atol=1e-4)
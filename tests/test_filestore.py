@@ -0,0 +1,88 @@
+# coding: utf-8
+'''Tests of the embedded model store against a synthetic model'''
+
+import numpy as np
+import pytest
+
+from mulandweb.benchmark.synthetic import SyntheticModel
+from mulandweb.filestore import ModelFileDB, ModelFileImporter, open_model
+from mulandweb.ingest import from_locations
+from mulandweb.mulanddb import MulandDB, MulandDBException, ModelImporter
+from mulandweb import config
+
+model = SyntheticModel(zones=9, agents=4, types=6)
+name = 'pytestsynthetic'
+
+@pytest.fixture(scope='module')
+def store(tmp_path_factory):
+    '''Folder of model files, holding the synthetic model'''
+    path = tmp_path_factory.mktemp('store')
+    model.write(str(path), name)
+    with pytest.MonkeyPatch.context() as patch:
+        # Model files are read from a folder named as the model
+        patch.chdir(str(path))
+        ModelFileImporter(name, path=str(path / 'models')).import_model()
+        patch.setattr(config, 'mulandweb_store_path', str(path / 'models'))
+        yield path
+
+def sorted_rows(values):
+    return values[np.lexsort(values.T[::-1])]
+
+def assert_same_data(actual, expected):
+    for table in expected:
+        if table == 'static_key':
+            continue
+        assert actual[table].header == expected[table].header, table
+        np.testing.assert_allclose(sorted_rows(actual[table].values),
+                                   sorted_rows(expected[table].values),
+                                   err_msg=table)
+
+def scenario():
+    locations = model.locations(20, units=3, seed=1)
+    # Outside any zone
+    locations.append({'lnglat': [0, 0], 'units': [{'type': 1}]})
+    return from_locations(locations)
+
+def test_get_matches_model(store):
+    with ModelFileDB(name, scenario()) as mudb:
+        data = mudb.get()
+    assert mudb.outside_locations == 1
+    assert_same_data(data, model.muland_data(scenario()))
+
+def test_static_tables_are_mapped(store):
+    model_file = open_model(name)
+    agents = model_file.snapshot.values('agents')
+    assert np.shares_memory(agents, model_file.arrays['agents'])
+    assert not agents.flags.writeable
+
+def test_update_replaces_version(store, monkeypatch):
+    monkeypatch.chdir(str(store))
+    path = str(store / 'models')
+    with pytest.raises(MulandDBException):
+        ModelFileImporter(name, path=path).import_model()
+    version = open_model(name).version
+    ModelFileImporter(name, path=path, update=True).import_model()
+    assert open_model(name).version == version + 1
+
+def test_matches_postgis(store, monkeypatch):
+    '''Both stores give the same data, if a database is available'''
+    from mulandweb import db
+    from mulandweb.mulanddb import get_model_version, ModelNotFound
+    try:
+        db.create_tables()
+    except Exception as e: # pylint: disable=broad-except
+        pytest.skip('No database: %s' % e)
+
+    monkeypatch.chdir(str(store))
+    try:
+        get_model_version(name)
+        update = True
+    except ModelNotFound:
+        update = False
+    ModelImporter(name, update=update).import_model()
+
+    with MulandDB(name, scenario()) as mudb:
+        expected = mudb.get()
+    with ModelFileDB(name, scenario()) as mudb:
+        actual = mudb.get()
+    assert_same_data(actual, expected)
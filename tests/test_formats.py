@@ -0,0 +1,85 @@
+# coding: utf-8
+'''Tests of codecs of request and response bodies'''
+
+import json
+from io import BytesIO
+
+import numpy as np
+import pytest
+
+from mulandweb import formats
+from mulandweb.formats import CodecError, JSONCodec, NPZCodec, XMLCodec
+
+output = {'rents': np.arange(12, dtype=float).reshape(4, 3) / 3,
+          'bh': np.zeros((0, 2)), 'bids': np.array([[1.0, 2.5]])}
+
+def npz_body(**arrays):
+    buffer = BytesIO()
+    np.savez(buffer, **arrays)
+    buffer.seek(0)
+    return buffer
+
+@pytest.mark.parametrize('backend', ['json', 'orjson'])
+def test_json_round_trip(backend, monkeypatch):
+    pytest.importorskip(backend)
+    # Rows span several chunks
+    monkeypatch.setattr(formats, '_chunk_rows', 3)
+    codec = JSONCodec(backend)
+    data = codec.load(BytesIO(b''.join(codec.iterdump(output))), codec.mimes[0])
+    assert list(data) == list(output)
+    for key, values in output.items():
+        np.testing.assert_array_equal(np.asarray(data[key]).reshape(values.shape),
+                                      values)
+    assert b''.join(codec.iterdump({})) == b'{}'
+
+def test_json_invalid():
+    with pytest.raises(CodecError):
+        JSONCodec('json').load(BytesIO(b'{"loc": '), 'application/json')
+
+def test_xml_scenario():
+    body = BytesIO(b'<data><location lng="1" lat="2"><unit type="3" /></location></data>')
+    scenario = XMLCodec().load_scenario(body, 'application/xml; charset=utf-8')
+    assert scenario.lng.tolist() == [1.0]
+    assert scenario.unit_type.tolist() == [3]
+    with pytest.raises(CodecError):
+        XMLCodec().load(BytesIO(b'<data />'), 'application/xml')
+
+def test_npz_round_trip():
+    codec = NPZCodec()
+    data = codec.load(BytesIO(b''.join(codec.iterdump(output))), codec.mimes[0])
+    for key, values in output.items():
+        np.testing.assert_array_equal(data[key], values)
+
+def test_npz_scenario():
+    body = npz_body(lng=[1.0, 2.0], lat=[3.0, 4.0], unit_loc=[1], unit_type=[5],
+                    **{'loc.acc': [np.nan, 6.0]})
+    scenario = NPZCodec().load_scenario(body, 'application/x-npz')
+    assert scenario.names == ['ACC']
+    assert scenario.location_overrides[0].tolist() == [1]
+    assert NPZCodec().load_scenario(BytesIO(), 'application/x-npz') is None
+
+@pytest.mark.parametrize('body', [
+    b'PK\x03\x04not a zip file',
+    b'not an npz file',
+])
+def test_npz_invalid(body):
+    with pytest.raises(CodecError):
+        NPZCodec().load(BytesIO(body), 'application/x-npz')
+
+def test_npz_single_array():
+    buffer = BytesIO()
+    np.save(buffer, np.zeros(3))
+    buffer.seek(0)
+    with pytest.raises(CodecError):
+        NPZCodec().load(buffer, 'application/x-npz')
+
+def test_npz_no_pickles():
+    with pytest.raises(CodecError):
+        NPZCodec().load(npz_body(lng=np.array([{}], dtype=object)), 'application/x-npz')
+
+def test_codec_selection():
+    assert formats.for_content_type('Application/JSON; charset=utf-8') is formats.json_codec
+    assert formats.for_content_type('text/plain') is None
+    assert isinstance(formats.for_accept('text/html, application/x-npz;q=0.9', None),
+                      NPZCodec)
+    assert formats.for_accept(None, formats.json_codec) is formats.json_codec
@@ -0,0 +1,61 @@
+# coding: utf-8
+'''Tests of ingestion of request locations'''
+
+import numpy as np
+import pytest
+
+from mulandweb.ingest import IngestError, from_columns, from_locations, load
+
+def test_locations_and_columns_agree():
+    by_locations = from_locations([
+        {'lnglat': [1, 2], 'acc': 3, 'units': [{'type': 4}, {'type': 5, 'nrest': 6}]},
+        {'lnglat': [7, 8], 'units': []},
+    ])
+    by_columns = from_columns({
+        'lng': [1, 7], 'lat': [2, 8], 'unit_loc': [0, 0], 'unit_type': [4.0, 5.0],
+        # Names are numbered in the order they're found, units first
+        'unit.nrest': [np.nan, 6], 'loc.acc': [3, np.nan],
+    })
+    assert by_locations.digest() == by_columns.digest()
+
+def test_integral_float_types():
+    scenario = load({'loc': [{'lnglat': [1.5, 2], 'units': [{'type': 3.0}]}]})
+    assert scenario.unit_type.tolist() == [3]
+
+@pytest.mark.parametrize('data_in', [
+    [], {}, {'loc': {}}, {'loc': [{'units': []}]},
+    {'loc': [{'lnglat': [1], 'units': []}]},
+    {'loc': [{'lnglat': [1, 'a'], 'units': []}]},
+    {'loc': [{'lnglat': [1, 2]}]},
+    {'loc': [{'lnglat': [1, 2], 'units': [{'type': 'a'}]}]},
+    {'loc': [{'lnglat': [float('nan'), 2], 'units': []}]},
+    {'loc': [{'lnglat': [1, float('inf')], 'units': []}]},
+    {'loc': [{'lnglat': [10 ** 400, 2], 'units': []}]},
+    {'loc': [{'lnglat': [True, 2], 'units': []}]},
+    {'loc': [{'lnglat': [1, 2], 'units': [{'type': 1.5}]}]},
+    {'loc': [{'lnglat': [1, 2], 'units': [{'type': True}]}]},
+    {'loc': [{'lnglat': [1, 2], 'units': [{'type': -1}]}]},
+    {'loc': [{'lnglat': [1, 2], 'units': [{'type': 2 ** 31}]}]},
+])
+def test_invalid_locations(data_in):
+    with pytest.raises(IngestError):
+        load(data_in)
+
+@pytest.mark.parametrize('columns', [
+    {'lat': [1]},
+    {'lng': [1, 2], 'lat': [1]},
+    {'lng': [np.nan], 'lat': [1]},
+    {'lng': [1], 'lat': [np.inf]},
+    {'lng': [1], 'lat': [1], 'unit_loc': [0], 'unit_type': [1.5]},
+    {'lng': [1], 'lat': [1], 'unit_loc': [0.5], 'unit_type': [1]},
+    {'lng': [1], 'lat': [1], 'unit_loc': ['a'], 'unit_type': [1]},
+    {'lng': [1], 'lat': [1], 'unit_loc': [1], 'unit_type': [1]},
+    {'lng': [1], 'lat': [1], 'unit_loc': [0], 'unit_type': [True]},
+    {'lng': [1], 'lat': [1], 'unit_loc': [0], 'unit_type': [-1]},
+    {'lng': [1], 'lat': [1], 'unit_loc': [0], 'unit_type': [2 ** 31]},
+    {'lng': [1], 'lat': [1], 'unit_loc': [0], 'unit_type': [1e20]},
+    {'lng': [1], 'lat': [1], 'loc.acc': [1, 2]},
+])
+def test_invalid_columns(columns):
+    with pytest.raises(IngestError):
+        from_columns(columns)
@@ -0,0 +1,34 @@
+# coding: utf-8
+'''Tests of metrics shared by processes through files'''
+
+import os
+
+from mulandweb import metrics
+
+def write_series(path, filename, count):
+    metrics._write_series(str(path), filename, {
+        ('mulandweb_locations_total', ('demo',)): count})
+
+def test_render_sums_processes(tmp_path):
+    write_series(tmp_path, '1-aaaa.json', 2)
+    write_series(tmp_path, '2-bbbb.json', 3)
+    assert 'mulandweb_locations_total{model="demo"} 5.0' in metrics.render(str(tmp_path))
+
+def test_retire_keeps_totals(tmp_path):
+    write_series(tmp_path, '10-aaaa.json', 2)
+    write_series(tmp_path, '10-11-bbbb.json', 3)
+    write_series(tmp_path, '100-cccc.json', 4)
+    metrics.retire(10, str(tmp_path))
+    metrics.retire(12, str(tmp_path))
+    assert sorted(name for name in os.listdir(str(tmp_path))
+                  if name.endswith('.json')) == ['100-cccc.json', 'retired.json']
+    write_series(tmp_path, '20-dddd.json', 1)
+    metrics.retire(20, str(tmp_path))
+    assert 'mulandweb_locations_total{model="demo"} 10.0' in metrics.render(str(tmp_path))
+
+def test_adopt_names_file_after_owner(tmp_path):
+    metrics.adopt(42)
+    metrics.locations.inc(model='demo')
+    metrics.flush(str(tmp_path))
+    assert [name.split('-')[:2] for name in os.listdir(str(tmp_path))
+            if name.endswith('.json')] == [['42', str(os.getpid())]]
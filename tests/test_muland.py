@@ -0,0 +1,40 @@
+# coding: utf-8
+'''Tests of working dirs populated for mu-land'''
+
+import os
+
+from mulandweb.muland import Muland
+
+from test_engine import load_input
+
+def populate(work_folder, static_key):
+    mu = Muland(static_key=static_key, **load_input())
+    working_dir = work_folder / ('run-' + static_key)
+    os.mkdir(str(working_dir))
+    mu._populate_working_dir(str(working_dir))
+    return working_dir
+
+def test_static_files_are_shared(tmp_path, monkeypatch):
+    monkeypatch.setattr(Muland, 'work_folder', str(tmp_path))
+    first = populate(tmp_path, '3-1')
+    agents = first / 'input' / 'agents.csv'
+    assert os.stat(str(agents)).st_nlink == 2
+    assert (first / 'input' / 'zones.csv').exists()
+    assert sorted(os.listdir(str(tmp_path / 'static'))) == ['3-1']
+
+def test_other_versions_are_pruned(tmp_path, monkeypatch):
+    monkeypatch.setattr(Muland, 'work_folder', str(tmp_path))
+    old = populate(tmp_path, '3-1')
+    populate(tmp_path, '13-1')
+    populate(tmp_path, '3-2')
+    assert sorted(os.listdir(str(tmp_path / 'static'))) == ['13-1', '3-2']
+    # Runs of the old version keep their files
+    assert (old / 'input' / 'agents.csv').exists()
+
+def test_pruned_meanwhile(tmp_path, monkeypatch):
+    monkeypatch.setattr(Muland, 'work_folder', str(tmp_path))
+    mu = Muland(static_key='3-1', **load_input())
+    monkeypatch.setattr(mu, '_get_static_dir', lambda: tmp_path / 'static' / 'gone')
+    os.mkdir(str(tmp_path / 'run'))
+    mu._populate_working_dir(str(tmp_path / 'run'))
+    assert (tmp_path / 'run' / 'input' / 'agents.csv').exists()
@@ -0,0 +1,38 @@
+# coding: utf-8
+'''Tests of overrides of scenarios applied to Muland data'''
+
+import numpy as np
+
+from mulandweb.ingest import from_locations
+from mulandweb.muland import MulandData
+from mulandweb.mulanddb import Overrides
+
+def scenario():
+    return from_locations([
+        {'lnglat': [0, 0], 'acc': 5, 'units': [{'type': 1},
+                                               {'type': 2, 'acc': 7, 'nrest': 3}]},
+        {'lnglat': [1, 1], 'units': [{'type': 1, 'id_zone': 9}]},
+    ])
+
+def test_location_tables():
+    data = MulandData(['I_IDX', 'ACC', 'NREST'], [[1, 0, 0], [2, 0, 0], [3, 0, 0]])
+    Overrides(scenario()).apply(data)
+    np.testing.assert_array_equal(data.values, [[1, 5, 0], [2, 0, 0], [3, 0, 0]])
+
+def test_unit_tables():
+    data = MulandData(['I_IDX', 'V_IDX', 'ACC', 'NREST'],
+                      [[1, 1, 0, 0], [1, 2, 0, 0], [2, 1, 0, 0], [2, 2, 0, 0]])
+    Overrides(scenario()).apply(data)
+    # Units start from overrides of their location, replaced by their own
+    np.testing.assert_array_equal(data.values, [[1, 1, 5, 0], [1, 2, 7, 3],
+                                                [2, 1, 0, 0], [2, 2, 0, 0]])
+
+def test_ids_not_overridden():
+    data = MulandData(['I_IDX', 'V_IDX', 'ID_ZONE'], [[2, 1, 4]])
+    Overrides(scenario()).apply(data)
+    np.testing.assert_array_equal(data.values, [[2, 1, 4]])
+
+def test_tables_without_indexes():
+    data = MulandData(['ACC'], [[1]])
+    Overrides(scenario()).apply(data)
+    np.testing.assert_array_equal(data.values, [[1]])
@@ -0,0 +1,34 @@
+# coding: utf-8
+'''Tests of profiling of requests'''
+
+import os
+import time
+
+from mulandweb import profiling
+from mulandweb.profiling import RequestProfile
+
+def test_save_and_load(tmp_path):
+    with RequestProfile('demo') as profile:
+        sum(range(1000))
+    profile.save(str(tmp_path))
+    summary = profiling.load_summary(profile.id, str(tmp_path))
+    assert summary['model'] == 'demo' and summary['functions']
+    assert (tmp_path / (profile.id + '.prof')).exists()
+    assert profiling.load_summary('../' + profile.id, str(tmp_path)) is None
+
+def test_save_keeps_latest(tmp_path):
+    ids = []
+    for age in (30, 20, 10):
+        with RequestProfile('demo') as profile:
+            pass
+        profile.save(str(tmp_path), keep=10)
+        for suffix in ('.json', '.prof'):
+            past = time.time() - age
+            os.utime(str(tmp_path / (profile.id + suffix)), (past, past))
+        ids.append(profile.id)
+    with RequestProfile('demo') as profile:
+        pass
+    profile.save(str(tmp_path), keep=2)
+    assert sorted(os.listdir(str(tmp_path))) == sorted(
+        profile_id + suffix for profile_id in (ids[2], profile.id)
+        for suffix in ('.json', '.prof'))
@@ -0,0 +1,48 @@
+# coding: utf-8
+'''Tests of reducers of Mu-Land output'''
+
+import numpy as np
+import pytest
+
+from mulandweb.muland import MulandData
+from mulandweb.reducers import ReducerError, reduce
+
+def data():
+    # Locations 1 and 2 are in zone 7, location 3 in zone 9
+    input_data = {
+        'agents': MulandData(['IDAGENT', 'IDMARKET', 'INCOME'],
+                             [[1, 1, 1000], [2, 1, 2000]]),
+        'location_zones': MulandData(['I_IDX', 'ZONE'], [[3, 9], [1, 7], [2, 7]]),
+    }
+    output_data = {
+        'rents': np.array([[1, 1, 100.], [2, 1, 300.], [1, 2, 200.], [1, 3, 50.]]),
+        'location': np.array([[1, 1, 1., 0.], [2, 1, 0., 3.], [1, 2, 1., 1.],
+                              [1, 3, 0., 0.]]),
+    }
+    return input_data, output_data
+
+def test_zone_rollup_by_model_zone():
+    table = reduce(['zone_rollup'], {}, *data())['zone_rollup']
+    np.testing.assert_allclose(table, [
+        # Rent of zone 7 is weighted by households of its two locations
+        [7, 6, (100 + 3 * 300 + 2 * 200) / 6, 2, 4],
+        # Zone 9 has no households, so its rent is a plain mean
+        [9, 0, 50, 0, 0],
+    ])
+
+def test_zone_rollup_location_without_zone():
+    input_data, output_data = data()
+    input_data['location_zones'] = MulandData(['I_IDX', 'ZONE'], [[1, 7]])
+    with pytest.raises(ReducerError):
+        reduce(['zone_rollup'], {}, input_data, output_data)
+
+def test_affordability():
+    table = reduce(['affordability'], {'income_attr': 'income', 'periods': '1'},
+                   *data())['affordability']
+    np.testing.assert_allclose(table[0], [1, 1, 1, 0.1, 0, 0])
+    np.testing.assert_allclose(table[2], [1, 2, 2, (0.2 + 0.1) / 2, 0, 0])
+    np.testing.assert_allclose(table[3, 2:], [0, 0, 0, 0])
+
+def test_affordability_requires_income():
+    with pytest.raises(ReducerError):
+        reduce(['affordability'], {}, *data())
@@ -0,0 +1,87 @@
+# coding: utf-8
+'''Tests of the cache of Mu-Land results'''
+
+import os
+import time
+import threading
+
+import numpy as np
+
+from mulandweb import resultcache
+from mulandweb.resultcache import ResultCache
+
+def output(value=1.0):
+    return {'rents': np.full((2, 3), value)}
+
+def test_memory_lru():
+    cache = ResultCache(2, 3600, '')
+    for key in 'abc':
+        cache.get_or_compute(key, output)
+    assert list(cache._entries) == ['b', 'c']
+    cache.get_or_compute('b', output)
+    cache.get_or_compute('d', output)
+    assert list(cache._entries) == ['b', 'd']
+
+def test_memory_expires():
+    cache = ResultCache(2, -1, '')
+    cache.get_or_compute('a', output)
+    _, hit = cache.get_or_compute('a', output)
+    assert not hit
+
+def test_single_flight():
+    cache = ResultCache(0, 3600, '')
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def compute():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return output()
+
+    hits = []
+    threads = [threading.Thread(target=lambda: hits.append(
+        cache.get_or_compute('a', compute)[1])) for _ in range(4)]
+    threads[0].start()
+    started.wait(5)
+    for thread in threads[1:]:
+        thread.start()
+    time.sleep(0.1)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert sorted(hits) == [False, True, True, True]
+    assert not cache._inflight
+
+def test_disk_round_trip(tmp_path):
+    cache = ResultCache(0, 3600, str(tmp_path))
+    value, hit = cache.get_or_compute('ab12', lambda: output(2.0))
+    assert not hit
+    value, hit = ResultCache(0, 3600, str(tmp_path)).get_or_compute('ab12', output)
+    assert hit
+    np.testing.assert_array_equal(value['rents'], output(2.0)['rents'])
+    assert not list(tmp_path.glob('*/*.lock'))
+
+def test_disk_expired_removed_on_read(tmp_path):
+    cache = ResultCache(0, 60, str(tmp_path))
+    cache.get_or_compute('ab12', output)
+    filename = cache._filename('ab12')
+    past = time.time() - 120
+    os.utime(str(filename), (past, past))
+    assert cache._read_disk('ab12') is None
+    assert not filename.exists()
+
+def test_disk_sweep_evicts_oldest(tmp_path, monkeypatch):
+    monkeypatch.setattr(resultcache, '_sweep_interval', 0)
+    cache = ResultCache(0, 3600, str(tmp_path))
+    for age, key in [(200, 'aa01'), (100, 'bb02')]:
+        cache.get_or_compute(key, output)
+        past = time.time() - age
+        os.utime(str(cache._filename(key)), (past, past))
+    cache.max_bytes = 2 * cache._filename('aa01').stat().st_size
+    cache.get_or_compute('cc03', output)
+    assert not cache._filename('aa01').exists()
+    assert cache._filename('bb02').exists()
+    assert cache._filename('cc03').exists()
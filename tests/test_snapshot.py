@@ -0,0 +1,47 @@
+# coding: utf-8
+'''Tests of the cache of location independent model tables'''
+
+import numpy as np
+
+from mulandweb.snapshot import ModelSnapshot, SnapshotCache
+
+def snapshot(models_id=1, version=1, rows=4):
+    return ModelSnapshot(models_id, version, {'agents': ['A', 'B']},
+                         {'agents': np.ones((rows, 2))})
+
+def test_snapshot_is_read_only():
+    item = snapshot()
+    assert item.nbytes == 4 * 2 * 8
+    assert not item.values('agents').flags.writeable
+
+def test_get_checks_version():
+    cache = SnapshotCache(1024)
+    cache.put('demo', snapshot(version=1))
+    assert cache.get('demo', 1, 1) is not None
+    assert cache.get('demo', 1, 2) is None
+    # Stale snapshots are dropped
+    assert cache.get('demo', 1, 1) is None
+    assert cache.nbytes == 0
+
+def test_evicts_least_recently_used():
+    item = snapshot()
+    cache = SnapshotCache(2 * item.nbytes)
+    cache.put('a', snapshot())
+    cache.put('b', snapshot())
+    cache.get('a', 1, 1)
+    cache.put('c', snapshot())
+    assert cache.get('a', 1, 1) is not None
+    assert cache.get('b', 1, 1) is None
+    assert cache.get('c', 1, 1) is not None
+    assert cache.nbytes == 2 * item.nbytes
+
+def test_replace_and_oversized():
+    item = snapshot()
+    cache = SnapshotCache(item.nbytes)
+    cache.put('a', snapshot(version=1))
+    cache.put('a', snapshot(version=2))
+    assert cache.nbytes == item.nbytes
+    assert cache.get('a', 1, 2) is not None
+    cache.put('b', snapshot(rows=8))
+    assert cache.get('b', 1, 1) is None
+    assert cache.get('a', 1, 2) is not None
@@ -0,0 +1,50 @@
+# coding: utf-8
+'''Tests of reading XML input and writing XML output'''
+
+from io import BytesIO
+from xml.etree import ElementTree
+
+import numpy as np
+import pytest
+
+from mulandweb import xmlparser
+
+def test_load_locations():
+    locations = xmlparser.loads(
+        '<data><location lng="-1.5" lat="2"><acc>3</acc>'
+        '<unit type="4"><nrest>5</nrest><bad>x</bad></unit><unit /></location>'
+        '<location lng="x" lat="1" /><other /></data>')
+    assert locations == [{'lnglat': [-1.5, 2.0], 'acc': 3.0,
+                          'units': [{'type': 4, 'nrest': 5.0}]}]
+
+def test_iterload_is_incremental():
+    xml = b'<data>' + b'<location lng="0" lat="0" />' * 3 + b'</data>'
+    locations = xmlparser.iterload(BytesIO(xml))
+    assert next(locations) == {'lnglat': [0.0, 0.0], 'units': []}
+    assert len(list(locations)) == 2
+
+@pytest.mark.parametrize('xml', [
+    '<data><location></data>',
+    '<!DOCTYPE data [<!ENTITY a "aaaa">]><data>&a;</data>',
+])
+def test_invalid_xml(xml):
+    with pytest.raises(xmlparser.XMLParseError):
+        xmlparser.loads(xml)
+
+def test_dump_round_trip(monkeypatch):
+    # Records span several chunks
+    monkeypatch.setattr(xmlparser, '_chunk_rows', 2)
+    output = {'rents': np.arange(15, dtype=float).reshape(5, 3) / 7,
+              'bh': [], 'bids': [[1.0, 2.5]]}
+    chunks = list(xmlparser.iterdump(output))
+    assert len(chunks) > 3
+
+    root = ElementTree.fromstring(b''.join(chunks))
+    assert [child.tag for child in root] == list(output)
+    for child in root:
+        values = [[float(rd.text) for rd in record] for record in child]
+        np.testing.assert_array_equal(np.asarray(values).reshape(-1),
+                                      np.asarray(output[child.tag]).reshape(-1))
+
+def test_dump_empty():
+    assert ElementTree.fromstring(xmlparser.dumps({})).tag == 'data'